@@ -1,11 +1,11 @@
-from tornado.gen import multi
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 import tornado.httpclient
 
 import anthill.common.admin as a
 from anthill.common import run_on_executor
 from anthill.common.server import Server
 from anthill.common.environment import EnvironmentClient, AppNotFound
+from anthill.common.options import options
 from anthill.common.database import format_conditions_json, ConditionError
 from anthill.common.validate import validate, ValidationError
 from anthill.common.jsonrpc import JsonRPCError, JSONRPC_TIMEOUT
@@ -16,19 +16,18 @@ from .model.deploy import DeploymentError, DeploymentNotFound, NoCurrentDeployme
 from .model.deploy import DeploymentDeliveryError, DeploymentDeliveryAdapter
 from .model.ban import NoSuchBan, BanError, UserAlreadyBanned
 from .model.room import RoomQuery, RoomNotFound, RoomError
+from .model.distribution import Delivery, DeliveryError, NothingToDeliver
+from .model.ziptest import ZipStreamTest
 
 from concurrent.futures import ThreadPoolExecutor
 
-from geoip import geolite2
 from urllib import parse
 import socket
 import logging
 import os
-import zipfile
 import hashlib
 import datetime
 import math
-import re
 import ujson
 
 
@@ -732,174 +731,6 @@ class ApplicationVersionController(a.AdminController):
         return ["game_admin"]
 
 
-class Delivery(object):
-    def __init__(self, application, gamespace):
-        self.application = application
-        self.gamespace = gamespace
-
-    async def __deliver_host__(self, game_name, game_version, deployment_id, delivery_id, host, deployment_hash):
-        deployments = self.application.deployments
-        rpc = self.application.rpc.acquire_rpc("admin")
-
-        try:
-            result = await rpc.send_mq_request(
-                "game_host_{0}".format(host.host_id),
-                "deploy_delivery", 600, game_name, game_version, deployment_id, deployment_hash)
-        except Exception as e:
-            await deployments.update_deployment_delivery_status(
-                self.gamespace, delivery_id, DeploymentDeliveryAdapter.STATUS_ERROR, "Cannot deliver")
-            logging.exception("Cannot deliver")
-            raise DeploymentDeliveryError(str(e))
-
-        if result:
-            await deployments.update_deployment_delivery_status(
-                self.gamespace, delivery_id, DeploymentDeliveryAdapter.STATUS_DELIVERED)
-        else:
-            await deployments.update_deployment_delivery_status(
-                self.gamespace, delivery_id, DeploymentDeliveryAdapter.STATUS_ERROR, "Cannot deliver")
-
-            raise DeploymentDeliveryError("Cannot deliver")
-
-    async def __deliver_upload__(self, game_name, game_version, deployment_id, deliver_list, deployment_hash):
-        deployments = self.application.deployments
-
-        tasks = [
-            self.__deliver_host__(game_name, game_version, deployment_id, delivery_id, host, deployment_hash)
-            for delivery_id, host in deliver_list
-        ]
-
-        try:
-            await multi(tasks)
-        except Exception as e:
-            logging.error("Error deliver deployment {0}: {1}".format(
-                deployment_id, str(e)
-            ))
-            await deployments.update_deployment_status(
-                self.gamespace, deployment_id, DeploymentAdapter.STATUS_ERROR)
-            return False
-        else:
-            await deployments.update_deployment_status(
-                self.gamespace, deployment_id, DeploymentAdapter.STATUS_DELIVERED)
-            return True
-
-    async def __deliver_clean_host__(self, game_name, game_version, deployment_id, delivery_id, host):
-        deployments = self.application.deployments
-
-        await deployments.update_deployment_delivery_status(
-            self.gamespace, delivery_id, DeploymentDeliveryAdapter.STATUS_DELETING)
-
-        deployments = self.application.deployments
-        rpc = self.application.rpc.acquire_rpc("admin")
-
-        try:
-            result = await rpc.send_mq_request(
-                "game_host_{0}".format(host.host_id),
-                "delete_delivery", JSONRPC_TIMEOUT, game_name, game_version, deployment_id)
-        except Exception as e:
-            await deployments.update_deployment_delivery_status(
-                self.gamespace, delivery_id, DeploymentDeliveryAdapter.STATUS_ERROR, str(e))
-            raise DeploymentDeliveryError(str(e))
-
-        if result:
-            await deployments.update_deployment_delivery_status(
-                self.gamespace, delivery_id, DeploymentDeliveryAdapter.STATUS_DELETED)
-        else:
-            await deployments.update_deployment_delivery_status(
-                self.gamespace, deployment_id, DeploymentDeliveryAdapter.STATUS_ERROR)
-
-    async def __deliver__(self, game_name, game_version, deployment_id, deployment_hash, wait_for_deliver=False):
-        hosts = self.application.hosts
-        deployments = self.application.deployments
-
-        try:
-            hosts_list = list(await hosts.list_enabled_hosts())
-        except HostError as e:
-            raise a.ActionError("Failed to list hosts: " + str(e))
-
-        try:
-            deliveries = list(await deployments.list_deployment_deliveries(self.gamespace, deployment_id))
-        except DeploymentDeliveryError as e:
-            raise a.ActionError("Failed to list deliveries: " + str(e))
-
-        deliver_list = []
-        delivery_ids = {item.host_id: item for item in deliveries}
-        host_ids = {item.host_id: item for item in hosts_list}
-
-        for host in hosts_list:
-            if host.host_id not in delivery_ids:
-                new_delivery_id = await deployments.new_deployment_delivery(
-                    self.gamespace, deployment_id, host.host_id)
-                deliver_list.append((new_delivery_id, host))
-
-        for delivery in deliveries:
-            if delivery.status == DeploymentDeliveryAdapter.STATUS_ERROR:
-                deliver_list.append((delivery.delivery_id, host_ids[delivery.host_id]))
-
-        if not deliver_list:
-            raise a.ActionError("Nothing to deliver")
-
-        try:
-            await deployments.update_deployment_status(
-                self.gamespace, deployment_id, DeploymentAdapter.STATUS_DELIVERING)
-        except DeploymentError as e:
-            raise a.ActionError("Failed to update deployment status: " + str(e))
-
-        try:
-            await deployments.update_deployment_deliveries_status(
-                self.gamespace, [
-                    delivery_id
-                    for delivery_id, host in deliver_list
-                ], DeploymentDeliveryAdapter.STATUS_DELIVERING)
-        except DeploymentDeliveryError as e:
-            await deployments.update_deployment_status(
-                self.gamespace, deployment_id, DeploymentAdapter.STATUS_ERROR)
-            raise a.ActionError("Failed to update deployment deliveries status: " + str(e))
-
-        if wait_for_deliver:
-            result = await self.__deliver_upload__(
-                game_name, game_version, deployment_id, deliver_list, deployment_hash)
-            return result
-        else:
-            IOLoop.current().spawn_callback(
-                self.__deliver_upload__, game_name, game_version, deployment_id, deliver_list, deployment_hash)
-
-    async def __clean__(self, deployment, deliver_list=None):
-        deployments = self.application.deployments
-
-        try:
-            await deployments.update_deployment_status(
-                self.gamespace, deployment.deployment_id, DeploymentAdapter.STATUS_DELETING)
-        except DeploymentError as e:
-            raise a.ActionError("Failed to update deployment status: " + str(e))
-
-        tasks = [
-            self.__deliver_clean_host__(deployment.game_name, deployment.game_version,
-                                        deployment.deployment_id, delivery_id, host)
-            for delivery_id, host in deliver_list
-        ]
-
-        try:
-            await multi(tasks)
-        except Exception as e:
-            logging.exception("Failed to delete deployment {0}".format(deployment.deployment_id))
-            await deployments.update_deployment_status(
-                self.gamespace, deployment.deployment_id, DeploymentAdapter.STATUS_ERROR)
-            raise a.ActionError("Failed to delete deployment: " + str(e))
-
-        try:
-            await deployments.delete_deployment_file(self.gamespace, deployment)
-        except DeploymentError as e:
-            raise a.ActionError("Failed to remove deployment: " + str(e))
-        except DeploymentNotFound:
-            raise a.ActionError("No such deployment")
-
-        try:
-            await deployments.update_deployment_status(
-                self.gamespace, deployment.deployment_id, DeploymentAdapter.STATUS_DELETED)
-        except DeploymentError as e:
-            raise a.ActionError("Failed to update deployment status: " + str(e))
-
-
 class ApplicationDeploymentController(a.AdminController):
     async def get(self, game_name, game_version, deployment_id):
 
@@ -951,6 +782,9 @@ class ApplicationDeploymentController(a.AdminController):
                        app_id=self.context.get("game_name"), version_id=self.context.get("game_version"))
             ], "Deployment {0}".format(self.context.get("deployment_id"))),
 
+            a.script(self.application.module_path("static/admin/delivery_progress.js"),
+                     deployment_id=self.context.get("deployment_id")),
+
             a.form("Delivery status (refresh for update)", fields={
                 "deployment_status": a.field("Deployment Status", "status", {
                     DeploymentAdapter.STATUS_UPLOADING: "info",
@@ -1044,7 +878,10 @@ class ApplicationDeploymentController(a.AdminController):
 
         delivery = Delivery(self.application, self.gamespace)
 
-        await delivery.__deliver__(game_name, game_version, deployment_id, deployment_hash)
+        try:
+            await delivery.deliver(game_name, game_version, deployment_id, deployment_hash)
+        except DeliveryError as e:
+            raise a.ActionError(e.message)
 
         raise a.Redirect("deployment",
                          message="Deployment process started",
@@ -1053,6 +890,47 @@ class ApplicationDeploymentController(a.AdminController):
                          deployment_id=deployment_id)
 
 
+class DeliveryProgressAction(a.StreamAdminController):
+    """
+    Streams the progress of a deployment delivery to the deployment page
+    """
+
+    UPDATE_PERIOD = 1
+
+    def __init__(self, app, token, handler):
+        super().__init__(app, token, handler)
+
+        self.deployment_id = None
+        self.update_callback = None
+        self.last_progress = None
+
+    async def prepared(self, deployment_id, **ignored):
+        self.deployment_id = deployment_id
+
+    async def __update__(self):
+        progress = self.application.deployments.get_delivery_progress(self.deployment_id)
+
+        if progress is None or progress == self.last_progress:
+            return
+
+        self.last_progress = progress
+        await self.send_rpc(self, "progress", **progress)
+
+    async def on_opened(self, *args, **kwargs):
+        await self.__update__()
+
+        self.update_callback = PeriodicCallback(self.__update__, DeliveryProgressAction.UPDATE_PERIOD * 1000)
+        self.update_callback.start()
+
+    async def on_closed(self):
+        if self.update_callback:
+            self.update_callback.stop()
+            self.update_callback = None
+
+    def access_scopes(self):
+        return ["game_deploy_admin"]
+
+
 class DeployApplicationController(a.UploadAdminController):
     executor = ThreadPoolExecutor(max_workers=4)
 
@@ -1062,6 +940,7 @@ class DeployApplicationController(a.UploadAdminController):
         self.deployment_file = None
         self.deployment_path = None
         self.sha256 = None
+        self.zip_test = None
         self.auto_switch = False
 
     async def get(self, game_name, game_version):
@@ -1126,10 +1005,15 @@ class DeployApplicationController(a.UploadAdminController):
         self.deployment_path = os.path.join(location, game_name, game_version, str(self.deployment) + ".zip")
         self.deployment_file = open(self.deployment_path, "wb")
         self.sha256 = hashlib.sha256()
+        self.zip_test = ZipStreamTest()
 
     @run_on_executor
-    def test_zip(self, the_zip_file):
-        return the_zip_file.testzip()
+    def test_zip(self):
+        """
+        :returns a name of the first bad file, or None, like ZipFile.testzip does
+        """
+
+        return self.zip_test.test(self.deployment_path)
 
     async def receive_completed(self):
 
@@ -1137,10 +1021,8 @@ class DeployApplicationController(a.UploadAdminController):
 
         self.deployment_file.close()
 
-        the_zip_file = zipfile.ZipFile(self.deployment_path)
-
         try:
-            ret = await self.test_zip(the_zip_file)
+            ret = await self.test_zip()
         except Exception as e:
             try:
                 await deployments.update_deployment_status(self.gamespace, self.deployment, "corrupt")
@@ -1163,6 +1045,9 @@ class DeployApplicationController(a.UploadAdminController):
         except DeploymentError as e:
             raise a.ActionError("Failed to update hash: " + str(e))
 
+        if deployments.chunks is not None:
+            await self.__store_chunks__()
+
         try:
             await deployments.update_deployment_status(self.gamespace, self.deployment, "uploaded")
         except DeploymentError as e:
@@ -1177,14 +1062,13 @@ class DeployApplicationController(a.UploadAdminController):
 
         if self.auto_switch:
             try:
-                result = await delivery.__deliver__(
+                result = await delivery.deliver(
                     game_name, game_version, self.deployment, deployment_hash,
                     wait_for_deliver=True)
-            except a.ActionError as e:
-                if e.title == "Nothing to deliver":
-                    nothing_to_deliver = True
-                else:
-                    raise e
+            except NothingToDeliver:
+                nothing_to_deliver = True
+            except DeliveryError as e:
+                raise a.ActionError(e.message)
             else:
                 if not result:
                     raise a.Redirect(
@@ -1196,7 +1080,10 @@ class DeployApplicationController(a.UploadAdminController):
             await deployments.update_game_version_deployment(
                 self.gamespace, game_name, game_version, self.deployment, True)
         else:
-            await delivery.__deliver__(game_name, game_version, self.deployment, deployment_hash)
+            try:
+                await delivery.deliver(game_name, game_version, self.deployment, deployment_hash)
+            except DeliveryError as e:
+                raise a.ActionError(e.message)
 
         message = "Game server has been deployed and switched"
         if nothing_to_deliver:
@@ -1209,10 +1096,35 @@ class DeployApplicationController(a.UploadAdminController):
             app_id=game_name,
             version_id=game_version)
 
+    async def __store_chunks__(self):
+        deployments = self.application.deployments
+
+        try:
+            deployment = await deployments.get_deployment(self.gamespace, self.deployment)
+            manifest = await deployments.store_deployment_chunks(deployment)
+        except (DeploymentError, DeploymentNotFound):
+            # the hosts will download the whole file then
+            logging.exception("Failed to store chunks of deployment {0}".format(self.deployment))
+            return
+
+        logging.info("Deployment {0}: {1} of {2} bytes are new ({3} of {4} chunks)".format(
+            self.deployment, manifest["new_size"], manifest["size"],
+            manifest["new_chunks"], len(manifest["chunks"])))
+
+        self.application.monitor_action(
+            "deployment_chunks",
+            values={
+                "size": float(manifest["size"]),
+                "new_size": float(manifest["new_size"]),
+                "chunks": float(len(manifest["chunks"])),
+                "new_chunks": float(manifest["new_chunks"])
+            })
+
     @run_on_executor
     def receive_data(self, chunk):
         self.deployment_file.write(chunk)
         self.sha256.update(chunk)
+        self.zip_test.feed(chunk)
 
     def render(self, data):
         return [
@@ -1393,6 +1305,7 @@ class RootAdminController(a.AdminController):
                 a.link("find_active_ban", "Find A Ban", icon="search"),
                 a.link("new_ban", "Issue A Ban", icon="plus"),
                 a.link("mass_ban", "Issue Multiple Bans", icon="plus-square"),
+                a.link("range_bans", "Network Bans", icon="sitemap"),
             ]),
             a.links("Navigate", [
                 a.link("/environment/apps", "Manage apps", icon="link text-danger"),
@@ -1611,11 +1524,95 @@ class IssueMultipleBansController(a.AdminController):
     def render(self, data):
         return [
             a.breadcrumbs([], "Issue Multiple Bans"),
+            a.script(self.application.module_path("static/admin/mass_ban.js"),
+                     expires=data["expires"]),
+            a.links("Navigate", [
+                a.link("index", "Go back", icon="chevron-left")
+            ])
+        ]
+
+    def access_scopes(self):
+        return ["game_admin"]
+
+
+class MassBanAction(a.StreamAdminController):
+    """
+    Issues the bans of IssueMultipleBansController, reporting the progress back as they go
+    """
+
+    async def __progress__(self, done, total):
+        await self.send_rpc(self, "progress", done=done, total=total)
+
+    async def command_received(self, context, method, **kwargs):
+        if method != "issue":
+            raise JsonRPCError(404, "No such method: " + method)
+
+        bans = self.application.bans
+
+        try:
+            result = await bans.new_bans(
+                self.gamespace, kwargs.get("accounts"), kwargs.get("expires"), kwargs.get("reason"),
+                progress=self.__progress__)
+        except ValidationError as e:
+            raise JsonRPCError(400, e.message)
+
+        summary = {}
+
+        for account, status in result.items():
+            summary.setdefault(status, []).append(account)
+
+        return summary
 
-            a.form("New bans", fields={
-                "account_ids": a.field(
-                    "Account IDs (sepatated with spaces, commas, or with newlines)",
-                    "text", "primary", "number", order=0, multiline=10),
+    def access_scopes(self):
+        return ["game_admin"]
+
+
+class RangeBansController(a.AdminController):
+    async def get(self):
+        bans = self.application.bans
+
+        try:
+            range_bans = await bans.list_range_bans(self.gamespace)
+        except BanError as e:
+            raise a.ActionError(str(e))
+
+        return {
+            "range_bans": range_bans,
+            "expires": str(datetime.datetime.now() + datetime.timedelta(days=7))
+        }
+
+    def render(self, data):
+        return [
+            a.breadcrumbs([], "Network Bans"),
+            a.content("Network Bans", headers=[
+                {
+                    "id": "network",
+                    "title": "Network"
+                }, {
+                    "id": "reason",
+                    "title": "Reason"
+                }, {
+                    "id": "expires",
+                    "title": "Expires"
+                }, {
+                    "id": "actions",
+                    "title": "Actions"
+                }
+            ], items=[
+                {
+                    "network": item.network,
+                    "reason": item.reason,
+                    "expires": str(item.expires),
+                    "actions": [
+                        a.button("range_bans", "Delete", "danger", _method="delete", range_id=item.range_id)
+                    ]
+                }
+                for item in data["range_bans"]
+            ], style="primary", empty="There is no network bans"),
+            a.form("Ban a network", fields={
+                "network": a.field(
+                    "Network (like 192.168.0.0/16 or 2001:db8::/32)",
+                    "text", "primary", "non-empty", order=0),
                 "reason": a.field(
                     "Reason",
                     "text", "primary", "non-empty", order=1),
@@ -1633,23 +1630,29 @@ class IssueMultipleBansController(a.AdminController):
     def access_scopes(self):
         return ["game_admin"]
 
-    async def create(self, account_ids, expires, reason):
-
+    async def create(self, network, expires, reason, **ignored):
         bans = self.application.bans
 
-        accounts = re.findall('\d+', account_ids, re.MULTILINE)
+        try:
+            await bans.new_range_ban(self.gamespace, network, expires, reason)
+        except BanError as e:
+            raise a.ActionError(str(e))
+
+        raise a.Redirect(
+            "range_bans",
+            message="Network has been banned")
+
+    async def delete(self, range_id, **ignored):
+        bans = self.application.bans
 
         try:
-            for account in accounts:
-                await bans.new_ban(self.gamespace, account, expires, reason)
-        except UserAlreadyBanned:
-            raise a.ActionError("User already banned")
+            await bans.delete_range_ban(self.gamespace, range_id)
         except BanError as e:
             raise a.ActionError(str(e))
 
         raise a.Redirect(
-            "mass_ban",
-            message="Bans have been issued")
+            "range_bans",
+            message="Network ban has been deleted")
 
 
 class BanController(a.AdminController):
@@ -1857,12 +1860,12 @@ class RegionController(a.AdminController):
         except socket.gaierror:
             raise a.ActionError("Failed to lookup hostname")
 
-        geo = geolite2.lookup(external_ip)
+        location = self.application.geo.get_location(external_ip)
 
-        if geo is None:
+        if location is None:
             raise a.ActionError("Failed to lookup IP address ({0})".format(external_ip))
 
-        p_lat, p_long = geo.location
+        p_lat, p_long = location
 
         hosts = self.application.hosts
 
@@ -2043,13 +2046,23 @@ class SpawnRoomController(a.AdminController):
             raise a.ActionError("Host not found")
 
         try:
-            host = await hosts.get_best_host(region.region_id)
+            delivered = await self.application.deployments.get_delivered_hosts(self.gamespace, deployment_id)
+        except DeploymentDeliveryError as e:
+            raise a.ActionError("Failed to list deliveries: " + e.message)
+
+        try:
+            host = await hosts.get_best_host(region.region_id, game_settings, delivered)
         except HostNotFound:
             raise a.ActionError("Not enough hosts")
 
-        room_id = await rooms.create_room(
-            self.gamespace, game_name, game_version,
-            gs, room_settings, host, deployment_id, max_players=max_players)
+        try:
+            room_id = await rooms.create_room(
+                self.gamespace, game_name, game_version,
+                gs, room_settings, host, deployment_id, max_players=max_players)
+        except Exception:
+            # the server is not going to be spawned, so the spawn accounted on the host is over
+            hosts.spawn_finished(host.host_id, False)
+            raise
 
         logging.info("Created a room: '{0}'".format(room_id))
 
@@ -1,5 +1,5 @@
 
-from tornado.web import HTTPError
+from tornado.web import HTTPError, stream_request_body
 from tornado.ioloop import PeriodicCallback
 
 from anthill.common.access import scoped, internal, AccessToken, remote_ip
@@ -8,6 +8,7 @@ from anthill.common.validate import ValidationError
 from anthill.common.internal import InternalError
 from anthill.common.jsonrpc import JsonRPCError, JsonRPCTimeout, JSONRPC_TIMEOUT
 from anthill.common.server import Server
+from anthill.common.environment import EnvironmentClient, AppNotFound
 from anthill.common import to_int
 
 from . model.host import RegionNotFound, HostNotFound, HostError, RegionError
@@ -16,13 +17,14 @@ from . model.player import Player, PlayersGroup, RoomNotFound, PlayerError, Room
 from . model.gameserver import GameServerNotFound
 from . model.party import PartySession, PartyError, NoSuchParty, PartyFlags
 from . model.ban import UserAlreadyBanned, BanError, NoSuchBan
-from . model.deploy import DeploymentError, DeploymentNotFound
+from . model.deploy import DeploymentError, DeploymentNotFound, DeploymentAdapter, NoCurrentDeployment
+from . model.upload import DeploymentUploadsModel, UploadError, UploadNotFound
+from . model.distribution import Delivery, DeliveryError, NothingToDeliver
 
 import logging
 import ujson
 import traceback
 
-from geoip import geolite2
 
 
 class InternalHandler(object):
@@ -44,6 +46,25 @@ class InternalHandler(object):
         except HostError as e:
             raise InternalError(500, str(e))
 
+    async def rank_regions(self, ips):
+        """
+        Ranks the regions by the distance for each of the IP addresses
+        :returns a dict of ip -> list of region names, the closest first
+        """
+
+        if not isinstance(ips, list):
+            raise InternalError(400, "ips is expected to be a list")
+
+        try:
+            ranks = await self.application.geo.rank_regions(ips)
+        except RegionError as e:
+            raise InternalError(500, e.message)
+
+        return {
+            ip: [region.name for region in regions]
+            for ip, regions in ranks.items()
+        }
+
     async def issue_ban(self, gamespace, account, reason, expires):
         bans = self.application.bans
 
@@ -60,6 +81,47 @@ class InternalHandler(object):
             "id": ban_id
         }
 
+    async def issue_bans(self, gamespace, accounts, reason, expires):
+        bans = self.application.bans
+
+        try:
+            result = await bans.new_bans(gamespace, accounts, expires, reason)
+        except ValidationError as e:
+            raise InternalError(400, e.message)
+
+        return {
+            "accounts": {
+                str(account): status
+                for account, status in result.items()
+            }
+        }
+
+    async def issue_range_ban(self, gamespace, network, reason, expires):
+        bans = self.application.bans
+
+        try:
+            range_id = await bans.new_range_ban(gamespace, network, expires, reason)
+        except ValidationError as e:
+            raise InternalError(400, e.message)
+        except BanError as e:
+            raise InternalError(500, e.message)
+
+        return {
+            "id": range_id
+        }
+
+    async def delete_range_ban(self, gamespace, range_id):
+        bans = self.application.bans
+
+        try:
+            await bans.delete_range_ban(gamespace, range_id)
+        except ValidationError as e:
+            raise InternalError(400, e.message)
+        except BanError as e:
+            raise InternalError(409, e.message)
+
+        return "OK"
+
     async def get_ban(self, gamespace, ban_id):
         bans = self.application.bans
 
@@ -400,19 +462,12 @@ class RoomsHandler(AuthenticatedHandler):
             if ip is None:
                 raise HTTPError(400, "Bad IP")
 
-            geo = geolite2.lookup(ip)
-
-            if geo:
-                p_lat, p_long = geo.location
+            closest_regions = await self.application.geo.list_closest_regions(ip)
 
+            if closest_regions:
                 if lock_my_region:
-                    try:
-                        region_lock = await hosts.get_closest_region(p_long, p_lat)
-                    except RegionNotFound:
-                        pass
-
-                if not region_lock:
-                    closest_regions = await hosts.list_closest_regions(p_long, p_lat)
+                    region_lock = closest_regions[0]
+                else:
                     ordered_regions = [region.region_id for region in closest_regions]
             else:
                 ordered_regions = None
@@ -450,17 +505,7 @@ class RegionsHandler(AuthenticatedHandler):
         if ip is None:
             raise HTTPError(400, "Bad IP")
 
-        geo = geolite2.lookup(ip)
-
-        my_region = None
-
-        if geo:
-            p_lat, p_long = geo.location
-
-            try:
-                my_region = await hosts.get_closest_region(p_long, p_lat)
-            except RegionNotFound:
-                pass
+        my_region = await self.application.geo.get_closest_region(ip)
 
         if not my_region:
             try:
@@ -702,15 +747,7 @@ class CreatePartySimpleHandler(AuthenticatedHandler):
             if ip is None:
                 raise HTTPError(400, "Bad IP")
 
-            geo = geolite2.lookup(ip)
-
-            if geo:
-                p_lat, p_long = geo.location
-
-                try:
-                    my_region = await hosts.get_closest_region(p_long, p_lat)
-                except RegionNotFound:
-                    pass
+            my_region = await self.application.geo.get_closest_region(ip)
 
         if not my_region:
             try:
@@ -802,15 +839,7 @@ class CreatePartySessionHandler(PartyHandler):
             if ip is None:
                 raise HTTPError(3400, "Bad IP")
 
-            geo = geolite2.lookup(ip)
-
-            if geo:
-                p_lat, p_long = geo.location
-
-                try:
-                    my_region = await hosts.get_closest_region(p_long, p_lat)
-                except RegionNotFound:
-                    pass
+            my_region = await self.application.geo.get_closest_region(ip)
 
         if not my_region:
             try:
@@ -905,15 +934,7 @@ class PartiesSearchHandler(PartyHandler):
             if ip is None:
                 raise HTTPError(3400, "Bad IP")
 
-            geo = geolite2.lookup(ip)
-
-            if geo:
-                p_lat, p_long = geo.location
-
-                try:
-                    my_region = await hosts.get_closest_region(p_long, p_lat)
-                except RegionNotFound:
-                    pass
+            my_region = await self.application.geo.get_closest_region(ip)
 
         if not my_region:
             try:
@@ -1121,9 +1142,17 @@ class FindBanHandler(AuthenticatedHandler):
         bans = self.application.bans
 
         gamespace = self.token.get(AccessToken.GAMESPACE)
+        ip = self.get_argument("ip", None)
 
         try:
-            ban = await bans.get_active_ban_by_account(gamespace, account_id)
+            if ip:
+                # the account, the ip itself, or the network it belongs to
+                ban = await bans.find_active_ban(gamespace, account_id, ip)
+
+                if ban is None:
+                    raise NoSuchBan()
+            else:
+                ban = await bans.get_active_ban_by_account(gamespace, account_id)
         except ValidationError as e:
             raise HTTPError(400, e.message)
         except BanError as e:
@@ -1137,6 +1166,65 @@ class FindBanHandler(AuthenticatedHandler):
 
 
 class HostDeploymentHandler(AuthenticatedHandler):
+    """
+    Serves the deployment file to the host controllers.
+
+    The ETag is the hash of the deployment, so a host that already has the file gets 304, and a host which download
+        has been broken can ask for the rest of it only, with "Range: bytes=<received>-" (and "If-Range: <etag>",
+        to make sure the file it has the beginning of is still the same).
+    """
+
+    @staticmethod
+    def __parse_range__(header, size):
+        """
+        Parses a single range of a Range header
+        :returns a (start, end) tuple with exclusive end, None if the header could not be parsed (so the whole file
+            is sent), or False if the range is not satisfiable
+        """
+
+        if not header or not header.startswith("bytes="):
+            return None
+
+        spec = header[len("bytes="):].strip()
+
+        # multiple ranges are not supported, the whole file is sent instead
+        if "," in spec or "-" not in spec:
+            return None
+
+        first, last = spec.split("-", 1)
+
+        try:
+            if first:
+                start = int(first)
+                end = int(last) + 1 if last else size
+            else:
+                # a suffix range, the last N bytes
+                start = max(size - int(last), 0)
+                end = size
+        except ValueError:
+            return None
+
+        # a range that ends before it starts is invalid, and is ignored
+        if end <= start and last and first:
+            return None
+
+        end = min(end, size)
+
+        if start >= end:
+            return False
+
+        return start, end
+
+    @staticmethod
+    def __etag_matches__(header, etag):
+        if not header:
+            return False
+
+        if header.strip() == "*":
+            return True
+
+        return etag in (tag.strip() for tag in header.split(","))
+
     @scoped(scopes=["game_host"])
     async def get(self, game_name, game_version, deployment_id):
         deployments = self.application.deployments
@@ -1153,21 +1241,383 @@ class HostDeploymentHandler(AuthenticatedHandler):
             # that deployment belongs to different game/version
             raise HTTPError(404, "No such deployment")
 
-        def write_callback(data, flushed):
+        etag = '"{0}"'.format(deployment.hash) if deployment.hash else None
+
+        if etag:
+            self.set_header("ETag", etag)
+
+            if HostDeploymentHandler.__etag_matches__(self.request.headers.get("If-None-Match"), etag):
+                self.set_status(304)
+                return
+
+        try:
+            deployment_file = await deployments.open_deployment_file(deployment)
+        except DeploymentError as e:
+            raise HTTPError(404, e.message)
+
+        async def write_callback(data):
             self.write(data)
-            self.flush(callback=flushed)
+            await self.flush()
+
+        try:
+            size = deployment_file.size
+            request_range = HostDeploymentHandler.__parse_range__(self.request.headers.get("Range"), size)
+
+            if request_range is not None:
+                if_range = self.request.headers.get("If-Range")
+
+                # the file has changed since the part the host has was downloaded, so it gets the whole new one
+                if if_range is not None and (etag is None or if_range.strip() != etag):
+                    request_range = None
+
+            self.set_header("Content-Type", "application/zip")
+            self.set_header("Accept-Ranges", "bytes")
+
+            if request_range is False:
+                self.set_header("Content-Range", "bytes */{0}".format(size))
+                self.set_status(416)
+                return
+
+            if request_range is None:
+                start, end = 0, size
+            else:
+                start, end = request_range
+                self.set_status(206)
+                self.set_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end - 1, size))
+
+            self.set_header("Content-Length", str(end - start))
+
+            await deployments.download_deployment_file(deployment_file, write_callback, start=start, end=end)
+        finally:
+            deployment_file.close()
+
+
+class HostDeploymentManifestHandler(AuthenticatedHandler):
+    @scoped(scopes=["game_host"])
+    async def get(self, game_name, game_version, deployment_id):
+        deployments = self.application.deployments
+        gamespace = self.token.get(AccessToken.GAMESPACE)
+
+        try:
+            deployment = await deployments.get_deployment(gamespace, deployment_id)
+        except DeploymentNotFound:
+            raise HTTPError(404, "No such deployment")
+        except DeploymentError as e:
+            raise HTTPError(500, e.message)
+
+        if deployment.game_name != game_name or deployment.game_version != game_version:
+            # that deployment belongs to different game/version
+            raise HTTPError(404, "No such deployment")
+
+        try:
+            manifest = await deployments.get_deployment_manifest(deployment)
+        except DeploymentError as e:
+            raise HTTPError(500, e.message)
+
+        if manifest is None:
+            raise HTTPError(404, "Deployment has no manifest")
+
+        self.dumps({
+            "hash": deployment.hash,
+            "size": manifest["size"],
+            "chunks": manifest["chunks"]
+        })
+
+
+class HostDeploymentChunkHandler(AuthenticatedHandler):
+    """
+    Serves a chunk of the chunk store. As the chunks are named after their contents, they never change.
+    """
+
+    @scoped(scopes=["game_host"])
+    async def get(self, chunk_id):
+        deployments = self.application.deployments
+
+        etag = '"{0}"'.format(chunk_id)
+        self.set_header("ETag", etag)
+
+        if self.request.headers.get("If-None-Match") == etag:
+            self.set_status(304)
+            return
+
+        try:
+            chunk_file = await deployments.open_chunk(chunk_id)
+        except DeploymentError as e:
+            raise HTTPError(404, e.message)
+
+        async def write_callback(data):
+            self.write(data)
+            await self.flush()
+
+        try:
+            self.set_header("Content-Type", "application/octet-stream")
+            self.set_header("Content-Length", str(chunk_file.size))
 
-        await deployments.download_deployment_file(deployment, write_callback)
+            await deployments.download_deployment_file(chunk_file, write_callback)
+        finally:
+            chunk_file.close()
+
+
+class DeploymentUploadHandler(AuthenticatedHandler):
+    """
+    Starts a multi-part upload of a deployment, see DeploymentUploadsModel. The parts are then uploaded with
+        DeploymentUploadPartHandler (in any order, and at the same time), and the upload is completed with
+        DeploymentUploadCompleteHandler.
+    """
+
+    @scoped(scopes=["game_deploy_admin"])
+    async def post(self, game_name, game_version):
+        uploads = self.application.uploads
+        gamespace = self.token.get(AccessToken.GAMESPACE)
+
+        size = self.get_argument("size")
+        part_size = self.get_argument("part_size", 0)
+
+        environment_client = EnvironmentClient(self.application.cache)
+
+        try:
+            app = await environment_client.get_app_info(game_name)
+        except AppNotFound:
+            raise HTTPError(404, "App was not found")
+
+        if game_version not in app.versions:
+            raise HTTPError(404, "No such app version")
+
+        try:
+            upload = await uploads.new_upload(gamespace, game_name, game_version, size, part_size)
+        except ValidationError as e:
+            raise HTTPError(400, e.message)
+        except UploadError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps(upload.dump(received=[]))
+
+
+class DeploymentUploadBaseHandler(AuthenticatedHandler):
+    async def get_deployment(self, gamespace, game_name, game_version, deployment_id):
+        try:
+            deployment = await self.application.deployments.get_deployment(gamespace, deployment_id)
+        except DeploymentNotFound:
+            raise HTTPError(404, "No such upload")
+        except ValidationError as e:
+            raise HTTPError(400, e.message)
+        except DeploymentError as e:
+            raise HTTPError(500, e.message)
+
+        if deployment.game_name != game_name or deployment.game_version != game_version:
+            # that deployment belongs to different game/version
+            raise HTTPError(404, "No such upload")
+
+        return deployment
+
+    async def get_upload(self, gamespace, game_name, game_version, deployment_id):
+        """
+        :returns a pair of (DeploymentAdapter, UploadAdapter)
+        """
+
+        deployment = await self.get_deployment(gamespace, game_name, game_version, deployment_id)
+
+        try:
+            upload = await self.application.uploads.get_upload(gamespace, deployment_id)
+        except UploadNotFound:
+            raise HTTPError(404, "No such upload")
+        except ValidationError as e:
+            raise HTTPError(400, e.message)
+        except UploadError as e:
+            raise HTTPError(e.code, e.message)
+
+        return deployment, upload
+
+
+class DeploymentUploadStatusHandler(DeploymentUploadBaseHandler):
+    """
+    Tells which parts of the upload have been received, so a broken upload can be resumed.
+        Once the upload is completed, tells how the delivery goes instead: the status of the deployment,
+        the progress of the delivery (see DeliveryProgress.dump), and whether it's the current deployment
+        of the game version already.
+    """
+
+    @scoped(scopes=["game_deploy_admin"])
+    async def get(self, game_name, game_version, deployment_id):
+        gamespace = self.token.get(AccessToken.GAMESPACE)
+        deployments = self.application.deployments
+
+        deployment = await self.get_deployment(gamespace, game_name, game_version, deployment_id)
+
+        if deployment.status == DeploymentAdapter.STATUS_UPLOADING:
+            deployment, upload = await self.get_upload(gamespace, game_name, game_version, deployment_id)
+
+            try:
+                received = await self.application.uploads.list_received_parts(gamespace, deployment_id)
+            except UploadError as e:
+                raise HTTPError(e.code, e.message)
+
+            self.dumps(upload.dump(received=received.keys()))
+            return
+
+        try:
+            current = await deployments.get_current_deployment(gamespace, game_name, game_version)
+        except NoCurrentDeployment:
+            current = None
+        except DeploymentError as e:
+            raise HTTPError(500, e.message)
+
+        self.dumps({
+            "deployment_id": deployment.deployment_id,
+            "status": deployment.status,
+            "delivery": deployments.get_delivery_progress(deployment.deployment_id),
+            "current": current is not None and current.deployment_id == deployment.deployment_id
+        })
+
+
+@stream_request_body
+class DeploymentUploadPartHandler(DeploymentUploadBaseHandler):
+    """
+    Uploads a part of the deployment file, as the request body. The body is written into its place as it arrives,
+        so no more than DeploymentUploadsModel.WRITE_CHUNK of it is kept in memory. The optional "hash" argument
+        is the sha256 of the part, to be checked upon arrival.
+    """
+
+    def __init__(self, application, request, **kwargs):
+        super().__init__(application, request, **kwargs)
+
+        self.deployment = None
+        self.part = None
+        self.error = None
+
+    async def prepare(self):
+        self.request.connection.set_max_body_size(DeploymentUploadsModel.MAX_PART_SIZE)
+        await super().prepare()
+
+    @scoped(scopes=["game_deploy_admin"])
+    async def prepared(self, game_name, game_version, deployment_id, part_number):
+        gamespace = self.token.get(AccessToken.GAMESPACE)
+
+        self.deployment, upload = await self.get_upload(gamespace, game_name, game_version, deployment_id)
+
+        try:
+            self.part = await self.application.uploads.start_part(
+                gamespace, self.deployment, upload, int(part_number))
+        except UploadError as e:
+            raise HTTPError(e.code, e.message)
+
+    async def data_received(self, chunk):
+        if self.part is None or self.error is not None:
+            return
+
+        try:
+            await self.application.uploads.write_part(self.part, chunk)
+        except UploadError as e:
+            # the rest of the body is ignored, and the error is responded with once it's over
+            self.error = e
+
+    def __close_part__(self):
+        if self.part is not None:
+            self.application.uploads.close_part(self.part)
+
+    def on_connection_close(self):
+        self.__close_part__()
+
+    def on_finish(self):
+        self.__close_part__()
+
+    @scoped(scopes=["game_deploy_admin"])
+    async def put(self, game_name, game_version, deployment_id, part_number):
+        gamespace = self.token.get(AccessToken.GAMESPACE)
+
+        if self.error is not None:
+            raise HTTPError(self.error.code, self.error.message)
+
+        try:
+            part_hash = await self.application.uploads.finish_part(
+                gamespace, self.deployment, self.part, part_hash=self.get_argument("hash", None))
+        except UploadError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps({
+            "hash": part_hash
+        })
+
+
+class DeploymentUploadCompleteHandler(DeploymentUploadBaseHandler):
+    """
+    Completes the upload once all of the parts are there, and starts delivering the deployment to the hosts,
+        the same way the admin does with the deployment uploaded there. The "hash" argument is the sha256 of
+        the whole file. With "switch" set to "true", the deployment becomes the current one for the game version
+        once it's delivered to every host.
+    The request does not wait for the delivery, it goes on in the background, and can be followed with
+        DeploymentUploadStatusHandler.
+    """
+
+    @scoped(scopes=["game_deploy_admin"])
+    async def post(self, game_name, game_version, deployment_id):
+        gamespace = self.token.get(AccessToken.GAMESPACE)
+        switch = self.get_argument("switch", "false") == "true"
+
+        deployment, upload = await self.get_upload(gamespace, game_name, game_version, deployment_id)
+
+        try:
+            deployment_hash = await self.application.uploads.complete_upload(
+                gamespace, deployment, upload, self.get_argument("hash"))
+        except UploadError as e:
+            raise HTTPError(e.code, e.message)
+
+        delivery = Delivery(self.application, gamespace)
+
+        try:
+            await delivery.deliver(
+                game_name, game_version, upload.deployment_id, deployment_hash, switch=switch)
+        except NothingToDeliver:
+            # every host has it already, so there's nothing to wait for
+            if switch:
+                try:
+                    await self.application.deployments.update_game_version_deployment(
+                        gamespace, game_name, game_version, upload.deployment_id, True)
+                except DeploymentError as e:
+                    raise HTTPError(500, str(e))
+        except DeliveryError as e:
+            raise HTTPError(500, e.message)
+
+        self.dumps({
+            "deployment_id": upload.deployment_id,
+            "hash": deployment_hash,
+            "switch": switch
+        })
 
 
 class HeartbeatReport(object):
+    """
+    The controller reports either a full list of the rooms it runs:
+        {"load": {...}, "rooms": [1, 2, 3]}
+    or the changes since the previous report:
+        {"load": {...}, "rooms_delta": {"added": [4], "removed": [1]}}
+
+    The load may also contain the amount of free ports the host has left, as "ports".
+
+    A controller that reports the changes is asked for a full list with a "full": true argument of the
+        heartbeat request once in a while.
+    """
+
     def __init__(self, data):
         load = data.get("load", {})
 
         self.memory = to_int(load.get("memory", 999))
         self.cpu = to_int(load.get("cpu", 999))
         self.storage = to_int(load.get("storage", 99))
-        self.rooms = data.get("rooms", [])
+
+        ports = load.get("ports")
+        self.ports = to_int(ports) if ports is not None else None
+
+        delta = data.get("rooms_delta")
+
+        if isinstance(delta, dict):
+            self.rooms = None
+            self.rooms_added = set(map(str, delta.get("added", [])))
+            self.rooms_removed = set(map(str, delta.get("removed", [])))
+        else:
+            self.rooms = set(map(str, data.get("rooms", [])))
+            self.rooms_added = None
+            self.rooms_removed = None
 
 
 class HostHandler(JsonRPCWSHandler):
@@ -1180,8 +1630,18 @@ class HostHandler(JsonRPCWSHandler):
         self.rpc_listener = None
         self.pub = None
 
+        # a set of rooms the host reported last time, None if unknown yet
+        self.known_rooms = None
+        self.heartbeats_since_full_check = 0
+        # whether the host reports the rooms delta, so it has to be asked for the full list
+        self.reports_delta = False
+
     MEMORY_OVERLOAD = 95
 
+    # every that many heartbeats the rooms are checked against the database as a whole,
+    #   in case there are rooms the host never knew about (e.g. failed to spawn)
+    FULL_ROOMS_CHECK_EVERY = 10
+
     def required_scopes(self):
         return ["game_host"]
 
@@ -1216,6 +1676,9 @@ class HostHandler(JsonRPCWSHandler):
         self.pub = await Server.acquire_custom_publisher("game_host_debug_{0}".format(self.host_id))
         self.application.monitor_action("game.controller.connected", {"connected": 1}, host=self.host_address)
 
+        # before the host turns active, so it's not picked for the game versions it doesn't have yet
+        await self.application.catch_up.host_connected(self.host_id)
+
         await self._check_heartbeat()
 
     async def on_rpc_shutdown_received(self, *args, **kwargs):
@@ -1251,6 +1714,16 @@ class HostHandler(JsonRPCWSHandler):
         return await self.send_request(
             self, "deploy_delivery", 600, game_name, game_version, deployment_id, deployment_hash)
 
+    async def on_rpc_deploy_delivery_chunks_received(self, game_name, game_version, deployment_id, deployment_hash):
+        return await self.send_request(
+            self, "deploy_delivery_chunks", 600, game_name, game_version, deployment_id, deployment_hash)
+
+    async def on_rpc_deploy_delivery_peer_received(self, game_name, game_version, deployment_id, deployment_hash,
+                                                   peer_address):
+        return await self.send_request(
+            self, "deploy_delivery_peer", 600, game_name, game_version, deployment_id, deployment_hash,
+            peer_address)
+
     async def on_rpc_delete_delivery_received(self, game_name, game_version, deployment_id):
         return await self.send_request(
             self, "delete_delivery", JSONRPC_TIMEOUT, game_name, game_version, deployment_id)
@@ -1295,31 +1768,95 @@ class HostHandler(JsonRPCWSHandler):
         else:
             raise JsonRPCError(-32600, "No such method")
 
+    def __full_rooms_check_due__(self):
+        return self.known_rooms is None or self.heartbeats_since_full_check >= HostHandler.FULL_ROOMS_CHECK_EVERY
+
+    async def __heartbeat__(self):
+        """
+        :returns a HeartbeatReport, or None if the host has nothing to report
+        """
+
+        if self.reports_delta and self.__full_rooms_check_due__():
+            report_data = await self.send_request(self, "heartbeat", full=True)
+        else:
+            # the controllers that only report the full list know nothing about the argument
+            report_data = await self.send_request(self, "heartbeat")
+
+        if report_data is None:
+            return None
+
+        report = HeartbeatReport(report_data)
+
+        if report.rooms is None and not self.reports_delta:
+            self.reports_delta = True
+
+            if self.__full_rooms_check_due__():
+                # now that the host is known to report the delta, ask it for the full list right away
+                return await self.__heartbeat__()
+
+        return report
+
     # noinspection PyBroadException
     async def _check_heartbeat(self):
         try:
             # process hosts one by one
-            report_data = await self.send_request(self, "heartbeat")
+            report = await self.__heartbeat__()
         except (JsonRPCTimeout, JsonRPCError):
             await self.application.hosts.update_host_state(self.host_id, state='TIMEOUT')
             return
 
-        if report_data is None:
+        if report is None:
             await self.application.hosts.update_host_state(self.host_id, state='ERROR')
             return
 
-        report = HeartbeatReport(report_data)
-
         if report.memory > HostHandler.MEMORY_OVERLOAD:
             state = 'OVERLOAD'
         else:
             state = 'ACTIVE'
 
+        await self.__reconcile_rooms__(report)
+
         # update load in case of success
-        await self.application.hosts.update_host_load(self.host_id, report.memory, report.cpu, report.storage, state)
+        await self.application.hosts.update_host_load(
+            self.host_id, report.memory, report.cpu, report.storage, state,
+            rooms=len(self.known_rooms) if self.known_rooms is not None else None,
+            ports=report.ports)
+
+    async def __reconcile_rooms__(self, report):
+        rooms = self.application.rooms
+
+        if report.rooms is None:
+            if self.known_rooms is None:
+                # a delta is useless unless we know what it applies to, wait for a full report
+                logging.warning("Host {0} reported a rooms delta before the full list".format(self.host_id))
+                return
+
+            if self.__full_rooms_check_due__():
+                # the full list has been asked for, but the host sent a delta anyway. the delta is still right
+                #   about what is gone, but the full check has to wait until the next heartbeat
+                logging.warning("Host {0} reported a rooms delta instead of the full list".format(self.host_id))
+
+            if report.rooms_removed:
+                await rooms.remove_rooms(self.host_id, list(report.rooms_removed))
+
+            self.known_rooms = (self.known_rooms | report.rooms_added) - report.rooms_removed
+            self.heartbeats_since_full_check += 1
+            return
+
+        if self.__full_rooms_check_due__():
+            # delete rooms not listed in that list
+            await rooms.remove_host_rooms(self.host_id, except_rooms=list(report.rooms))
+            self.heartbeats_since_full_check = 0
+        else:
+            # delete only the rooms that are gone since the last time, if any
+            gone = self.known_rooms - report.rooms
+
+            if gone:
+                await rooms.remove_rooms(self.host_id, list(gone))
+
+            self.heartbeats_since_full_check += 1
 
-        # delete rooms not listed in that list
-        await self.application.rooms.remove_host_rooms(self.host_id, except_rooms=report.rooms)
+        self.known_rooms = report.rooms
 
     async def on_closed(self):
         self.application.monitor_action("game.controller.connected", {"connected": 0}, host=self.host_address)
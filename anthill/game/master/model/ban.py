@@ -1,8 +1,18 @@
 
+from tornado.ioloop import PeriodicCallback
+
 from anthill.common import database
 from anthill.common.model import Model
+from anthill.common.options import options
 from anthill.common.validate import validate
 
+from .prefix import NetworkTrie
+from collections import OrderedDict
+
+import datetime
+import heapq
+import logging
+
 
 class BanError(Exception):
     def __init__(self, message):
@@ -23,6 +33,7 @@ class NoSuchBan(Exception):
 class BanAdapter(object):
     def __init__(self, data):
         self.ban_id = str(data.get("ban_id"))
+        self.gamespace = str(data.get("ban_gamespace"))
         self.account = data.get("ban_account")
         self.ip = data.get("ban_ip")
         self.expires = data.get("ban_expires")
@@ -38,15 +49,414 @@ class BanAdapter(object):
         }
 
 
+class RangeBanAdapter(object):
+    """
+    A ban of a whole network. It can be used wherever a BanAdapter is (except it has no account),
+        with ban_id prefixed so it can never be confused with a regular one.
+    """
+
+    ID_PREFIX = "range-"
+
+    def __init__(self, data):
+        self.range_id = str(data.get("range_id"))
+        self.ban_id = RangeBanAdapter.ID_PREFIX + self.range_id
+        self.gamespace = str(data.get("range_gamespace"))
+        self.network = data.get("range_network")
+        self.account = None
+        self.ip = self.network
+        self.expires = data.get("range_expires")
+        self.reason = data.get("range_reason")
+
+    def dump(self):
+        return {
+            "id": self.ban_id,
+            "range": self.network,
+            "expires": str(self.expires),
+            "reason": str(self.reason)
+        }
+
+
+class BanIndex(object):
+    """
+    Active bans, indexed both by account and by IP, so checking a player (or a whole group of players) is a couple
+        of dict lookups. Network bans are kept in a prefix trie per gamespace, for the longest prefix match.
+        Bans leave the index as they expire, with help of a min-heap on the expiration date.
+
+    The index only learns about new bans with incremental loads (id greater than the last one seen), and about
+        changes of the existing ones from the model itself.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        # ban_id -> BanAdapter
+        self.bans = {}
+        # (gamespace, account) -> set of ban_id
+        self.accounts = {}
+        # (gamespace, ip) -> set of ban_id
+        self.ips = {}
+        # gamespace -> NetworkTrie of RangeBanAdapter
+        self.networks = {}
+        self.last_range_id = 0
+        # a heap of (expires, ban_id)
+        self.expiry = []
+        self.last_ban_id = 0
+        # how much the database clock is ahead of ours, the expiration dates are in database time
+        self.clock_skew = datetime.timedelta()
+
+    def now(self):
+        return datetime.datetime.now() + self.clock_skew
+
+    def load(self, bans, db_now):
+        self.bans = {}
+        self.accounts = {}
+        self.ips = {}
+        self.networks = {}
+        self.expiry = []
+        self.last_ban_id = 0
+        self.last_range_id = 0
+        self.clock_skew = db_now - datetime.datetime.now()
+
+        self.update(bans)
+        self.loaded = True
+
+    def update(self, bans):
+        for ban in bans:
+            self.add(ban)
+
+            if isinstance(ban, RangeBanAdapter):
+                self.last_range_id = max(self.last_range_id, int(ban.range_id))
+            else:
+                self.last_ban_id = max(self.last_ban_id, int(ban.ban_id))
+
+    @staticmethod
+    def __unlink__(index, key, ban_id):
+        ban_ids = index.get(key)
+
+        if ban_ids is None:
+            return
+
+        ban_ids.discard(ban_id)
+
+        if not ban_ids:
+            del index[key]
+
+    def add(self, ban):
+        self.remove(ban.ban_id)
+
+        if ban.expires <= self.now():
+            return
+
+        if isinstance(ban, RangeBanAdapter):
+            try:
+                self.networks.setdefault(ban.gamespace, NetworkTrie()).insert(ban.network, ban.ban_id, ban)
+            except ValueError:
+                logging.error("Malformed network {0} in range ban {1}".format(ban.network, ban.range_id))
+                return
+        else:
+            self.accounts.setdefault((ban.gamespace, str(ban.account)), set()).add(ban.ban_id)
+
+            if ban.ip:
+                self.ips.setdefault((ban.gamespace, ban.ip), set()).add(ban.ban_id)
+
+        self.bans[ban.ban_id] = ban
+        heapq.heappush(self.expiry, (ban.expires, ban.ban_id))
+
+    def remove(self, ban_id):
+        ban = self.bans.pop(str(ban_id), None)
+
+        if ban is None:
+            return
+
+        if isinstance(ban, RangeBanAdapter):
+            self.networks[ban.gamespace].remove(ban.network, ban.ban_id)
+            return
+
+        BanIndex.__unlink__(self.accounts, (ban.gamespace, str(ban.account)), ban.ban_id)
+
+        if ban.ip:
+            BanIndex.__unlink__(self.ips, (ban.gamespace, ban.ip), ban.ban_id)
+
+    def evict(self):
+        now = self.now()
+
+        while self.expiry and self.expiry[0][0] <= now:
+            expires, ban_id = heapq.heappop(self.expiry)
+            ban = self.bans.get(ban_id)
+
+            # the ban might have been prolonged since, then there's another entry in the heap for it
+            if ban is not None and ban.expires == expires:
+                self.remove(ban_id)
+
+    def __active__(self, ban_ids, now):
+        for ban_id in ban_ids:
+            ban = self.bans.get(ban_id)
+
+            if ban is not None and ban.expires > now:
+                return ban
+
+        return None
+
+    def find_by_account(self, gamespace, account):
+        return self.__active__(self.accounts.get((str(gamespace), str(account)), ()), self.now())
+
+    def find_range(self, gamespace, ip, now=None):
+        """
+        :returns the active ban of the most specific network the ip belongs to, if any
+        """
+        networks = self.networks.get(str(gamespace))
+
+        if networks is None:
+            return None
+
+        now = now or self.now()
+
+        for ban in networks.match(ip):
+            if ban.expires > now:
+                return ban
+
+        return None
+
+    def find(self, gamespace, account, ip):
+        now = self.now()
+        gamespace = str(gamespace)
+
+        return (self.__active__(self.accounts.get((gamespace, str(account)), ()), now) or
+                self.__active__(self.ips.get((gamespace, ip), ()), now) or
+                self.find_range(gamespace, ip, now))
+
+    def resolve(self, gamespace, accounts, ips):
+        """
+        :returns a pair of dicts: account -> active ban of it, and ip -> active ban of it (including the bans
+            of the networks the ip belongs to)
+        """
+        now = self.now()
+        gamespace = str(gamespace)
+
+        by_account = {}
+        by_ip = {}
+
+        for account in accounts:
+            ban = self.__active__(self.accounts.get((gamespace, str(account)), ()), now)
+            if ban is not None:
+                by_account[account] = ban
+
+        for ip in ips:
+            ban = self.__active__(self.ips.get((gamespace, ip), ()), now) or self.find_range(gamespace, ip, now)
+            if ban is not None:
+                by_ip[ip] = ban
+
+        return by_account, by_ip
+
+    def find_many(self, gamespace, accounts, ips):
+        """
+        :returns a list of active bans for any of the accounts or ips
+        """
+        now = self.now()
+        gamespace = str(gamespace)
+        found = {}
+
+        for index, keys in ((self.accounts, map(str, accounts)), (self.ips, ips)):
+            for key in keys:
+                for ban_id in index.get((gamespace, key), ()):
+                    ban = self.bans.get(ban_id)
+
+                    if ban is not None and ban.expires > now:
+                        found[ban_id] = ban
+
+        return list(found.values())
+
+
 class BansModel(Model):
-    def __init__(self, db):
+    BULK_CHUNK = 1000
+
+    BULK_BANNED = "banned"
+    BULK_UPDATED = "updated"
+    BULK_ALREADY_BANNED = "already_banned"
+    BULK_FAILED = "failed"
+
+    def __init__(self, db, bus):
         self.db = db
+        self.bus = bus
+        self.index = BanIndex()
+
+        if options.bans_index_refresh:
+            self.index_refresh_callback = PeriodicCallback(
+                self.__refresh_index__, options.bans_index_refresh * 1000)
+        else:
+            self.index_refresh_callback = None
+
+        bus.subscribe("bans", self.__on_bans_event__, self.__reload_index__)
+
+    async def started(self, application):
+        await super(BansModel, self).started(application)
+
+        if self.index_refresh_callback:
+            await self.__reload_index__()
+            self.index_refresh_callback.start()
+
+    async def stopped(self):
+        if self.index_refresh_callback:
+            self.index_refresh_callback.stop()
+        await super(BansModel, self).stopped()
+
+    async def __reload_index__(self):
+        if not self.index_refresh_callback:
+            return
+
+        try:
+            db_now = await self.db.get("SELECT NOW() AS `now`;")
+            bans = await self.db.query(
+                """
+                SELECT *
+                FROM `bans`
+                WHERE `ban_expires` > NOW();
+                """)
+            ranges = await self.db.query(
+                """
+                SELECT *
+                FROM `ban_ranges`
+                WHERE `range_expires` > NOW();
+                """)
+        except database.DatabaseError:
+            logging.exception("Failed to load bans index")
+        else:
+            self.index.load(
+                list(map(BanAdapter, bans)) + list(map(RangeBanAdapter, ranges)),
+                db_now["now"])
+
+    async def __refresh_index__(self):
+        if not self.index.loaded:
+            await self.__reload_index__()
+            return
+
+        self.index.evict()
+
+        try:
+            bans = await self.db.query(
+                """
+                SELECT *
+                FROM `bans`
+                WHERE `ban_id` > %s AND `ban_expires` > NOW();
+                """, self.index.last_ban_id)
+            ranges = await self.db.query(
+                """
+                SELECT *
+                FROM `ban_ranges`
+                WHERE `range_id` > %s AND `range_expires` > NOW();
+                """, self.index.last_range_id)
+        except database.DatabaseError:
+            logging.exception("Failed to refresh bans index")
+        else:
+            self.index.update(list(map(BanAdapter, bans)) + list(map(RangeBanAdapter, ranges)))
+
+    async def __on_bans_event__(self, event, data):
+        if not self.index.loaded:
+            return
+
+        if event == "ban_changed":
+            await self.__reindex_ban__(data["ban_id"])
+        elif event == "bans_changed":
+            await self.__refresh_index__()
+            if data["ban_ids"]:
+                await self.__reindex_bans__(data["ban_ids"])
+        elif event == "range_changed":
+            await self.__reindex_range__(data["range_id"])
+
+    async def __reindex_range__(self, range_id):
+        try:
+            ban = await self.db.get(
+                """
+                SELECT *
+                FROM `ban_ranges`
+                WHERE `range_id`=%s
+                LIMIT 1;
+                """, range_id)
+        except database.DatabaseError:
+            logging.exception("Failed to reindex range ban {0}".format(range_id))
+            return
+
+        if ban is None:
+            self.index.remove(RangeBanAdapter.ID_PREFIX + str(range_id))
+        else:
+            self.index.add(RangeBanAdapter(ban))
+
+    async def __range_changed__(self, range_id):
+        if self.index.loaded:
+            await self.__reindex_range__(range_id)
+
+        await self.bus.publish("bans", "range_changed", {
+            "range_id": str(range_id)
+        })
+
+    async def __reindex_ban__(self, ban_id):
+        try:
+            ban = await self.db.get(
+                """
+                SELECT *
+                FROM `bans`
+                WHERE `ban_id`=%s
+                LIMIT 1;
+                """, ban_id)
+        except database.DatabaseError:
+            logging.exception("Failed to reindex ban {0}".format(ban_id))
+            return
+
+        if ban is None:
+            self.index.remove(ban_id)
+        else:
+            self.index.add(BanAdapter(ban))
+
+    async def __ban_changed__(self, ban_id):
+        if self.index.loaded:
+            await self.__reindex_ban__(ban_id)
+
+        await self.bus.publish("bans", "ban_changed", {
+            "ban_id": str(ban_id)
+        })
+
+    async def __reindex_bans__(self, ban_ids):
+        try:
+            bans = await self.db.query(
+                """
+                SELECT *
+                FROM `bans`
+                WHERE `ban_id` IN %s;
+                """, ban_ids)
+        except database.DatabaseError:
+            logging.exception("Failed to reindex {0} bans".format(len(ban_ids)))
+            return
+
+        found = set()
+
+        for ban in bans:
+            adapter = BanAdapter(ban)
+            found.add(adapter.ban_id)
+            self.index.add(adapter)
+
+        for ban_id in ban_ids:
+            if str(ban_id) not in found:
+                self.index.remove(str(ban_id))
+
+    async def __bans_changed__(self, ban_ids):
+        """
+        Applies a bulk change to the index in one pass: the new bans are picked up with a single incremental
+            refresh, and the renewed ones are reloaded with a single query
+        """
+
+        if self.index.loaded:
+            await self.__refresh_index__()
+            if ban_ids:
+                await self.__reindex_bans__(ban_ids)
+
+        await self.bus.publish("bans", "bans_changed", {
+            "ban_ids": list(map(str, ban_ids))
+        })
 
     def get_setup_db(self):
         return self.db
 
     def get_setup_tables(self):
-        return ["bans"]
+        return ["bans", "ban_ranges"]
 
     @validate(gamespace="int", account="int", expires="datetime", reason="str")
     async def new_ban(self, gamespace, account, expires, reason):
@@ -64,8 +474,114 @@ class BansModel(Model):
         except database.DatabaseError as e:
             raise BanError("Failed to ban user: " + e.args[1])
         else:
+            await self.__ban_changed__(ban_id)
             return ban_id
 
+    @validate(gamespace="int", accounts="json_list_of_ints", expires="datetime", reason="str")
+    async def new_bans(self, gamespace, accounts, expires, reason, progress=None):
+        """
+        Bans many accounts at once, BULK_CHUNK accounts per query
+        :param progress: optional async callback (done, total), called after each chunk
+        :returns a dict of account -> one of the BULK_* statuses
+        """
+
+        accounts = list(OrderedDict.fromkeys(accounts))
+        total = len(accounts)
+        result = {}
+        changed = []
+
+        for offset in range(0, total, BansModel.BULK_CHUNK):
+            chunk = accounts[offset:offset + BansModel.BULK_CHUNK]
+
+            try:
+                updated = await self.__new_bans_chunk__(gamespace, chunk, expires, reason, result)
+            except database.DatabaseError as e:
+                logging.error("Failed to ban {0} accounts: {1}".format(len(chunk), e.args[1]))
+                for account in chunk:
+                    result.setdefault(account, BansModel.BULK_FAILED)
+            else:
+                changed.extend(updated)
+
+            if progress:
+                await progress(min(offset + len(chunk), total), total)
+
+        await self.__bans_changed__(changed)
+        return result
+
+    async def __new_bans_chunk__(self, gamespace, accounts, expires, reason, result):
+        """
+        :returns a list of the existing ban ids that have been renewed
+        """
+
+        async with self.db.acquire(auto_commit=False) as db:
+            try:
+                existing = await db.query(
+                    """
+                    SELECT `ban_id`, `ban_account`, `ban_expires` > NOW() AS `active`
+                    FROM `bans`
+                    WHERE `ban_gamespace`=%s AND `ban_account` IN %s
+                    FOR UPDATE;
+                    """, gamespace, accounts)
+
+                active = set()
+                # account -> the latest expired ban of it, to be renewed instead of adding one more
+                expired = {}
+
+                for ban in existing:
+                    account = ban["ban_account"]
+                    if ban["active"]:
+                        active.add(account)
+                    elif ban["ban_id"] > expired.get(account, 0):
+                        expired[account] = ban["ban_id"]
+
+                renew = [
+                    ban_id
+                    for account, ban_id in expired.items()
+                    if account not in active
+                ]
+                insert = [
+                    account
+                    for account in accounts
+                    if account not in active and account not in expired
+                ]
+
+                if renew:
+                    await db.execute(
+                        """
+                        UPDATE `bans`
+                        SET `ban_expires`=%s, `ban_reason`=%s, `ban_ip`=NULL
+                        WHERE `ban_id` IN %s;
+                        """, expires, reason, renew)
+
+                if insert:
+                    values = []
+                    for account in insert:
+                        values.extend((gamespace, account, expires, reason))
+
+                    await db.execute(
+                        """
+                        INSERT INTO `bans`
+                        (`ban_gamespace`, `ban_account`, `ban_expires`, `ban_reason`)
+                        VALUES {0};
+                        """.format(", ".join(["(%s, %s, %s, %s)"] * len(insert))), *values)
+
+            except BaseException:
+                # nothing of the chunk is applied, and the rows locked by FOR UPDATE are released right away
+                await db.rollback()
+                raise
+
+            await db.commit()
+
+        for account in accounts:
+            if account in active:
+                result[account] = BansModel.BULK_ALREADY_BANNED
+            elif account in expired:
+                result[account] = BansModel.BULK_UPDATED
+            else:
+                result[account] = BansModel.BULK_BANNED
+
+        return renew
+
     @validate(gamespace="int", ban_id="int", ban_expires="datetime", ban_reason="str")
     async def update_ban(self, gamespace, ban_id, ban_expires, ban_reason):
         try:
@@ -79,6 +595,8 @@ class BansModel(Model):
         except database.DatabaseError as e:
             raise BanError("Failed to update ban: " + e.args[1])
 
+        await self.__ban_changed__(ban_id)
+
     async def update_ban_ip(self, gamespace, ban_id, ban_ip):
         try:
             await self.db.execute(
@@ -91,6 +609,8 @@ class BansModel(Model):
         except database.DatabaseError as e:
             raise BanError("Failed to update ban: " + e.args[1])
 
+        await self.__ban_changed__(ban_id)
+
     async def get_ban(self, gamespace, ban_id):
         try:
             ban = await self.db.get(
@@ -110,6 +630,14 @@ class BansModel(Model):
         return BanAdapter(ban)
 
     async def get_active_ban_by_account(self, gamespace, account):
+        if self.index.loaded:
+            ban = self.index.find_by_account(gamespace, account)
+
+            if ban is None:
+                raise NoSuchBan()
+
+            return ban
+
         try:
             ban = await self.db.get(
                 """
@@ -173,6 +701,17 @@ class BansModel(Model):
         return ban
 
     async def find_active_ban(self, gamespace, account, account_ip):
+        if self.index.loaded:
+            return self.index.find(gamespace, account, account_ip)
+
+        ban = await self.__find_active_ban__(gamespace, account, account_ip)
+
+        if ban is None:
+            ban = await self.find_active_range_ban(gamespace, account_ip)
+
+        return ban
+
+    async def __find_active_ban__(self, gamespace, account, account_ip):
         try:
             ban = await self.db.get(
                 """
@@ -205,6 +744,12 @@ class BansModel(Model):
         if not accounts or not ips:
             raise BanError("accounts or ips is empty")
 
+        if self.index.loaded:
+            return [
+                int(ban.account)
+                for ban in self.index.find_many(gamespace, accounts, ips)
+            ]
+
         try:
             bans = await self.db.query(
                 """
@@ -212,8 +757,7 @@ class BansModel(Model):
                 FROM `bans`
                 WHERE `ban_gamespace`=%s
                     AND (`ban_account` IN %s OR `ban_ip` IN %s)
-                    AND `ban_expires` > NOW()
-                LIMIT 1;
+                    AND `ban_expires` > NOW();
                 """, gamespace, accounts, ips
             )
         except database.DatabaseError as e:
@@ -226,6 +770,52 @@ class BansModel(Model):
 
         return result
 
+    @validate(gamespace="int", accounts="json_list_of_ints", ips="json_list_of_strings")
+    async def resolve_bans(self, gamespace, accounts, ips):
+        """
+        Resolves the active bans for many accounts and ips at once
+        :param gamespace: A gamespace to check in
+        :param accounts: a list of account id's to check
+        :param ips: a list of ip addresses to check
+        :returns a pair of dicts: account -> BanAdapter, and ip -> BanAdapter (or RangeBanAdapter if the ip
+            belongs to a banned network); the ones that are not banned are not in there
+        """
+
+        if self.index.loaded:
+            return self.index.resolve(gamespace, accounts, ips)
+
+        by_account = {}
+        by_ip = {}
+
+        if accounts or ips:
+            # an empty list is replaced with (NULL), that matches nothing
+            try:
+                bans = await self.db.query(
+                    """
+                    SELECT *
+                    FROM `bans`
+                    WHERE `ban_gamespace`=%s
+                        AND (`ban_account` IN %s OR `ban_ip` IN %s)
+                        AND `ban_expires` > NOW();
+                    """, gamespace, accounts or [None], ips or [None]
+                )
+            except database.DatabaseError as e:
+                raise BanError("Failed to resolve bans: " + e.args[1])
+
+            accounts_set = set(accounts)
+            ips_set = set(ips)
+
+            for ban in map(BanAdapter, bans):
+                if ban.account in accounts_set:
+                    by_account[ban.account] = ban
+                if ban.ip in ips_set:
+                    by_ip[ban.ip] = ban
+
+        range_bans = await self.find_range_bans(gamespace, [ip for ip in ips if ip not in by_ip])
+        by_ip.update(range_bans)
+
+        return by_account, by_ip
+
     @validate(gamespace="int", ban_id="int")
     async def delete_ban(self, gamespace, ban_id):
 
@@ -238,3 +828,104 @@ class BansModel(Model):
             )
         except database.DatabaseError as e:
             raise BanError("Failed to delete a server: " + e.args[1])
+
+        await self.__ban_changed__(ban_id)
+
+    @validate(gamespace="int", network="str", expires="datetime", reason="str")
+    async def new_range_ban(self, gamespace, network, expires, reason):
+        """
+        Bans a whole network, like 192.168.0.0/16 or 2001:db8::/32
+        """
+
+        try:
+            network = NetworkTrie.parse(network)
+        except ValueError:
+            raise BanError("Malformed network: " + network)
+
+        try:
+            range_id = await self.db.insert(
+                """
+                INSERT INTO `ban_ranges`
+                (`range_gamespace`, `range_network`, `range_start`, `range_end`, `range_expires`, `range_reason`)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                """, gamespace, str(network), network.network_address.packed, network.broadcast_address.packed,
+                expires, reason
+            )
+        except database.DatabaseError as e:
+            raise BanError("Failed to ban a network: " + e.args[1])
+
+        await self.__range_changed__(range_id)
+        return range_id
+
+    @validate(gamespace="int", range_id="int")
+    async def delete_range_ban(self, gamespace, range_id):
+        try:
+            await self.db.execute(
+                """
+                DELETE FROM `ban_ranges`
+                WHERE `range_gamespace`=%s AND `range_id`=%s;
+                """, gamespace, range_id
+            )
+        except database.DatabaseError as e:
+            raise BanError("Failed to delete a network ban: " + e.args[1])
+
+        await self.__range_changed__(range_id)
+
+    async def list_range_bans(self, gamespace):
+        try:
+            bans = await self.db.query(
+                """
+                SELECT *
+                FROM `ban_ranges`
+                WHERE `range_gamespace`=%s
+                ORDER BY `range_id` DESC;
+                """, gamespace
+            )
+        except database.DatabaseError as e:
+            raise BanError("Failed to list network bans: " + e.args[1])
+
+        return list(map(RangeBanAdapter, bans))
+
+    async def find_active_range_ban(self, gamespace, ip):
+        """
+        :returns an active ban of the most specific network the ip belongs to, or None
+        """
+
+        if self.index.loaded:
+            return self.index.find_range(gamespace, ip)
+
+        try:
+            ban = await self.db.get(
+                """
+                SELECT *
+                FROM `ban_ranges`
+                WHERE `range_gamespace`=%s
+                    AND `range_start` <= INET6_ATON(%s) AND `range_end` >= INET6_ATON(%s)
+                    AND LENGTH(`range_start`) = LENGTH(INET6_ATON(%s))
+                    AND `range_expires` > NOW()
+                ORDER BY `range_start` DESC, `range_end` ASC
+                LIMIT 1;
+                """, gamespace, ip, ip, ip
+            )
+        except database.DatabaseError as e:
+            raise BanError("Failed to find a network ban: " + e.args[1])
+
+        if ban is None:
+            return None
+
+        return RangeBanAdapter(ban)
+
+    async def find_range_bans(self, gamespace, ips):
+        """
+        :returns a dict of ip -> RangeBanAdapter, for the ips that belong to a banned network
+        """
+
+        result = {}
+
+        for ip in set(ips):
+            ban = await self.find_active_range_ban(gamespace, ip)
+
+            if ban is not None:
+                result[ip] = ban
+
+        return result
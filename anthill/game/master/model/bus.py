@@ -0,0 +1,118 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.common.model import Model
+from anthill.common.server import Server
+
+import logging
+import uuid
+
+
+class CacheBus(Model):
+    """
+    Keeps the local caches of the game-master nodes coherent.
+
+    A model that caches something subscribes to a topic with two callbacks: one to apply a single change, and one
+        to reload everything from scratch. Whenever a model changes something, it publishes an event to its topic,
+        and every other node applies it to its own cache.
+
+    Every node numbers its events, so a receiver can detect it has missed some (a broker reconnect, a node
+        restart etc). In that case there is no telling what has been changed, so every cache is reloaded entirely.
+    """
+
+    EXCHANGE = "game_master_cache"
+    ACTION = "cache_event"
+    ROUTING_KEY = "cache"
+
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex
+        self.sequence = 0
+        # node_id -> sequence number of the last event received from that node
+        self.received = {}
+        # topic -> (on_event, on_reload)
+        self.topics = {}
+
+        self.publisher = None
+        self.subscriber = None
+
+    async def started(self, application):
+        await super(CacheBus, self).started(application)
+
+        self.publisher = await Server.acquire_custom_publisher(CacheBus.EXCHANGE)
+        self.subscriber = await Server.acquire_custom_subscriber(CacheBus.EXCHANGE, round_robin=False)
+        await self.subscriber.handle(CacheBus.ACTION, self.__on_event__, routing_key=CacheBus.ROUTING_KEY)
+
+    async def stopped(self):
+        if self.subscriber:
+            await self.subscriber.release()
+            self.subscriber = None
+
+        if self.publisher:
+            await self.publisher.release()
+            self.publisher = None
+
+        await super(CacheBus, self).stopped()
+
+    def subscribe(self, topic, on_event, on_reload):
+        """
+        :param on_event: async callback (event, data) to apply a change made on another node
+        :param on_reload: async callback () to reload the cache entirely
+        """
+        self.topics[topic] = (on_event, on_reload)
+
+    async def publish(self, topic, event, data=None):
+        """
+        Notifies the other nodes about a change. Failing to do so is not an error for the caller: the other nodes
+            will notice the gap in the sequence with the next event and reload.
+        """
+
+        self.sequence += 1
+
+        if self.publisher is None:
+            return
+
+        try:
+            await self.publisher.publish(CacheBus.ACTION, {
+                "node": self.node_id,
+                "sequence": self.sequence,
+                "topic": topic,
+                "event": event,
+                "data": data or {}
+            }, routing_key=CacheBus.ROUTING_KEY)
+        except Exception:
+            logging.exception("Failed to publish a cache event {0}/{1}".format(topic, event))
+
+    async def __on_event__(self, payload):
+        node = payload.get("node")
+
+        if node == self.node_id:
+            return
+
+        sequence = payload.get("sequence", 0)
+        last = self.received.get(node)
+        self.received[node] = sequence
+
+        if last is not None and sequence != last + 1:
+            logging.warning("Missed {0} cache event(s) from node {1}, reloading".format(sequence - last - 1, node))
+            IOLoop.current().spawn_callback(self.reload)
+            return
+
+        handlers = self.topics.get(payload.get("topic"))
+
+        if handlers is None:
+            return
+
+        on_event, on_reload = handlers
+
+        try:
+            await on_event(payload.get("event"), payload.get("data", {}))
+        except Exception:
+            logging.exception("Failed to apply a cache event, reloading")
+            await on_reload()
+
+    async def reload(self):
+        for topic, (on_event, on_reload) in self.topics.items():
+            try:
+                await on_reload()
+            except Exception:
+                logging.exception("Failed to reload cache {0}".format(topic))
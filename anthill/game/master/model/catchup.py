@@ -0,0 +1,147 @@
+
+from tornado.queues import Queue
+
+from anthill.common.model import Model
+from anthill.common.options import options
+
+from .deploy import DeploymentError, DeploymentDeliveryError, DeploymentNotFound, DeploymentDeliveryAdapter
+from .distribution import DeliveryTree, deliver_host
+from .host import HostError, HostNotFound
+
+import asyncio
+import logging
+
+
+class DeliveryCatchUpModel(Model):
+    """
+    Delivers the current deployments to the hosts that have missed them, for example being offline, or not existing
+        yet, when the deployment was delivered.
+
+    As soon as a host connects, every delivery it is missing is marked as being delivered, and queued. No more than
+        deployments_catch_up_concurrency of them run at the same time, no matter how many hosts connect at once.
+        Until a delivery is done, no room of that game version is placed onto the host
+        (see DeploymentModel.get_delivered_hosts).
+    """
+
+    def __init__(self, app, deployments, hosts):
+        self.app = app
+        self.deployments = deployments
+        self.hosts = hosts
+        self.queue = Queue()
+        # a set of (host_id, deployment_id) queued or being delivered
+        self.queued = set()
+        self.workers = []
+
+    async def started(self, application):
+        await super(DeliveryCatchUpModel, self).started(application)
+
+        self.workers = [
+            asyncio.ensure_future(self.__worker__())
+            for i in range(0, max(options.deployments_catch_up_concurrency, 1))
+        ]
+
+    async def stopped(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+        await super(DeliveryCatchUpModel, self).stopped()
+
+    async def host_connected(self, host_id):
+        """
+        Queues the delivery of every current deployment the host does not have
+        :returns amount of deliveries queued
+        """
+
+        host_id = str(host_id)
+
+        try:
+            missing = await self.deployments.list_missing_deliveries(host_id)
+        except DeploymentDeliveryError:
+            logging.exception("Failed to list missing deliveries for host {0}".format(host_id))
+            return 0
+
+        queued = 0
+
+        for deployment in missing:
+            key = (host_id, deployment.deployment_id)
+
+            if key in self.queued:
+                continue
+
+            try:
+                if deployment.delivery_id is None:
+                    delivery_id = await self.deployments.new_deployment_delivery(
+                        deployment.gamespace_id, deployment.deployment_id, host_id)
+                else:
+                    delivery_id = deployment.delivery_id
+                    await self.deployments.update_deployment_delivery_status(
+                        deployment.gamespace_id, delivery_id, DeploymentDeliveryAdapter.STATUS_DELIVERING)
+            except DeploymentError as e:
+                # most likely, being delivered by the admin at the same time
+                logging.warning("Cannot catch up deployment {0} on host {1}: {2}".format(
+                    deployment.deployment_id, host_id, e.message))
+                continue
+
+            self.queued.add(key)
+            self.queue.put_nowait((host_id, deployment, delivery_id))
+            queued += 1
+
+        if queued:
+            logging.info("Host {0} is missing {1} deployment(s), catching up".format(host_id, queued))
+
+        return queued
+
+    async def __worker__(self):
+        while True:
+            host_id, deployment, delivery_id = await self.queue.get()
+
+            try:
+                await self.__catch_up__(host_id, deployment, delivery_id)
+            except Exception:
+                logging.exception("Failed to catch up deployment {0} on host {1}".format(
+                    deployment.deployment_id, host_id))
+            finally:
+                self.queued.discard((host_id, deployment.deployment_id))
+                self.queue.task_done()
+
+    async def __catch_up__(self, host_id, missing, delivery_id):
+        deployments = self.deployments
+
+        try:
+            host = await self.hosts.get_host(host_id)
+            deployment = await deployments.get_deployment(missing.gamespace_id, missing.deployment_id)
+            delta = (await deployments.get_deployment_manifest(deployment)) is not None
+        except (HostError, HostNotFound, DeploymentError, DeploymentNotFound) as e:
+            await deployments.update_deployment_delivery_status(
+                missing.gamespace_id, delivery_id, DeploymentDeliveryAdapter.STATUS_ERROR,
+                str(e)[:256] or "Not found")
+            return
+
+        errors = {}
+
+        def on_result(delivered_host, delivered, error):
+            errors[delivered_host.host_id] = error
+
+        async def deliver(delivered_host, source):
+            await deliver_host(
+                self.app, missing.game_name, missing.game_version, missing.deployment_id,
+                delivered_host, missing.hash, delta=delta)
+            return True
+
+        tree = DeliveryTree(
+            [host], 1, 0,
+            retries=options.deployments_delivery_retries,
+            backoff=options.deployments_delivery_backoff,
+            on_result=on_result)
+
+        results = await tree.run(deliver)
+
+        if results.get(host.host_id):
+            logging.info("Deployment {0} caught up on host {1}".format(missing.deployment_id, host_id))
+            await deployments.update_deployment_delivery_status(
+                missing.gamespace_id, delivery_id, DeploymentDeliveryAdapter.STATUS_DELIVERED)
+        else:
+            await deployments.update_deployment_delivery_status(
+                missing.gamespace_id, delivery_id, DeploymentDeliveryAdapter.STATUS_ERROR,
+                (errors.get(host.host_id) or "Cannot deliver")[:256])
@@ -0,0 +1,189 @@
+
+import hashlib
+import mmap
+import os
+import struct
+import time
+import ujson
+
+
+class ChunkStore(object):
+    """
+    A content-addressed store of the pieces (chunks) the deployment files are split into, each one named after
+        the SHA-256 of its contents. Chunks that are the same across deployments are stored (and delivered to
+        the hosts) once, so a new version of a game only costs the chunks that have actually changed.
+
+    The chunk boundaries are defined by the contents, not by the offsets: a deployment is a zip file, so a
+        boundary is put at the start of every file entry, and between its header and its (compressed) data.
+        The data of an unchanged file then always ends up in the same chunks, wherever it moves in the archive,
+        and regardless of its header (that has the modification time in it) being changed. The headers and the
+        small files in between the large ones are merged into chunks of at least MIN_CHUNK, and the large files
+        are cut every MAX_CHUNK bytes.
+    """
+
+    MIN_CHUNK = 65536
+    MAX_CHUNK = 4194304
+
+    ZIP_LOCAL_HEADER = b"PK\x03\x04"
+    ZIP_LOCAL_HEADER_SIZE = 30
+
+    def __init__(self, location):
+        self.location = location
+
+        if not os.path.isdir(self.location):
+            os.mkdir(self.location)
+
+    def chunk_path(self, chunk_id):
+        return os.path.join(self.location, chunk_id[:2], chunk_id)
+
+    def has_chunk(self, chunk_id):
+        return os.path.isfile(self.chunk_path(chunk_id))
+
+    @staticmethod
+    def anchors(data):
+        """
+        :returns a list of the offsets a chunk is allowed to start at, in ascending order
+        """
+
+        result = []
+        size = len(data)
+        position = data.find(ChunkStore.ZIP_LOCAL_HEADER)
+
+        while position >= 0:
+            result.append(position)
+
+            header_end = position + ChunkStore.ZIP_LOCAL_HEADER_SIZE
+
+            if header_end <= size:
+                name_length, extra_length = struct.unpack("<HH", data[position + 26:header_end])
+                data_start = header_end + name_length + extra_length
+
+                if data_start < size:
+                    result.append(data_start)
+
+            position = data.find(ChunkStore.ZIP_LOCAL_HEADER, position + 1)
+
+        return result
+
+    @staticmethod
+    def split(data):
+        """
+        :returns a list of (start, end) of the chunks the data consists of
+        """
+
+        size = len(data)
+        result = []
+        start = 0
+        previous = 0
+
+        for anchor in ChunkStore.anchors(data) + [size]:
+            if anchor <= previous:
+                continue
+
+            # a large piece always starts a chunk of its own, so it is not glued to a header in front of it
+            if anchor - previous >= ChunkStore.MIN_CHUNK and previous > start:
+                result.append((start, previous))
+                start = previous
+
+            while anchor - start > ChunkStore.MAX_CHUNK:
+                result.append((start, start + ChunkStore.MAX_CHUNK))
+                start += ChunkStore.MAX_CHUNK
+
+            if anchor - start >= ChunkStore.MIN_CHUNK:
+                result.append((start, anchor))
+                start = anchor
+
+            previous = anchor
+
+        if start < size:
+            result.append((start, size))
+
+        return result
+
+    def __write_chunk__(self, chunk_id, data):
+        path = self.chunk_path(chunk_id)
+        directory = os.path.dirname(path)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        # written aside and then moved in place, so a chunk is never seen partially written
+        temp_path = path + ".tmp"
+
+        with open(temp_path, "wb") as f:
+            f.write(data)
+
+        os.replace(temp_path, path)
+
+    def store(self, filename):
+        """
+        Splits a file into the chunks, and stores the ones that are not in the store yet
+        :returns a manifest of the file: {"size": <size>, "chunks": [[<chunk_id>, <chunk_size>], ...]}, and
+            the amount of bytes and chunks that were new to the store, as "new_size" and "new_chunks"
+        """
+
+        chunks = []
+        new_size = 0
+        new_chunks = 0
+
+        size = os.path.getsize(filename)
+
+        if size:
+            with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for start, end in ChunkStore.split(data):
+                    chunk = data[start:end]
+                    chunk_id = hashlib.sha256(chunk).hexdigest()
+
+                    if self.has_chunk(chunk_id):
+                        # see collect
+                        os.utime(self.chunk_path(chunk_id))
+                    else:
+                        self.__write_chunk__(chunk_id, chunk)
+                        new_size += len(chunk)
+                        new_chunks += 1
+
+                    chunks.append([chunk_id, len(chunk)])
+
+        return {
+            "size": size,
+            "chunks": chunks,
+            "new_size": new_size,
+            "new_chunks": new_chunks
+        }
+
+    @staticmethod
+    def write_manifest(filename, manifest):
+        with open(filename, "w") as f:
+            f.write(ujson.dumps(manifest))
+
+    @staticmethod
+    def read_manifest(filename):
+        with open(filename, "r") as f:
+            return ujson.loads(f.read())
+
+    def collect(self, manifests, min_age=3600):
+        """
+        Removes the chunks no manifest refers to anymore
+        :param manifests: a list of paths to every manifest there is
+        :param min_age: the chunks written (or reused) less than that many seconds ago are kept, as they may belong
+            to a deployment that is being stored right now and has no manifest yet
+        :returns amount of chunks removed
+        """
+
+        referenced = set()
+        keep_after = time.time() - min_age
+
+        for manifest in manifests:
+            referenced.update(chunk_id for chunk_id, chunk_size in ChunkStore.read_manifest(manifest)["chunks"])
+
+        removed = 0
+
+        for directory, subdirectories, files in os.walk(self.location):
+            for name in files:
+                path = os.path.join(directory, name)
+
+                if name not in referenced and os.path.getmtime(path) < keep_after:
+                    os.remove(path)
+                    removed += 1
+
+        return removed
@@ -1,6 +1,5 @@
 
 from tornado.concurrent import run_on_executor
-from tornado.ioloop import IOLoop
 from concurrent.futures import ThreadPoolExecutor
 
 from anthill.common import database, clamp
@@ -8,8 +7,11 @@ from anthill.common.model import Model
 from anthill.common.options import options
 from anthill.common.validate import validate
 
+from .chunks import ChunkStore
+
+import mmap
 import os
-import threading
+import time
 
 
 class DeploymentError(Exception):
@@ -82,16 +84,85 @@ class CurrentDeploymentAdapter(object):
         self.enabled = data.get("deployment_enabled") == 1
 
 
+class MissingDeploymentAdapter(object):
+    """
+    A current deployment of a game version that is not delivered to a host
+    """
+
+    def __init__(self, data):
+        self.gamespace_id = str(data.get("gamespace_id"))
+        self.game_name = data.get("game_name")
+        self.game_version = data.get("game_version")
+        self.deployment_id = str(data.get("deployment_id"))
+        self.hash = data.get("deployment_hash")
+        delivery_id = data.get("delivery_id")
+        # None if there was no attempt to deliver it to the host yet
+        self.delivery_id = str(delivery_id) if delivery_id is not None else None
+
+
+class DeploymentFile(object):
+    """
+    A deployment file, mapped into memory. Many hosts download the same deployment at the same time, so instead
+        of reading the file over and over with a small buffer each, they all take large slices of the same
+        mapping, straight from the page cache.
+    """
+
+    def __init__(self, filename):
+        self.size = os.path.getsize(filename)
+        self.mapped = None
+
+        # an empty file cannot be mapped
+        if self.size:
+            with open(filename, 'rb') as f:
+                self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, start, end):
+        return self.mapped[start:end]
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+
 class DeploymentModel(Model):
     executor = ThreadPoolExecutor(max_workers=4)
 
-    def __init__(self, db):
+    # for how long (in seconds) the set of hosts a deployment is delivered to is cached, as the deliveries
+    #   made by other instances are only seen once it expires
+    DELIVERED_HOSTS_TTL = 5
+
+    def __init__(self, db, bus):
         self.db = db
+        self.bus = bus
         self.deployments_location = options.deployments_location
+        self.download_chunk = max(options.deployments_download_chunk, 16384)
+        # (gamespace_id, game_name, game_version) -> CurrentDeploymentAdapter
+        self.current_deployments = {}
+        # deployment_id -> progress of the delivery of it, see DeliveryProgress
+        self.delivery_progress = {}
+        # deployment_id -> (expires_at, a frozenset of the host ids it's delivered to)
+        self.delivered_hosts = {}
 
         if not os.path.isdir(self.deployments_location):
             os.mkdir(self.deployments_location)
 
+        if options.deployments_delta_delivery:
+            self.chunks = ChunkStore(os.path.join(self.deployments_location, ".chunks"))
+        else:
+            self.chunks = None
+
+        bus.subscribe("deployments", self.__on_cache_event__, self.__on_cache_reload__)
+
+    async def __on_cache_event__(self, event, data):
+        if event == "current_changed":
+            self.current_deployments.pop((str(data["gamespace_id"]), data["game_name"], data["game_version"]), None)
+        elif event == "delivery_progress":
+            self.delivery_progress[str(data["deployment_id"])] = data["progress"]
+
+    async def __on_cache_reload__(self):
+        self.current_deployments = {}
+
     def get_setup_db(self):
         return self.db
 
@@ -100,6 +171,12 @@ class DeploymentModel(Model):
 
     @validate(gamespace_id="int", game_name="str", game_version="str")
     async def get_current_deployment(self, gamespace_id, game_name, game_version):
+        key = (str(gamespace_id), game_name, game_version)
+        cached = self.current_deployments.get(key)
+
+        if cached is not None:
+            return cached
+
         try:
             current_deployment = await self.db.get(
                 """
@@ -115,7 +192,9 @@ class DeploymentModel(Model):
         if current_deployment is None:
             raise NoCurrentDeployment()
 
-        return CurrentDeploymentAdapter(current_deployment)
+        result = CurrentDeploymentAdapter(current_deployment)
+        self.current_deployments[key] = result
+        return result
 
     @validate(gamespace_id="int", game_name="str", current_deployment="int", enabled="bool")
     async def update_game_version_deployment(self, gamespace_id, game_name, game_version, current_deployment, enabled):
@@ -133,6 +212,14 @@ class DeploymentModel(Model):
         except database.DatabaseError as e:
             raise DeploymentError("Failed to switch deployment: " + e.args[1])
 
+        self.current_deployments.pop((str(gamespace_id), game_name, game_version), None)
+
+        await self.bus.publish("deployments", "current_changed", {
+            "gamespace_id": gamespace_id,
+            "game_name": game_name,
+            "game_version": game_version
+        })
+
     @validate(gamespace_id="int", game_name="str", current_deployment="int", deployment_hash="str")
     async def new_deployment(self, gamespace_id, game_name, game_version, deployment_hash):
 
@@ -252,54 +339,170 @@ class DeploymentModel(Model):
 
         return list(map(DeploymentAdapter, deployments))
 
-    @run_on_executor
-    def __download_deployment_file__(self, ioloop, filename, write_callback):
-        lock = threading.Lock()
+    def get_deployment_path(self, deployment):
+        return os.path.join(
+            self.deployments_location,
+            deployment.game_name,
+            deployment.game_version,
+            str(deployment.deployment_id) + ".zip")
 
-        def write_chunk(chunk):
-            write_callback(chunk, lock.release)
+    def get_manifest_path(self, deployment):
+        return os.path.join(
+            self.deployments_location,
+            deployment.game_name,
+            deployment.game_version,
+            str(deployment.deployment_id) + ".manifest")
+
+    @run_on_executor
+    def __open_deployment_file__(self, filename):
+        return DeploymentFile(filename)
 
-        with open(filename, 'rb') as f:
-            while 1:
-                data = f.read(16384)
-                if data:
-                    lock.acquire()
-                    ioloop.add_callback(write_chunk, data)
-                else:
-                    return
+    @run_on_executor
+    def __read_deployment_file__(self, deployment_file, start, end):
+        return deployment_file.read(start, end)
 
     @validate(deployment=DeploymentAdapter)
-    async def download_deployment_file(self, deployment, write_callback):
+    async def open_deployment_file(self, deployment):
         """
-        Starts the process of downloading deployment file for deployment
+        Opens the deployment file for reading
         :param deployment: a DeploymentAdapter instance for file in question
-        :param write_callback: a write function of signatuere write_callback(chunk, flushed) which should write the
-                               chunk data to the socket and call flushed when the chunk has been flushed out
+        :return: a DeploymentFile, to be closed by the caller
+        """
+
+        try:
+            return await self.__open_deployment_file__(self.get_deployment_path(deployment))
+        except (OSError, ValueError) as e:
+            raise DeploymentError("Failed to open deployment file: " + str(e))
+
+    async def download_deployment_file(self, deployment_file, write_callback, start=0, end=None):
+        """
+        Sends out the contents of a deployment file, in slices of options.deployments_download_chunk bytes
+        :param deployment_file: a DeploymentFile, as returned by open_deployment_file
+        :param write_callback: an async function write_callback(chunk) which should write the chunk data to the
+                               socket and return when the chunk has been flushed out
+        :param start: an offset to start from, to resume a broken download
+        :param end: an offset to stop at (exclusive), the end of the file by default
         :return: yields until all contents of the file has been flushed out
         """
 
-        deployment_path = os.path.join(
-            self.deployments_location,
-            deployment.game_name,
-            deployment.game_version,
-            str(deployment.deployment_id) + ".zip")
+        chunk_size = self.download_chunk
+        end = deployment_file.size if end is None else min(end, deployment_file.size)
+
+        for offset in range(start, end, chunk_size):
+            # the slice is taken on the executor, as it may have to wait for the disk
+            data = await self.__read_deployment_file__(deployment_file, offset, min(offset + chunk_size, end))
+            await write_callback(data)
 
-        await self.__download_deployment_file__(IOLoop.current(), deployment_path, write_callback)
+    @run_on_executor
+    def __get_file_size__(self, filename):
+        return os.path.getsize(filename)
+
+    @validate(deployment=DeploymentAdapter)
+    async def get_deployment_size(self, deployment):
+        try:
+            return await self.__get_file_size__(self.get_deployment_path(deployment))
+        except OSError as e:
+            raise DeploymentError("Failed to get deployment file size: " + str(e))
+
+    def get_delivery_progress(self, deployment_id):
+        """
+        :returns the progress of the last delivery of the deployment (see DeliveryProgress.dump), or None
+        """
+        return self.delivery_progress.get(str(deployment_id))
+
+    async def update_delivery_progress(self, deployment_id, progress):
+        self.delivery_progress[str(deployment_id)] = progress
+
+        await self.bus.publish("deployments", "delivery_progress", {
+            "deployment_id": str(deployment_id),
+            "progress": progress
+        })
 
     @run_on_executor
-    def __remove_deployment_file__(self, filename):
+    def __store_deployment_chunks__(self, filename, manifest_filename):
+        manifest = self.chunks.store(filename)
+        ChunkStore.write_manifest(manifest_filename, manifest)
+        return manifest
+
+    @validate(deployment=DeploymentAdapter)
+    async def store_deployment_chunks(self, deployment):
+        """
+        Splits the deployment file into the chunk store, and writes down the manifest of it, so the hosts could
+            fetch only the chunks they don't have yet
+        :returns the manifest, see ChunkStore.store
+        """
+
+        if self.chunks is None:
+            raise DeploymentError("Delta delivery is disabled")
+
+        try:
+            return await self.__store_deployment_chunks__(
+                self.get_deployment_path(deployment), self.get_manifest_path(deployment))
+        except (OSError, ValueError) as e:
+            raise DeploymentError("Failed to store deployment chunks: " + str(e))
+
+    @run_on_executor
+    def __read_manifest__(self, filename):
+        if not os.path.isfile(filename):
+            return None
+        return ChunkStore.read_manifest(filename)
+
+    @validate(deployment=DeploymentAdapter)
+    async def get_deployment_manifest(self, deployment):
+        """
+        :returns the manifest of the deployment, or None if the deployment has not been split into chunks
+        """
+
+        if self.chunks is None:
+            return None
+
+        try:
+            return await self.__read_manifest__(self.get_manifest_path(deployment))
+        except (OSError, ValueError) as e:
+            raise DeploymentError("Failed to read deployment manifest: " + str(e))
+
+    async def open_chunk(self, chunk_id):
+        """
+        Opens a chunk for reading, the same way open_deployment_file does
+        """
+
+        if self.chunks is None or not self.chunks.has_chunk(chunk_id):
+            raise DeploymentError("No such chunk")
+
+        try:
+            return await self.__open_deployment_file__(self.chunks.chunk_path(chunk_id))
+        except (OSError, ValueError) as e:
+            raise DeploymentError("Failed to open chunk: " + str(e))
+
+    @run_on_executor
+    def __remove_deployment_file__(self, filename, manifest_filename):
         os.remove(filename)
 
-    @validate(gamespace_id="int", deployment=DeploymentAdapter)
-    async def delete_deployment_file(self, gamespace_id, deployment):
+        if not os.path.isfile(manifest_filename):
+            return
 
-        deployment_path = os.path.join(
-            self.deployments_location,
-            deployment.game_name,
-            deployment.game_version,
-            str(deployment.deployment_id) + ".zip")
+        os.remove(manifest_filename)
+
+        if self.chunks is None:
+            return
+
+        manifests = []
+
+        for directory, subdirectories, files in os.walk(self.deployments_location):
+            # the chunk store itself
+            subdirectories[:] = [name for name in subdirectories if not name.startswith(".")]
 
-        await self.__remove_deployment_file__(deployment_path)
+            manifests.extend(
+                os.path.join(directory, name)
+                for name in files
+                if name.endswith(".manifest"))
+
+        self.chunks.collect(manifests)
+
+    @validate(gamespace_id="int", deployment=DeploymentAdapter)
+    async def delete_deployment_file(self, gamespace_id, deployment):
+        await self.__remove_deployment_file__(
+            self.get_deployment_path(deployment), self.get_manifest_path(deployment))
 
     @validate(gamespace_id="int", deployment=DeploymentAdapter)
     async def delete_deployment(self, gamespace_id, deployment):
@@ -313,6 +516,61 @@ class DeploymentModel(Model):
         except database.DatabaseError as e:
             raise DeploymentError("Failed to delete a deployment: " + e.args[1])
 
+    @validate(gamespace_id="int", deployment_id="int")
+    async def get_delivered_hosts(self, gamespace_id, deployment_id):
+        """
+        :returns a frozenset of the ids of the hosts the deployment is delivered to, so the rooms of that deployment
+            are only placed on them
+        """
+
+        deployment_id = str(deployment_id)
+        cached = self.delivered_hosts.get(deployment_id)
+
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+
+        try:
+            deliveries = await self.db.query(
+                """
+                SELECT `host_id`
+                FROM `deployment_deliveries`
+                WHERE `gamespace_id`=%s AND `deployment_id`=%s AND `delivery_status`='delivered';
+                """, gamespace_id, deployment_id
+            )
+        except database.DatabaseError as e:
+            raise DeploymentDeliveryError("Failed to get deployment deliveries: " + e.args[1])
+
+        result = frozenset(str(delivery["host_id"]) for delivery in deliveries)
+        self.delivered_hosts[deployment_id] = (time.time() + DeploymentModel.DELIVERED_HOSTS_TTL, result)
+        return result
+
+    @validate(host_id="int")
+    async def list_missing_deliveries(self, host_id):
+        """
+        :returns a list of the current deployments (of enabled game versions, across all gamespaces) that are not
+            delivered to the host, see MissingDeploymentAdapter
+        """
+
+        try:
+            missing = await self.db.query(
+                """
+                SELECT g.`gamespace_id`, g.`game_name`, g.`game_version`, d.`deployment_id`, d.`deployment_hash`,
+                    dd.`delivery_id`
+                FROM `game_deployments` AS g
+                INNER JOIN `deployments` AS d
+                    ON d.`deployment_id`=g.`current_deployment`
+                LEFT JOIN `deployment_deliveries` AS dd
+                    ON dd.`gamespace_id`=g.`gamespace_id` AND dd.`deployment_id`=d.`deployment_id` AND
+                        dd.`host_id`=%s
+                WHERE g.`deployment_enabled`=1 AND d.`deployment_status` IN ('delivering', 'delivered') AND
+                    (dd.`delivery_id` IS NULL OR dd.`delivery_status`!='delivered');
+                """, host_id
+            )
+        except database.DatabaseError as e:
+            raise DeploymentDeliveryError("Failed to list missing deliveries: " + e.args[1])
+
+        return list(map(MissingDeploymentAdapter, missing))
+
     @validate(gamespace_id="int", deployment_id="int", host_id="int")
     async def new_deployment_delivery(self, gamespace_id, deployment_id, host_id):
         try:
@@ -325,6 +583,7 @@ class DeploymentModel(Model):
         except database.DatabaseError as e:
             raise DeploymentError("Failed to create a deployment delivery: " + e.args[1])
         else:
+            self.delivered_hosts.pop(str(deployment_id), None)
             return str(deployment_delivery_id)
 
     @validate(gamespace_id="int", delivery_id="int", status="str_name", error_reason="str")
@@ -340,19 +599,25 @@ class DeploymentModel(Model):
         except database.DatabaseError as e:
             raise DeploymentError("Failed to update deployment delivery status: " + e.args[1])
 
-    @validate(gamespace_id="int", delivery_ids="json_list_of_ints", status="str_name")
-    async def update_deployment_deliveries_status(self, gamespace_id, delivery_ids, status):
+        # the delivery ids are not mapped to the deployments, so everything is looked up again
+        self.delivered_hosts = {}
+
+    @validate(gamespace_id="int", delivery_ids="json_list_of_ints", status="str_name", error_reason="str")
+    async def update_deployment_deliveries_status(self, gamespace_id, delivery_ids, status, error_reason=""):
         try:
             await self.db.execute(
                 """
                 UPDATE `deployment_deliveries`
-                SET `delivery_status`=%s
+                SET `delivery_status`=%s, `error_reason`=%s
                 WHERE `gamespace_id`=%s AND `delivery_id` IN %s;
-                """, status, gamespace_id, delivery_ids
+                """, status, error_reason, gamespace_id, delivery_ids
             )
         except database.DatabaseError as e:
             raise DeploymentError("Failed to update deployment delivery status: " + e.args[1])
 
+        # the delivery ids are not mapped to the deployments, so everything is looked up again
+        self.delivered_hosts = {}
+
     @validate(gamespace_id="int", delivery_id="int")
     async def update_deployment_delivery(self, gamespace_id, delivery_id):
         try:
@@ -399,3 +664,5 @@ class DeploymentModel(Model):
             )
         except database.DatabaseError as e:
             raise DeploymentDeliveryError("Failed to delete a deployment delivery: " + e.args[1])
+
+        self.delivered_hosts = {}
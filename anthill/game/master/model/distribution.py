@@ -0,0 +1,521 @@
+
+from tornado.gen import multi
+from tornado.ioloop import IOLoop
+
+from anthill.common.jsonrpc import JsonRPCError, JSONRPC_TIMEOUT
+from anthill.common.options import options
+
+from .deploy import DeploymentError, DeploymentNotFound, DeploymentAdapter
+from .deploy import DeploymentDeliveryError, DeploymentDeliveryAdapter
+from .host import HostError
+
+from collections import deque
+
+import asyncio
+import logging
+import time
+
+
+class DeliveryError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class NothingToDeliver(DeliveryError):
+    pass
+
+
+class DeliveryProgress(object):
+    """
+    How far a delivery of a deployment has got, in hosts and in bytes placed on them
+    """
+
+    def __init__(self, hosts, size):
+        self.hosts = hosts
+        self.size = size
+        self.delivered = 0
+        self.failed = 0
+        self.started = time.time()
+        self.finished = None
+
+    def add(self, delivered):
+        if delivered:
+            self.delivered += 1
+        else:
+            self.failed += 1
+
+    def finish(self):
+        self.finished = time.time()
+
+    def dump(self):
+        return {
+            "hosts": self.hosts,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "size": self.size,
+            "bytes": self.delivered * self.size,
+            "total_bytes": self.hosts * self.size,
+            "time": (self.finished or time.time()) - self.started,
+            "finished": self.finished is not None
+        }
+
+
+class DeliveryTree(object):
+    """
+    Plans the delivery of a deployment to a fleet of hosts, so the master does not have to send it to every host
+        by itself.
+
+    The hosts are delivered region by region, all regions at the same time. In each region, first `seeds` hosts
+        download the deployment from the master. As soon as a host has the deployment, it becomes a source for up
+        to `fanout` other hosts of the same region, and so on, so the delivery forms a fan-out tree that grows
+        as it goes. The peers are always preferred over the master, the master only serves `seeds` hosts per
+        region at a time.
+
+    On top of that, no more than `region_concurrency` deliveries run in a region, and no more than `concurrency`
+        overall. A failed delivery is retried up to `retries` times, waiting `backoff` seconds before the first
+        retry, and twice as long before each next one.
+
+    The delivery itself is up to the `deliver` callback, so the tree can be run against stand-in hosts.
+    """
+
+    def __init__(self, hosts, seeds, fanout, concurrency=0, region_concurrency=0, retries=0, backoff=5.0,
+                 on_result=None):
+        """
+        :param hosts: a list of hosts to deliver to, each one having `region` attribute
+        :param seeds: how many hosts of a region may download from the master at the same time
+        :param fanout: how many hosts a host may serve at the same time, once it has the deployment; with 0,
+            every host downloads from the master
+        :param concurrency: how many deliveries may run at the same time overall, 0 for no limit
+        :param region_concurrency: how many deliveries may run at the same time in a region, 0 for no limit
+        :param retries: how many times a failed delivery is retried
+        :param backoff: how long (in seconds) to wait before the first retry
+        :param on_result: a function on_result(host, delivered, error) called as soon as a host is done
+        """
+
+        self.seeds = max(seeds, 1)
+        self.fanout = max(fanout, 0)
+        self.region_concurrency = max(region_concurrency, 0)
+        self.retries = max(retries, 0)
+        self.backoff = backoff
+        self.on_result = on_result
+
+        self.semaphore = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+
+        self.regions = {}
+
+        for host in hosts:
+            self.regions.setdefault(host.region, []).append(host)
+
+        # host -> the source it has got the deployment from, None for the master
+        self.sources = {}
+
+    async def __deliver_once__(self, host, source, deliver):
+        if self.semaphore is None:
+            return await deliver(host, source)
+
+        async with self.semaphore:
+            return await deliver(host, source)
+
+    async def __deliver_host__(self, host, source, deliver):
+        """
+        :returns a pair (delivered, error)
+        """
+
+        error = "Cannot deliver"
+
+        for attempt in range(0, self.retries + 1):
+            if attempt:
+                delay = self.backoff * (2 ** (attempt - 1))
+                logging.info("Retrying delivery to host {0} in {1} seconds".format(host.host_id, delay))
+                await asyncio.sleep(delay)
+
+            try:
+                if await self.__deliver_once__(host, source, deliver):
+                    return True, None
+            except Exception as e:
+                logging.exception("Failed to deliver to host {0}".format(host.host_id))
+                error = str(e) or error
+
+        return False, error
+
+    async def __deliver_region__(self, hosts, deliver, results):
+        pending = deque(hosts)
+
+        if self.fanout:
+            master_slots = self.seeds
+        else:
+            master_slots = len(hosts)
+
+        peer_slots = deque()
+        running = {}
+
+        while pending or running:
+            while pending and (peer_slots or master_slots) and \
+                    (not self.region_concurrency or len(running) < self.region_concurrency):
+
+                host = pending.popleft()
+
+                if peer_slots:
+                    source = peer_slots.popleft()
+                else:
+                    source = None
+                    master_slots -= 1
+
+                running[asyncio.ensure_future(self.__deliver_host__(host, source, deliver))] = (host, source)
+
+            done, ignored = await asyncio.wait(list(running.keys()), return_when=asyncio.FIRST_COMPLETED)
+
+            for future in done:
+                host, source = running.pop(future)
+
+                if source is None:
+                    master_slots += 1
+                else:
+                    peer_slots.append(source)
+
+                delivered, error = future.result()
+                results[host.host_id] = delivered
+
+                if delivered:
+                    self.sources[host.host_id] = source
+                    peer_slots.extend([host] * self.fanout)
+
+                if self.on_result:
+                    self.on_result(host, delivered, error)
+
+    async def run(self, deliver):
+        """
+        Delivers to every host
+        :param deliver: async function deliver(host, source) that delivers to the host from the source (a host
+            that already has the deployment, or None for the master); returns True if it has been delivered,
+            and either returns False or raises an exception otherwise
+        :returns a dict of host_id -> True/False, whether the deployment has been delivered to the host
+        """
+
+        results = {}
+
+        await asyncio.gather(*[
+            self.__deliver_region__(hosts, deliver, results)
+            for hosts in self.regions.values()
+        ])
+
+        return results
+
+
+async def deliver_host(application, game_name, game_version, deployment_id, host, deployment_hash,
+                       delta=False, source=None):
+    """
+    Delivers a deployment to a single host: from the source host if there is one, by chunks if the deployment has
+        a manifest, or as a whole file, falling back to the next option if the host cannot do the previous one
+    :raises DeploymentDeliveryError if the host could not get it
+    """
+    rpc = application.rpc.acquire_rpc("admin")
+
+    started = time.time()
+
+    try:
+        result = None
+
+        if source is not None:
+            # the host fetches the deployment from a host of its region that already has it
+            try:
+                result = await rpc.send_mq_request(
+                    "game_host_{0}".format(host.host_id),
+                    "deploy_delivery_peer", 600, game_name, game_version, deployment_id, deployment_hash,
+                    source.address)
+            except Exception as e:
+                logging.warning("Host {0} cannot deliver {1} from host {2} ({3}), delivering from master".format(
+                    host.host_id, deployment_id, source.host_id, str(e)))
+
+            if not result:
+                source = None
+
+        if source is None and delta:
+            # the host fetches the manifest, and then only the chunks it doesn't have yet
+            try:
+                result = await rpc.send_mq_request(
+                    "game_host_{0}".format(host.host_id),
+                    "deploy_delivery_chunks", 600, game_name, game_version, deployment_id, deployment_hash)
+            except JsonRPCError as e:
+                logging.warning("Host {0} cannot deliver {1} by chunks ({2}), delivering the whole file".format(
+                    host.host_id, deployment_id, e.message))
+                delta = False
+
+        if source is None and not delta:
+            result = await rpc.send_mq_request(
+                "game_host_{0}".format(host.host_id),
+                "deploy_delivery", 600, game_name, game_version, deployment_id, deployment_hash)
+    except Exception as e:
+        raise DeploymentDeliveryError("Cannot deliver: " + str(e))
+
+    if not result:
+        raise DeploymentDeliveryError("Cannot deliver")
+
+    application.monitor_action(
+        "deployment_delivery",
+        values={
+            "time": time.time() - started,
+            "delta": 1.0 if delta and source is None else 0.0,
+            "peer": 1.0 if source is not None else 0.0
+        })
+
+
+class Delivery(object):
+    """
+    Delivers a deployment to every enabled host (and deletes it from them), keeping the delivery statuses
+        and the status of the deployment itself up to date. Used by the admin, and by the upload API.
+    """
+
+    # how often (in seconds) the delivery status changes and progress are written down
+    REPORT_PERIOD = 1
+
+    def __init__(self, application, gamespace):
+        self.application = application
+        self.gamespace = gamespace
+
+    async def __flush_statuses__(self, statuses):
+        """
+        Writes down the delivery status changes collected so far, one query per distinct status
+        :param statuses: a dict of delivery_id -> (status, error_reason), emptied as it's written
+        """
+        deployments = self.application.deployments
+
+        groups = {}
+
+        while statuses:
+            delivery_id, change = statuses.popitem()
+            groups.setdefault(change, []).append(delivery_id)
+
+        for (status, error_reason), delivery_ids in groups.items():
+            try:
+                await deployments.update_deployment_deliveries_status(
+                    self.gamespace, delivery_ids, status, error_reason)
+            except DeploymentError:
+                logging.exception("Failed to update {0} delivery statuses".format(len(delivery_ids)))
+
+    async def __deliver_upload__(self, game_name, game_version, deployment_id, deliver_list, deployment_hash):
+        deployments = self.application.deployments
+
+        try:
+            deployment = await deployments.get_deployment(self.gamespace, deployment_id)
+            delta = (await deployments.get_deployment_manifest(deployment)) is not None
+            size = await deployments.get_deployment_size(deployment)
+        except (DeploymentError, DeploymentNotFound):
+            logging.exception("Failed to check deployment file {0}".format(deployment_id))
+            delta = False
+            size = 0
+
+        delivery_ids = {
+            host.host_id: delivery_id
+            for delivery_id, host in deliver_list
+        }
+
+        progress = DeliveryProgress(len(deliver_list), size)
+        # delivery_id -> (status, error_reason) changes that are not written down yet
+        statuses = {}
+
+        def on_result(host, delivered, error):
+            progress.add(delivered)
+
+            if delivered:
+                statuses[delivery_ids[host.host_id]] = (DeploymentDeliveryAdapter.STATUS_DELIVERED, "")
+            else:
+                statuses[delivery_ids[host.host_id]] = (DeploymentDeliveryAdapter.STATUS_ERROR, error[:256])
+
+        async def deliver(host, source):
+            await deliver_host(
+                self.application, game_name, game_version, deployment_id, host, deployment_hash,
+                delta=delta, source=source)
+            return True
+
+        finished = asyncio.Event()
+
+        async def report():
+            while not finished.is_set():
+                try:
+                    await asyncio.wait_for(finished.wait(), Delivery.REPORT_PERIOD)
+                except asyncio.TimeoutError:
+                    pass
+
+                await self.__flush_statuses__(statuses)
+                await deployments.update_delivery_progress(deployment_id, progress.dump())
+
+        tree = DeliveryTree(
+            [host for delivery_id, host in deliver_list],
+            options.deployments_delivery_seeds, options.deployments_delivery_fanout,
+            concurrency=options.deployments_delivery_concurrency,
+            region_concurrency=options.deployments_delivery_region_concurrency,
+            retries=options.deployments_delivery_retries,
+            backoff=options.deployments_delivery_backoff,
+            on_result=on_result)
+
+        await deployments.update_delivery_progress(deployment_id, progress.dump())
+        reporter = asyncio.ensure_future(report())
+
+        try:
+            results = await tree.run(deliver)
+        finally:
+            progress.finish()
+            finished.set()
+            # the last report writes down whatever is left
+            await reporter
+
+        failed = [host_id for host_id, delivered in results.items() if not delivered]
+
+        if failed:
+            logging.error("Error deliver deployment {0}: failed to deliver to hosts {1}".format(
+                deployment_id, ", ".join(failed)
+            ))
+            await deployments.update_deployment_status(
+                self.gamespace, deployment_id, DeploymentAdapter.STATUS_ERROR)
+            return False
+        else:
+            await deployments.update_deployment_status(
+                self.gamespace, deployment_id, DeploymentAdapter.STATUS_DELIVERED)
+            return True
+
+    async def __deliver_clean_host__(self, game_name, game_version, deployment_id, delivery_id, host):
+        deployments = self.application.deployments
+
+        await deployments.update_deployment_delivery_status(
+            self.gamespace, delivery_id, DeploymentDeliveryAdapter.STATUS_DELETING)
+
+        deployments = self.application.deployments
+        rpc = self.application.rpc.acquire_rpc("admin")
+
+        try:
+            result = await rpc.send_mq_request(
+                "game_host_{0}".format(host.host_id),
+                "delete_delivery", JSONRPC_TIMEOUT, game_name, game_version, deployment_id)
+        except Exception as e:
+            await deployments.update_deployment_delivery_status(
+                self.gamespace, delivery_id, DeploymentDeliveryAdapter.STATUS_ERROR, str(e))
+            raise DeploymentDeliveryError(str(e))
+
+        if result:
+            await deployments.update_deployment_delivery_status(
+                self.gamespace, delivery_id, DeploymentDeliveryAdapter.STATUS_DELETED)
+        else:
+            await deployments.update_deployment_delivery_status(
+                self.gamespace, deployment_id, DeploymentDeliveryAdapter.STATUS_ERROR)
+
+    async def __deliver_and_switch__(self, game_name, game_version, deployment_id, deliver_list, deployment_hash,
+                                     switch=False):
+        delivered = await self.__deliver_upload__(
+            game_name, game_version, deployment_id, deliver_list, deployment_hash)
+
+        if delivered and switch:
+            try:
+                await self.application.deployments.update_game_version_deployment(
+                    self.gamespace, game_name, game_version, deployment_id, True)
+            except DeploymentError:
+                logging.exception("Failed to switch to deployment {0}".format(deployment_id))
+                return False
+
+        return delivered
+
+    async def deliver(self, game_name, game_version, deployment_id, deployment_hash,
+                      wait_for_deliver=False, switch=False):
+        """
+        Delivers the deployment to every enabled host that does not have it yet (or failed to get it last time)
+        :param wait_for_deliver: wait for the delivery to finish, otherwise it goes on in the background,
+            and the progress can be followed with DeploymentModel.get_delivery_progress
+        :param switch: once delivered to every host, make the deployment the current one of the game version
+        :returns whether the deployment has been delivered (and switched to), if waited for
+        :raises NothingToDeliver if every host has the deployment already
+        """
+
+        hosts = self.application.hosts
+        deployments = self.application.deployments
+
+        try:
+            hosts_list = list(await hosts.list_enabled_hosts())
+        except HostError as e:
+            raise DeliveryError("Failed to list hosts: " + str(e))
+
+        try:
+            deliveries = list(await deployments.list_deployment_deliveries(self.gamespace, deployment_id))
+        except DeploymentDeliveryError as e:
+            raise DeliveryError("Failed to list deliveries: " + str(e))
+
+        deliver_list = []
+        delivery_ids = {item.host_id: item for item in deliveries}
+        host_ids = {item.host_id: item for item in hosts_list}
+
+        for host in hosts_list:
+            if host.host_id not in delivery_ids:
+                new_delivery_id = await deployments.new_deployment_delivery(
+                    self.gamespace, deployment_id, host.host_id)
+                deliver_list.append((new_delivery_id, host))
+
+        for delivery in deliveries:
+            if delivery.status == DeploymentDeliveryAdapter.STATUS_ERROR:
+                deliver_list.append((delivery.delivery_id, host_ids[delivery.host_id]))
+
+        if not deliver_list:
+            raise NothingToDeliver("Nothing to deliver")
+
+        try:
+            await deployments.update_deployment_status(
+                self.gamespace, deployment_id, DeploymentAdapter.STATUS_DELIVERING)
+        except DeploymentError as e:
+            raise DeliveryError("Failed to update deployment status: " + str(e))
+
+        try:
+            await deployments.update_deployment_deliveries_status(
+                self.gamespace, [
+                    delivery_id
+                    for delivery_id, host in deliver_list
+                ], DeploymentDeliveryAdapter.STATUS_DELIVERING)
+        except DeploymentDeliveryError as e:
+            await deployments.update_deployment_status(
+                self.gamespace, deployment_id, DeploymentAdapter.STATUS_ERROR)
+            raise DeliveryError("Failed to update deployment deliveries status: " + str(e))
+
+        if wait_for_deliver:
+            result = await self.__deliver_and_switch__(
+                game_name, game_version, deployment_id, deliver_list, deployment_hash, switch)
+            return result
+        else:
+            IOLoop.current().spawn_callback(
+                self.__deliver_and_switch__, game_name, game_version, deployment_id, deliver_list,
+                deployment_hash, switch)
+
+    async def __clean__(self, deployment, deliver_list=None):
+        deployments = self.application.deployments
+
+        try:
+            await deployments.update_deployment_status(
+                self.gamespace, deployment.deployment_id, DeploymentAdapter.STATUS_DELETING)
+        except DeploymentError as e:
+            raise DeliveryError("Failed to update deployment status: " + str(e))
+
+        tasks = [
+            self.__deliver_clean_host__(deployment.game_name, deployment.game_version,
+                                        deployment.deployment_id, delivery_id, host)
+            for delivery_id, host in deliver_list
+        ]
+
+        try:
+            await multi(tasks)
+        except Exception as e:
+            logging.exception("Failed to delete deployment {0}".format(deployment.deployment_id))
+            await deployments.update_deployment_status(
+                self.gamespace, deployment.deployment_id, DeploymentAdapter.STATUS_ERROR)
+            raise DeliveryError("Failed to delete deployment: " + str(e))
+
+        try:
+            await deployments.delete_deployment_file(self.gamespace, deployment)
+        except DeploymentError as e:
+            raise DeliveryError("Failed to remove deployment: " + str(e))
+        except DeploymentNotFound:
+            raise DeliveryError("No such deployment")
+
+        try:
+            await deployments.update_deployment_status(
+                self.gamespace, deployment.deployment_id, DeploymentAdapter.STATUS_DELETED)
+        except DeploymentError as e:
+            raise DeliveryError("Failed to update deployment status: " + str(e))
@@ -1,8 +1,12 @@
 
+from tornado.ioloop import PeriodicCallback
+
 from anthill.common.model import Model
+from anthill.common.options import options
 from anthill.common import database
 
 import ujson
+import logging
 
 
 class GameError(Exception):
@@ -37,6 +41,89 @@ class GameServerAdapter(object):
         self.server_settings = data.get("server_settings", {})
 
 
+class GameServersCache(object):
+    """
+    All of the game servers and their per-version settings, kept in memory.
+
+    The configuration only changes when an admin edits it, so every write drops (or replaces) the affected
+        entries, and `version` goes up so whatever has been derived from the cache can tell it's stale.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.version = 0
+        # game_server_id -> GameServerAdapter
+        self.servers = {}
+        # (gamespace_id, game_name, game_server_name) -> game_server_id
+        self.names = {}
+        # (gamespace_id, game_name, game_version, game_server_id) -> server_settings
+        self.versions = {}
+        # (gamespace_id, game_name, game_version, game_server_id) -> (GameServerAdapter, server_settings)
+        self.resolved = {}
+
+    @staticmethod
+    def version_key(gamespace_id, game_name, game_version, game_server_id):
+        return str(gamespace_id), game_name, game_version, str(game_server_id)
+
+    def load(self, servers, versions):
+        self.servers = {}
+        self.names = {}
+        self.versions = {}
+
+        for server in servers:
+            self.add_server(server)
+
+        for version in versions:
+            self.versions[GameServersCache.version_key(
+                version["gamespace_id"], version["game_name"],
+                version["game_version"], version["game_server_id"])] = version["server_settings"]
+
+        self.loaded = True
+        self.changed()
+
+    def changed(self):
+        self.resolved = {}
+        self.version += 1
+
+    def add_server(self, data):
+        gs = GameServerAdapter(data)
+        game_server_id = str(gs.game_server_id)
+
+        self.servers[game_server_id] = (data["gamespace_id"], gs)
+        self.names[(str(data["gamespace_id"]), gs.game_name, gs.name)] = game_server_id
+
+        return gs
+
+    def remove_server(self, game_server_id, versions=False):
+        entry = self.servers.pop(str(game_server_id), None)
+
+        if entry is not None:
+            gamespace_id, gs = entry
+            self.names.pop((str(gamespace_id), gs.game_name, gs.name), None)
+
+        if not versions:
+            return
+
+        for key in [key for key in self.versions.keys() if key[3] == str(game_server_id)]:
+            del self.versions[key]
+
+    def get_server(self, gamespace_id, game_server_id):
+        entry = self.servers.get(str(game_server_id))
+
+        if entry is None or str(entry[0]) != str(gamespace_id):
+            return None
+
+        return entry[1]
+
+    def find_server(self, gamespace_id, game_name, game_server_name):
+        game_server_id = self.names.get((str(gamespace_id), game_name, game_server_name))
+
+        if game_server_id is None:
+            return None
+
+        return self.get_server(gamespace_id, game_server_id)
+
+
 class GameServersModel(Model):
 
     DEFAULT_SERVER_SCHEME = {
@@ -219,8 +306,137 @@ class GameServersModel(Model):
         "title": "Game configuration"
     }
 
-    def __init__(self, db):
+    def __init__(self, db, bus):
         self.db = db
+        self.bus = bus
+        self.cache = GameServersCache()
+
+        bus.subscribe("gameservers", self.__on_cache_event__, self.__on_cache_reload__)
+
+        if options.gameservers_cache_refresh:
+            self.cache_refresh_callback = PeriodicCallback(
+                self.__reload_cache__, options.gameservers_cache_refresh * 1000)
+        else:
+            self.cache_refresh_callback = None
+
+    async def started(self, application):
+        await super(GameServersModel, self).started(application)
+
+        if self.cache_refresh_callback:
+            await self.__reload_cache__()
+            self.cache_refresh_callback.start()
+
+    async def stopped(self):
+        if self.cache_refresh_callback:
+            self.cache_refresh_callback.stop()
+        await super(GameServersModel, self).stopped()
+
+    async def __reload_cache__(self):
+        version = self.cache.version
+
+        try:
+            servers = await self.db.query(
+                """
+                    SELECT *
+                    FROM `game_servers`
+                """)
+            versions = await self.get_all_versions_settings()
+        except (database.DatabaseError, GameError):
+            logging.exception("Failed to reload game servers cache")
+        else:
+            if self.cache.version != version:
+                # something has changed while loading, and may not be seen in what's loaded; next time then
+                return
+
+            self.cache.load(servers, versions)
+
+    async def __on_cache_reload__(self):
+        if self.cache.loaded:
+            await self.__reload_cache__()
+
+    async def __on_cache_event__(self, event, data):
+        if event == "server_changed":
+            self.__drop_server__(data["game_server_id"], data.get("versions", False))
+        elif event == "version_changed":
+            self.__set_version__(
+                data["gamespace_id"], data["game_name"], data["game_version"],
+                data["game_server_id"], data.get("server_settings"))
+
+    def __drop_server__(self, game_server_id, versions=False):
+        # the server is fetched again on the next request
+        if self.cache.loaded:
+            self.cache.remove_server(game_server_id, versions)
+            self.cache.changed()
+
+    def __set_version__(self, gamespace_id, game_name, game_version, game_server_id, server_settings=None):
+        if not self.cache.loaded:
+            return
+
+        key = GameServersCache.version_key(gamespace_id, game_name, game_version, game_server_id)
+
+        if server_settings is None:
+            self.cache.versions.pop(key, None)
+        else:
+            self.cache.versions[key] = server_settings
+
+        self.cache.changed()
+
+    async def __invalidate_server__(self, game_server_id, versions=False):
+        self.__drop_server__(game_server_id, versions)
+
+        await self.bus.publish("gameservers", "server_changed", {
+            "game_server_id": game_server_id,
+            "versions": versions
+        })
+
+    async def __invalidate_version__(self, gamespace_id, game_name, game_version, game_server_id,
+                                     server_settings=None):
+        self.__set_version__(gamespace_id, game_name, game_version, game_server_id, server_settings)
+
+        await self.bus.publish("gameservers", "version_changed", {
+            "gamespace_id": gamespace_id,
+            "game_name": game_name,
+            "game_version": game_version,
+            "game_server_id": game_server_id,
+            "server_settings": server_settings
+        })
+
+    async def resolve_game_server(self, gamespace_id, game_name, game_version,
+                                  game_server_name=None, game_server_id=None):
+        """
+        Resolves the complete configuration of a game server for a given game version: the game server itself,
+            and its server settings for that version (or the default ones, if the version has none)
+        :returns a (GameServerAdapter, server_settings) tuple; server_settings is None if there are
+            no settings for that version and no default ones either
+        :raises GameServerNotFound
+        """
+
+        # an invalidation may arrive while this is resolved, then what's resolved may be stale already
+        version = self.cache.version
+
+        if game_server_id is None:
+            gs = await self.find_game_server(gamespace_id, game_name, game_server_name)
+            game_server_id = gs.game_server_id
+
+        key = GameServersCache.version_key(gamespace_id, game_name, game_version, game_server_id)
+        resolved = self.cache.resolved.get(key)
+
+        if resolved is not None:
+            return resolved
+
+        gs = await self.get_game_server(gamespace_id, game_name, game_server_id)
+
+        try:
+            server_settings = await self.get_version_game_server(gamespace_id, game_name, game_version, game_server_id)
+        except GameVersionNotFound:
+            server_settings = gs.server_settings
+
+        resolved = (gs, server_settings)
+
+        if self.cache.loaded and self.cache.version == version:
+            self.cache.resolved[key] = resolved
+
+        return resolved
 
     def get_setup_db(self):
         return self.db
@@ -238,6 +454,8 @@ class GameServersModel(Model):
         except database.DatabaseError as e:
             raise GameVersionError("Failed to delete game:" + e.args[1])
 
+        await self.__invalidate_version__(gamespace_id, game_name, game_version, game_server_id)
+
     async def delete_game_server(self, gamespace_id, game_name, game_server_id):
         try:
             await self.db.get(
@@ -257,6 +475,8 @@ class GameServersModel(Model):
         except database.DatabaseError as e:
             raise GameVersionError("Failed to delete game server:" + e.args[1])
 
+        await self.__invalidate_server__(game_server_id, versions=True)
+
     async def get_all_versions_settings(self):
         try:
             result = await self.db.query(
@@ -286,6 +506,13 @@ class GameServersModel(Model):
         return list(map(GameServerAdapter, servers))
 
     async def find_game_server(self, gamespace_id, game_name, game_server_name):
+        gs = self.cache.find_server(gamespace_id, game_name, game_server_name)
+
+        if gs is not None:
+            return gs
+
+        version = self.cache.version
+
         try:
             result = await self.db.get(
                 """
@@ -299,9 +526,20 @@ class GameServersModel(Model):
         if result is None:
             raise GameServerNotFound()
 
+        if self.cache.loaded and self.cache.version == version:
+            # created after the cache has been loaded
+            return self.cache.add_server(result)
+
         return GameServerAdapter(result)
 
     async def get_game_server(self, gamespace_id, game_name, game_server_id):
+        gs = self.cache.get_server(gamespace_id, game_server_id)
+
+        if gs is not None and gs.game_name == game_name:
+            return gs
+
+        version = self.cache.version
+
         try:
             result = await self.db.get(
                 """
@@ -315,9 +553,22 @@ class GameServersModel(Model):
         if result is None:
             raise GameServerNotFound()
 
+        if self.cache.loaded and self.cache.version == version:
+            return self.cache.add_server(result)
+
         return GameServerAdapter(result)
 
     async def get_version_game_server(self, gamespace_id, game_name, game_version, game_server_id):
+        if self.cache.loaded:
+            # every version is in the cache, so a miss means there are no settings for that version
+            server_settings = self.cache.versions.get(
+                GameServersCache.version_key(gamespace_id, game_name, game_version, game_server_id))
+
+            if server_settings is None:
+                raise GameVersionNotFound()
+
+            return server_settings
+
         try:
             result = await self.db.get(
                 """
@@ -365,6 +616,8 @@ class GameServersModel(Model):
         except database.DatabaseError as e:
             raise GameError("Failed to change game settings:" + e.args[1])
 
+        await self.__invalidate_server__(game_server_id)
+
     async def set_version_game_server(self, gamespace_id, game_name, game_version, game_server_id, server_settings):
 
         dump = ujson.dumps(server_settings)
@@ -379,3 +632,5 @@ class GameServersModel(Model):
                 """, game_name, game_version, game_server_id, gamespace_id, dump, dump)
         except database.DatabaseError as e:
             raise GameVersionError("Failed to insert config:" + e.args[1])
+
+        await self.__invalidate_version__(gamespace_id, game_name, game_version, game_server_id, server_settings)
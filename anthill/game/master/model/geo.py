@@ -0,0 +1,213 @@
+
+from tornado.ioloop import PeriodicCallback
+
+from anthill.common.model import Model
+from anthill.common.options import options
+
+from geoip import geolite2, open_database
+from collections import OrderedDict
+
+import ipaddress
+import logging
+import os
+
+
+class GeoEntry(object):
+    __slots__ = ("location", "regions", "regions_version")
+
+    def __init__(self, location):
+        self.location = location
+        self.regions = None
+        self.regions_version = None
+
+
+class GeoModel(Model):
+    """
+    Resolves an IP address into the location, and the location into the list of regions ordered by distance.
+
+    Both are cached together in a bounded LRU, keyed by the network the address belongs to (/24 for IPv4 and /48
+        for IPv6): the addresses of one network are practically always located at the same place, and a single
+        request resolves "ip -> regions" once, no matter how many times it is asked.
+
+    If the geoip_database option is set, that GeoIP database is used instead of the bundled one, and is reopened
+        (with the cache dropped) as soon as the file changes, so it can be updated without a restart.
+    """
+
+    MAINTENANCE_PERIOD = 60
+
+    def __init__(self, app, hosts):
+        self.app = app
+        self.hosts = hosts
+        self.cache = OrderedDict()
+        self.cache_size = options.geoip_cache_size
+
+        self.database = geolite2
+        self.database_mtime = None
+
+        self.hits = 0
+        self.misses = 0
+
+        self.maintenance_callback = PeriodicCallback(self.__maintenance__, GeoModel.MAINTENANCE_PERIOD * 1000)
+
+    async def started(self, application):
+        await super(GeoModel, self).started(application)
+
+        self.__reload_database__()
+        self.maintenance_callback.start()
+
+    async def stopped(self):
+        self.maintenance_callback.stop()
+        await super(GeoModel, self).stopped()
+
+    def __reload_database__(self):
+        path = options.geoip_database
+
+        if not path:
+            return
+
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            logging.error("GeoIP database {0} is not accessible, keeping the current one".format(path))
+            return
+
+        if mtime == self.database_mtime:
+            return
+
+        try:
+            database = open_database(path)
+        except (IOError, ValueError):
+            logging.exception("Failed to open GeoIP database {0}, keeping the current one".format(path))
+            return
+
+        self.database = database
+        self.database_mtime = mtime
+        self.cache.clear()
+
+        logging.info("GeoIP database {0} loaded".format(path))
+
+    async def __maintenance__(self):
+        self.__reload_database__()
+
+        total = self.hits + self.misses
+
+        self.app.monitor_action(
+            "geoip_cache",
+            values={
+                "hits": float(self.hits),
+                "misses": float(self.misses),
+                "hit_rate": float(self.hits) / total if total else 0.0,
+                "size": float(len(self.cache))
+            })
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def network(ip):
+        """
+        :returns a key of the network the ip belongs to, or None if the ip is malformed
+        """
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+
+        if address.version == 4:
+            return address.packed[:3]
+
+        return address.packed[:6]
+
+    def __entry__(self, ip):
+        key = GeoModel.network(ip)
+
+        if key is None:
+            return None
+
+        entry = self.cache.get(key)
+
+        if entry is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+
+        try:
+            geo = self.database.lookup(ip)
+        except ValueError:
+            geo = None
+
+        entry = GeoEntry(geo.location if geo else None)
+
+        self.cache[key] = entry
+
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return entry
+
+    def get_location(self, ip):
+        """
+        :returns a (lat, long) tuple, or None if the location of the ip is unknown
+        """
+        if not ip:
+            return None
+
+        entry = self.__entry__(ip)
+
+        if entry is None:
+            return None
+
+        return entry.location
+
+    async def list_closest_regions(self, ip):
+        """
+        :returns a list of the regions, the closest to the ip first, or None if the location of the ip is unknown
+        """
+        if not ip:
+            return None
+
+        entry = self.__entry__(ip)
+
+        if entry is None or entry.location is None:
+            return None
+
+        cache = await self.hosts.get_regions_cache()
+
+        if entry.regions_version != cache.version:
+            p_lat, p_long = entry.location
+            entry.regions = cache.rank(p_long, p_lat)
+            entry.regions_version = cache.version
+
+        return entry.regions
+
+    async def get_closest_region(self, ip):
+        """
+        :returns the closest region to the ip, or None if the location of the ip is unknown
+        """
+        regions = await self.list_closest_regions(ip)
+        return regions[0] if regions else None
+
+    async def rank_regions(self, ips):
+        """
+        Ranks the regions for many IP addresses at once
+        :returns a dict of ip -> list of regions, the closest first; an ip with unknown location
+            gets the default region first, then the rest in the order of ids
+        """
+
+        result = {}
+        fallback = None
+
+        for ip in ips:
+            regions = await self.list_closest_regions(ip)
+
+            if regions is None:
+                if fallback is None:
+                    cache = await self.hosts.get_regions_cache()
+                    fallback = sorted(cache.regions, key=lambda r: (not r.default, int(r.region_id)))
+                regions = fallback
+
+            result[ip] = regions
+
+        return result
@@ -1,9 +1,17 @@
 
+
+from tornado.ioloop import PeriodicCallback
+
 from anthill.common import database
 from anthill.common.model import Model
+from anthill.common.options import options
 from anthill.common.validate import validate
 
 import ujson
+import logging
+import random
+import math
+import time
 
 
 class HostError(Exception):
@@ -30,6 +38,10 @@ class HostNotFound(Exception):
     pass
 
 
+class HostOvercommitted(Exception):
+    pass
+
+
 class HostAdapter(object):
     def __init__(self, data):
         self.host_id = str(data.get("host_id"))
@@ -57,9 +69,440 @@ class RegionAdapter(object):
         self.geo_location = tuple((data.get("region_location_x", 0), data.get("region_location_y", 0)))
 
 
+class RegionsCache(object):
+    """
+    The regions table is tiny and almost never changes, so it is kept in memory entirely, along with the
+        coordinates of each region prepared for the haversine formula. Ranking the regions by distance
+        is then a single pass over a few floats instead of ST_Distance_Sphere over the table.
+
+    The cache is invalidated by every write made by this instance, and expires after TTL seconds
+        to pick up the writes made by the others.
+    """
+
+    TTL = 60
+
+    def __init__(self):
+        self.regions = None
+        # a list of (region, latitude in radians, longitude in radians, cosine of the latitude)
+        self.points = []
+        self.loaded_at = 0
+        # changes every time the regions are reloaded, so the ones computed out of them can be invalidated
+        self.version = 0
+
+    def valid(self):
+        return self.regions is not None and self.loaded_at + RegionsCache.TTL > time.time()
+
+    def load(self, regions):
+        self.regions = regions
+        self.points = []
+
+        for region in regions:
+            p_long, p_lat = region.geo_location
+            lat = math.radians(p_lat or 0)
+            self.points.append((region, lat, math.radians(p_long or 0), math.cos(lat)))
+
+        self.loaded_at = time.time()
+        self.version += 1
+
+    def invalidate(self):
+        self.regions = None
+        self.points = []
+
+    def default(self):
+        for region in self.regions:
+            if region.default:
+                return region
+
+        return None
+
+    def rank(self, p_long, p_lat):
+        """
+        :returns a list of regions, the closest to the point first
+        """
+
+        lat = math.radians(p_lat)
+        lon = math.radians(p_long)
+        cos_lat = math.cos(lat)
+
+        def distance(point):
+            region, region_lat, region_lon, region_cos_lat = point
+
+            # the haversine of the central angle, which grows along with the distance itself,
+            #   so there is no need to go any further for ordering
+            return (math.sin((region_lat - lat) / 2.0) ** 2 +
+                    cos_lat * region_cos_lat * math.sin((region_lon - lon) / 2.0) ** 2), int(region.region_id)
+
+        return [point[0] for point in sorted(self.points, key=distance)]
+
+
+class HostCapacity(object):
+    """
+    What is known about the capacity of a host, out of its heartbeats.
+
+    The cost of a room is the load it adds on top of whatever the host takes by itself, so it is estimated
+        at the margin: out of the load at 0 rooms (the baseline) when it has been seen, or out of how much the load
+        has changed along with the amount of rooms between two heartbeats otherwise. Dividing the whole load
+        by the amount of rooms would charge the baseline to the rooms, and a host with a single room would be
+        rated as full.
+    """
+
+    # weight of the latest observation in the running average of the cost of a room
+    COST_WEIGHT = 0.3
+
+    # bounds (in percents) of the cost of a room, as the load reported is noisy
+    MIN_ROOM_COST = 0.1
+    MAX_ROOM_COST = 25.0
+
+    def __init__(self):
+        self.rooms = 0
+        # free ports, as reported by the host, None if the host does not report them
+        self.ports = None
+        # observed memory and cpu (in percents) a single room takes, None until there is a room to observe
+        self.room_memory = None
+        self.room_cpu = None
+        # memory and cpu the host has been seen at with no rooms, None if never seen
+        self.baseline_memory = None
+        self.baseline_cpu = None
+        # the previous (rooms, memory, cpu) observation, None if there was none
+        self.last = None
+
+    def observe(self, memory, cpu, rooms, ports):
+        self.ports = ports
+
+        if rooms is None:
+            return
+
+        memory = float(memory)
+        cpu = float(cpu)
+        last = self.last
+
+        self.rooms = rooms
+        self.last = (rooms, memory, cpu)
+
+        if rooms == 0:
+            self.baseline_memory = memory
+            self.baseline_cpu = cpu
+            return
+
+        if self.baseline_memory is not None:
+            room_memory = (memory - self.baseline_memory) / rooms
+            room_cpu = (cpu - self.baseline_cpu) / rooms
+        elif last is not None and last[0] != rooms:
+            last_rooms, last_memory, last_cpu = last
+            room_memory = (memory - last_memory) / (rooms - last_rooms)
+            room_cpu = (cpu - last_cpu) / (rooms - last_rooms)
+        else:
+            # nothing to tell the rooms from the host itself yet
+            return
+
+        self.room_memory = HostCapacity.__average__(self.room_memory, HostCapacity.__clamp__(room_memory))
+        self.room_cpu = HostCapacity.__average__(self.room_cpu, HostCapacity.__clamp__(room_cpu))
+
+    @staticmethod
+    def __clamp__(cost):
+        return min(max(cost, HostCapacity.MIN_ROOM_COST), HostCapacity.MAX_ROOM_COST)
+
+    @staticmethod
+    def __average__(current, observed):
+        if current is None:
+            return observed
+        return current + (observed - current) * HostCapacity.COST_WEIGHT
+
+
+class HostRegistry(object):
+    """
+    In-memory view of the hosts, used to place new rooms without asking the database.
+
+    Hosts report their load once per heartbeat only, so the registry also counts the spawns that were placed on
+        a host but are not reflected in its load yet: the ones still in flight, and the ones completed since the
+        last heartbeat. Together with the cost of a room observed on that host, this is what the host is expected
+        to run at, and a host that would go above the limits is not offered at all.
+    """
+
+    # a spawn that has not been reported to finish for that long is considered lost
+    SPAWN_TIMEOUT = 90
+
+    def __init__(self):
+        self.hosts = {}
+        self.capacity = {}
+        # host_id -> a list of [deadline, ports] of the spawns in flight
+        self.spawning = {}
+        # host_id -> a list of ports of the spawns completed since the last heartbeat
+        self.spawned = {}
+        self.loaded = False
+
+    def load(self, hosts):
+        self.hosts = {
+            host.host_id: host
+            for host in hosts
+        }
+        self.loaded = True
+
+    def get(self, host_id):
+        return self.hosts.get(str(host_id))
+
+    def get_capacity(self, host_id):
+        host_id = str(host_id)
+        capacity = self.capacity.get(host_id)
+
+        if capacity is None:
+            capacity = HostCapacity()
+            self.capacity[host_id] = capacity
+
+        return capacity
+
+    def add(self, host):
+        self.hosts[host.host_id] = host
+
+    def remove(self, host_id):
+        host_id = str(host_id)
+        self.hosts.pop(host_id, None)
+        self.capacity.pop(host_id, None)
+        self.spawning.pop(host_id, None)
+        self.spawned.pop(host_id, None)
+
+    def __pending__(self, host_id):
+        """
+        :returns a list of ports taken by every spawn not reflected by the host's load yet
+        """
+        spawning = self.spawning.get(host_id)
+
+        if spawning:
+            now = time.time()
+            spawning[:] = [spawn for spawn in spawning if spawn[0] > now]
+
+        return [spawn[1] for spawn in spawning or []] + self.spawned.get(host_id, [])
+
+    def pending(self, host_id):
+        return len(self.__pending__(host_id))
+
+    def projected(self, host, extra=0):
+        """
+        :returns a (memory, cpu, ports) tuple the host is expected to be at, once the pending spawns
+            and `extra` more rooms are up; ports is None if the host does not report them
+        """
+        pending = self.__pending__(host.host_id)
+        capacity = self.get_capacity(host.host_id)
+        rooms = len(pending) + extra
+
+        room_memory = capacity.room_memory
+        room_cpu = capacity.room_cpu
+
+        if room_memory is None:
+            room_memory = options.hosts_spawn_cost
+        if room_cpu is None:
+            room_cpu = options.hosts_spawn_cost
+
+        if capacity.ports is None:
+            ports = None
+        else:
+            ports = capacity.ports - sum(pending)
+
+        return host.memory + rooms * room_memory, host.cpu + rooms * room_cpu, ports
+
+    def effective_load(self, host):
+        memory, cpu, ports = self.projected(host)
+        return max(memory, cpu)
+
+    def fits(self, host, ports=1, extra=1):
+        memory, cpu, free_ports = self.projected(host, extra)
+
+        if memory > options.hosts_memory_limit or cpu > options.hosts_cpu_limit:
+            return False
+
+        if free_ports is not None and free_ports < ports * extra:
+            return False
+
+        return True
+
+    def spawn_started(self, host_id, ports=1):
+        self.spawning.setdefault(str(host_id), []).append([time.time() + HostRegistry.SPAWN_TIMEOUT, ports])
+
+    def spawn_finished(self, host_id, success=True):
+        host_id = str(host_id)
+        spawning = self.spawning.get(host_id)
+
+        if not spawning:
+            return
+
+        deadline, ports = spawning.pop(0)
+
+        if success:
+            self.spawned.setdefault(host_id, []).append(ports)
+
+    def heartbeat(self, host_id, memory, cpu, storage, state, rooms=None, ports=None):
+        host_id = str(host_id)
+        host = self.hosts.get(host_id)
+
+        if host:
+            host.memory = int(memory)
+            host.cpu = int(cpu)
+            host.storage = int(storage)
+            host.load = int(max(memory, cpu))
+
+        self.update_state(host_id, state)
+        self.get_capacity(host_id).observe(memory, cpu, rooms, ports)
+        # whatever was spawned is the part of the reported load now
+        self.spawned.pop(host_id, None)
+
+    def update_state(self, host_id, state):
+        host = self.hosts.get(str(host_id))
+
+        if host:
+            host.state = state
+            host.active = state in ["ACTIVE", "OVERLOAD"]
+
+    def update_enabled(self, host_id, enabled):
+        host = self.hosts.get(str(host_id))
+
+        if host:
+            host.enabled = bool(enabled)
+
+    def candidates(self, region_id, ports=1, delivered=None):
+        region_id = str(region_id)
+
+        return [
+            host
+            for host in self.hosts.values()
+            if host.region_id == region_id and host.enabled and host.state == "ACTIVE" and
+            (delivered is None or host.host_id in delivered) and self.fits(host, ports)
+        ]
+
+    def pick(self, region_id, ports=1, delivered=None):
+        """
+        Picks a host with enough capacity for one more room, according to the hosts_placement option:
+
+        p2c: out of two random hosts of the region, the less loaded one wins. Unlike always picking the least
+            loaded host, concurrent placements (including the ones made by other instances) spread across the
+            hosts instead of piling up on a single one.
+        best_fit: the most loaded host that still fits, so the rooms are packed onto as few hosts as possible,
+            leaving the others free for the bigger game servers (or to scale down).
+
+        :param delivered: if set, a set of the host ids, only the hosts in it are picked
+        :returns a HostAdapter or None if there are no hosts available
+        """
+
+        hosts = self.candidates(region_id, ports, delivered)
+
+        if not hosts:
+            return None
+
+        if len(hosts) == 1:
+            return hosts[0]
+
+        if options.hosts_placement == "best_fit":
+            return max(hosts, key=self.effective_load)
+
+        return min(random.sample(hosts, 2), key=self.effective_load)
+
+
 class HostsModel(Model):
-    def __init__(self, db):
+    def __init__(self, db, bus):
         self.db = db
+        self.bus = bus
+        self.registry = HostRegistry()
+        self.regions_cache = RegionsCache()
+
+        bus.subscribe("hosts", self.__on_hosts_event__, self.__reload_caches__)
+
+        if options.hosts_registry_refresh:
+            self.registry_refresh_callback = PeriodicCallback(
+                self.__refresh_registry__, options.hosts_registry_refresh * 1000)
+        else:
+            self.registry_refresh_callback = None
+
+    async def started(self, application):
+        await super(HostsModel, self).started(application)
+
+        if self.registry_refresh_callback:
+            await self.__refresh_registry__()
+            self.registry_refresh_callback.start()
+
+    async def stopped(self):
+        if self.registry_refresh_callback:
+            self.registry_refresh_callback.stop()
+        await super(HostsModel, self).stopped()
+
+    async def __refresh_registry__(self):
+        # the hosts connected to other instances report their load there, so the registry is refreshed
+        #   from time to time
+        try:
+            hosts = await self.list_hosts()
+        except HostError:
+            logging.exception("Failed to refresh hosts registry")
+        else:
+            self.registry.load(hosts)
+
+    @staticmethod
+    def spawn_ports(game_settings):
+        if not game_settings:
+            return 1
+
+        try:
+            return max(int(game_settings.get("ports", 1)), 1)
+        except (TypeError, ValueError):
+            return 1
+
+    def check_capacity(self, host):
+        """
+        Makes sure the host still can take a room that has been placed onto it with get_best_host
+            (the host might have reported a higher load in between)
+        :raises HostOvercommitted if it cannot
+        """
+
+        if not self.registry.loaded:
+            return
+
+        known = self.registry.get(host.host_id)
+
+        if known is None:
+            return
+
+        if known.state != "ACTIVE" or not self.registry.fits(known, extra=0):
+            raise HostOvercommitted()
+
+    def spawn_finished(self, host_id, success=True):
+        self.registry.spawn_finished(host_id, success)
+
+    async def __reload_caches__(self):
+        self.regions_cache.invalidate()
+
+        if self.registry.loaded:
+            await self.__refresh_registry__()
+
+    async def __on_hosts_event__(self, event, data):
+        if event == "regions_changed":
+            self.regions_cache.invalidate()
+            return
+
+        if not self.registry.loaded:
+            return
+
+        if event == "host_load":
+            self.registry.heartbeat(
+                data["host_id"], data["memory"], data["cpu"], data["storage"], data["state"],
+                data.get("rooms"), data.get("ports"))
+        elif event == "host_state":
+            self.registry.update_state(data["host_id"], data["state"])
+        elif event == "host_enabled":
+            self.registry.update_enabled(data["host_id"], data["enabled"])
+        elif event == "host_added":
+            self.registry.add(HostsModel.__new_host_adapter__(
+                data["host_id"], data["address"], data["region"], data["enabled"]))
+        elif event == "host_removed":
+            self.registry.remove(data["host_id"])
+
+    @staticmethod
+    def __new_host_adapter__(host_id, address, region, enabled):
+        return HostAdapter({
+            "host_id": host_id,
+            "host_address": address,
+            "host_region": region,
+            "host_enabled": int(bool(enabled)),
+            "host_memory": 0,
+            "host_cpu": 0,
+            "host_storage": 0
+        })
 
     def get_setup_db(self):
         return self.db
@@ -67,6 +510,15 @@ class HostsModel(Model):
     def get_setup_tables(self):
         return ["regions", "hosts"]
 
+    async def get_regions_cache(self):
+        """
+        :returns a RegionsCache, loaded if needed
+        """
+        if not self.regions_cache.valid():
+            self.regions_cache.load(await self.__list_regions__())
+
+        return self.regions_cache
+
     async def setup_table_regions(self):
         await self.new_region("local", True, {})
 
@@ -83,6 +535,8 @@ class HostsModel(Model):
         except database.DatabaseError as e:
             raise RegionError("Failed to create a region: " + e.args[1])
         else:
+            self.regions_cache.invalidate()
+            await self.bus.publish("hosts", "regions_changed")
             return region_id
 
     async def get_region(self, region_id):
@@ -126,16 +580,36 @@ class HostsModel(Model):
 
         return RegionAdapter(region)
 
-    async def get_best_host(self, region_id):
+    async def get_best_host(self, region_id, game_settings=None, delivered=None):
+        """
+        Picks a host to spawn a new room on. Once the host is picked, the spawn (and the ports it takes)
+            is accounted as in flight until spawn_finished is called.
+        :param game_settings: settings of the game server to be spawned, used to find out its cost
+        :param delivered: the hosts the deployment of the room is delivered to, see DeploymentModel.get_delivered_hosts;
+            a host the deployment is not delivered to (or is still being delivered to) is never picked, as the spawn
+            would fail there, after the spawn timeout
+        """
+
+        if self.registry.loaded:
+            ports = HostsModel.spawn_ports(game_settings)
+            host = self.registry.pick(region_id, ports, delivered)
+
+            if host is None:
+                raise HostNotFound()
+
+            self.registry.spawn_started(host.host_id, ports)
+            return host
+
         try:
             host = await self.db.get(
                 """
                 SELECT *
                 FROM `hosts`
-                WHERE `host_region`=%s AND `host_enabled`=1 AND `host_state`='ACTIVE'
+                WHERE `host_region`=%s AND `host_enabled`=1 AND `host_state`='ACTIVE' AND
+                    (%s OR `host_id` IN %s)
                 ORDER BY `host_load` ASC
                 LIMIT 1;
-                """, region_id
+                """, region_id, delivered is None, list(delivered) if delivered else [0]
             )
         except database.DatabaseError as e:
             raise HostError("Failed to get host: " + e.args[1])
@@ -146,44 +620,23 @@ class HostsModel(Model):
         return HostAdapter(host)
 
     async def get_closest_region(self, p_long, p_lat):
-        try:
-            region = await self.db.get(
-                """
-                SELECT *,
-                    ST_X(`region_location`) AS `region_location_x`,
-                    ST_Y(`region_location`) AS `region_location_y`,
-                    ST_Distance_Sphere(`region_location`, point(%s, %s)) AS distance
-                FROM `regions`
-                ORDER BY distance ASC
-                LIMIT 1;
-                """, p_long, p_lat
-            )
-        except database.DatabaseError as e:
-            raise RegionError("Failed to get closest region: " + e.args[1])
+        cache = await self.get_regions_cache()
+        regions = cache.rank(p_long, p_lat)
 
-        if region is None:
+        if not regions:
             raise RegionNotFound()
 
-        return RegionAdapter(region)
+        return regions[0]
 
     async def list_closest_regions(self, p_long, p_lat):
-        try:
-            hosts = await self.db.query(
-                """
-                SELECT *,
-                    ST_X(`region_location`) AS `region_location_x`,
-                    ST_Y(`region_location`) AS `region_location_y`,
-                    ST_Distance_Sphere(`region_location`, point(%s, %s)) AS distance
-                FROM `regions`
-                ORDER BY distance ASC;
-                """, p_long, p_lat
-            )
-        except database.DatabaseError as e:
-            raise RegionError("Failed to get server: " + e.args[1])
-
-        return list(map(RegionAdapter, hosts))
+        cache = await self.get_regions_cache()
+        return cache.rank(p_long, p_lat)
 
     async def list_regions(self):
+        cache = await self.get_regions_cache()
+        return list(cache.regions)
+
+    async def __list_regions__(self):
         try:
             regions = await self.db.query(
                 """
@@ -199,24 +652,13 @@ class HostsModel(Model):
         return list(map(RegionAdapter, regions))
 
     async def get_default_region(self):
-        try:
-            region = await self.db.get(
-                """
-                SELECT *,
-                    ST_X(`region_location`) AS `region_location_x`,
-                    ST_Y(`region_location`) AS `region_location_y`
-                FROM `regions`
-                WHERE `region_default`=1
-                LIMIT 1;
-                """
-            )
-        except database.DatabaseError as e:
-            raise HostError("Failed to get server: " + e.args[1])
+        cache = await self.get_regions_cache()
+        region = cache.default()
 
         if region is None:
             raise RegionNotFound()
 
-        return RegionAdapter(region)
+        return region
 
     @validate(region_id="int", name="str_name", default="bool", setting="json")
     async def update_region(self, region_id, name, default, settings):
@@ -231,6 +673,9 @@ class HostsModel(Model):
         except database.DatabaseError as e:
             raise RegionError("Failed to update region: " + e.args[1])
 
+        self.regions_cache.invalidate()
+        await self.bus.publish("hosts", "regions_changed")
+
     async def update_region_geo_location(self, region_id, p_long, p_lat):
         try:
             await self.db.execute(
@@ -243,6 +688,9 @@ class HostsModel(Model):
         except database.DatabaseError as e:
             raise HostError("Failed to update host geo location: " + e.args[1])
 
+        self.regions_cache.invalidate()
+        await self.bus.publish("hosts", "regions_changed")
+
     async def delete_region(self, region_id):
         try:
             await self.db.execute(
@@ -256,6 +704,9 @@ class HostsModel(Model):
         except database.DatabaseError as e:
             raise RegionError("Failed to delete a region: " + e.args[1])
 
+        self.regions_cache.invalidate()
+        await self.bus.publish("hosts", "regions_changed")
+
     async def new_host(self, address, region, enabled=True):
 
         try:
@@ -269,6 +720,15 @@ class HostsModel(Model):
         except database.DatabaseError as e:
             raise HostError("Failed to create a host: " + e.args[1])
         else:
+            self.registry.add(HostsModel.__new_host_adapter__(host_id, address, region, enabled))
+
+            await self.bus.publish("hosts", "host_added", {
+                "host_id": host_id,
+                "address": address,
+                "region": region,
+                "enabled": bool(enabled)
+            })
+
             return host_id
 
     async def update_host(self, host_id, enabled):
@@ -283,7 +743,18 @@ class HostsModel(Model):
         except database.DatabaseError as e:
             raise HostError("Failed to update host: " + e.args[1])
 
-    async def update_host_load(self, host_id, memory, cpu, storage, state='ACTIVE', db=None):
+        self.registry.update_enabled(host_id, enabled)
+
+        await self.bus.publish("hosts", "host_enabled", {
+            "host_id": host_id,
+            "enabled": bool(enabled)
+        })
+
+    async def update_host_load(self, host_id, memory, cpu, storage, state='ACTIVE', db=None, rooms=None, ports=None):
+        """
+        :param rooms: amount of rooms the host runs, if known
+        :param ports: amount of free ports the host has, if reported
+        """
 
         total_load = max(memory, cpu) / 100.0
 
@@ -299,6 +770,18 @@ class HostsModel(Model):
         except database.DatabaseError as e:
             raise HostError("Failed to update host load: " + e.args[1])
 
+        self.registry.heartbeat(host_id, memory, cpu, storage, state, rooms, ports)
+
+        await self.bus.publish("hosts", "host_load", {
+            "host_id": host_id,
+            "memory": memory,
+            "cpu": cpu,
+            "storage": storage,
+            "state": state,
+            "rooms": rooms,
+            "ports": ports
+        })
+
     async def update_host_state(self, host_id, state, db=None):
 
         try:
@@ -311,6 +794,13 @@ class HostsModel(Model):
         except database.DatabaseError as e:
             raise HostError("Failed to update host state: " + e.args[1])
 
+        self.registry.update_state(host_id, state)
+
+        await self.bus.publish("hosts", "host_state", {
+            "host_id": host_id,
+            "state": state
+        })
+
     async def find_host(self, host_address):
         try:
             host = await self.db.get(
@@ -391,3 +881,9 @@ class HostsModel(Model):
             )
         except database.DatabaseError as e:
             raise HostError("Failed to delete a server: " + e.args[1])
+
+        self.registry.remove(host_id)
+
+        await self.bus.publish("hosts", "host_removed", {
+            "host_id": host_id
+        })
@@ -0,0 +1,370 @@
+
+import operator
+import time
+import ujson
+import re
+
+
+class FilterUnsupported(Exception):
+    pass
+
+
+class RoomFilter(object):
+    """
+    In-memory counterpart of database.format_conditions_json. Filters are defined like so:
+        {"filterA": 5, "filterB": true, "filterC": {"@func": ">", "@value": 10}, "filterD": [1, 2]}
+
+    A room matches exactly when the SQL made out of the same filters would match its settings:
+        - "=" (and a plain value) compares the unquoted text of the setting with the text of the value,
+          the way MySQL compares strings (case-insensitively), a plain true/false is "true"/"false";
+        - ">", "<", ">=", "<=", "!=" and "between" compare the unquoted text of the setting converted to a number,
+          the way MySQL converts a string in a numeric context ("12abc" is 12, "abc" is 0);
+        - "in" (and a plain list) compares the JSON value of the setting with each of the values:
+          a string only matches a string, and a number only matches a number (true is 1 there);
+        - a setting that is not there never matches.
+
+    Anything this class cannot express (the nested settings a dotted key refers to), or a filter the database
+        would reject, raises FilterUnsupported, so the caller can fall back to the database.
+    The match is only a hint: the final slot claim checks the same conditions in MySQL again.
+    """
+
+    NUMERIC = {
+        ">": operator.gt,
+        ">=": operator.ge,
+        "<": operator.lt,
+        "<=": operator.le,
+        "!=": operator.ne
+    }
+
+    # the longest prefix of a string MySQL takes for a number in a numeric context
+    NUMBER_PREFIX = re.compile(r"^\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?")
+
+    # a setting that is not there at all, unlike the one that is null
+    MISSING = object()
+
+    def __init__(self, filters):
+        self.checks = []
+
+        if not filters:
+            return
+
+        if not isinstance(filters, dict):
+            raise FilterUnsupported()
+
+        for key, condition in filters.items():
+            if not isinstance(key, str) or "." in key or '"' in key:
+                raise FilterUnsupported()
+
+            self.checks.append((key, RoomFilter.__check__(condition)))
+
+    @staticmethod
+    def __number__(value):
+        return isinstance(value, (int, float))
+
+    @staticmethod
+    def __check__(condition):
+        if isinstance(condition, bool):
+            return RoomFilter.__equal__("true" if condition else "false")
+
+        if isinstance(condition, (str, int, float)):
+            return RoomFilter.__equal__(condition)
+
+        if isinstance(condition, list):
+            return RoomFilter.__in__(condition)
+
+        if not isinstance(condition, dict) or "@func" not in condition:
+            raise FilterUnsupported()
+
+        func = condition["@func"]
+
+        if func == "=":
+            if "@value" not in condition or not isinstance(condition["@value"], (str, int, float, bool)):
+                raise FilterUnsupported()
+
+            return RoomFilter.__equal__(condition["@value"])
+
+        if func == "in":
+            return RoomFilter.__in__(condition.get("@values"))
+
+        if func == "between":
+            a, b = condition.get("@a"), condition.get("@b")
+
+            if not RoomFilter.__number__(a) or not RoomFilter.__number__(b):
+                raise FilterUnsupported()
+
+            return lambda value: a <= RoomFilter.__to_number__(value) <= b
+
+        op = RoomFilter.NUMERIC.get(func)
+
+        if op is None or not RoomFilter.__number__(condition.get("@value")):
+            raise FilterUnsupported()
+
+        expected = condition["@value"]
+        return lambda value: op(RoomFilter.__to_number__(value), expected)
+
+    @staticmethod
+    def __equal__(expected):
+        # much like the SQL does, with str() of the value
+        expected = str(expected).casefold()
+        return lambda value: RoomFilter.__to_text__(value).casefold() == expected
+
+    @staticmethod
+    def __in__(values):
+        if not isinstance(values, list) or not values:
+            raise FilterUnsupported()
+
+        strings = set()
+        numbers = set()
+
+        for value in values:
+            if isinstance(value, str):
+                strings.add(value)
+            elif isinstance(value, (int, float)):
+                # a bool is passed to MySQL as 1 or 0
+                numbers.add(float(value))
+            else:
+                raise FilterUnsupported()
+
+        def check(value):
+            if isinstance(value, str):
+                return value in strings
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return float(value) in numbers
+            return False
+
+        return check
+
+    @staticmethod
+    def __to_text__(value):
+        """
+        :returns what JSON_UNQUOTE(JSON_EXTRACT(...)) gives out of the value
+        """
+        if isinstance(value, str):
+            return value
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if value is None:
+            return "null"
+        if isinstance(value, (int, float)):
+            return str(value)
+        return RoomFilter.__to_json__(value)
+
+    @staticmethod
+    def __to_json__(value):
+        """
+        Renders the value the way MySQL prints a JSON document: the keys of an object are sorted by length first
+        """
+        if isinstance(value, dict):
+            return "{" + ", ".join(
+                ujson.dumps(key, ensure_ascii=False, escape_forward_slashes=False) + ": " +
+                RoomFilter.__to_json__(value[key])
+                for key in sorted(value.keys(), key=lambda k: (len(k.encode("utf-8")), k))) + "}"
+        if isinstance(value, list):
+            return "[" + ", ".join(RoomFilter.__to_json__(item) for item in value) + "]"
+        return ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False)
+
+    @staticmethod
+    def __to_number__(value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+
+        number = RoomFilter.NUMBER_PREFIX.match(RoomFilter.__to_text__(value))
+        return float(number.group(0)) if number else 0.0
+
+    def match(self, settings):
+        if not isinstance(settings, dict):
+            settings = {}
+
+        for key, check in self.checks:
+            value = settings.get(key, RoomFilter.MISSING)
+
+            # a missing key is NULL in terms of MySQL, and NULL never matches
+            if value is RoomFilter.MISSING:
+                return False
+
+            if not check(value):
+                return False
+
+        return True
+
+
+class IndexedRoom(object):
+    __slots__ = ("room", "region_id", "host_active")
+
+    def __init__(self, room, region_id, host_active=True):
+        self.room = room
+        self.region_id = str(region_id)
+        self.host_active = host_active
+
+    def free_slots(self):
+        return self.room.max_players - self.room.players
+
+
+class RoomIndex(object):
+    """
+    A per-(gamespace, game_name, game_version, game_server_id) index of the rooms that still have free slots.
+
+    The index is a cache of the `rooms` table and never the source of truth: every node keeps its own copy,
+        refreshes the keys that are actually being searched, and the slot claim itself is a conditional write
+        that fails on a stale entry. So several game-master nodes can search their own index concurrently.
+    """
+
+    def __init__(self, key_ttl=60):
+        self.key_ttl = key_ttl
+        # key -> {region_id -> {room_id -> IndexedRoom}}
+        self.keys = {}
+        # room_id -> key
+        self.rooms = {}
+        # key -> last time the key has been searched
+        self.touched = {}
+
+    @staticmethod
+    def key(gamespace, game_name, game_version, game_server_id):
+        return str(gamespace), game_name, game_version, str(game_server_id)
+
+    def has(self, key):
+        return key in self.keys
+
+    def touch(self, key):
+        self.touched[key] = time.time()
+
+    def active_keys(self):
+        """
+        Returns the keys searched recently, and forgets about the others
+        """
+        deadline = time.time() - self.key_ttl
+
+        for key, last_used in list(self.touched.items()):
+            if last_used < deadline:
+                self.drop_key(key)
+
+        return list(self.keys.keys())
+
+    def drop_key(self, key):
+        regions = self.keys.pop(key, None)
+        self.touched.pop(key, None)
+
+        if regions:
+            for region_rooms in regions.values():
+                for room_id in region_rooms.keys():
+                    self.rooms.pop(room_id, None)
+
+    def reset(self, key, entries):
+        """
+        Replaces the whole content of the key with a fresh list of IndexedRoom
+        """
+        old = self.keys.get(key)
+
+        if old:
+            for region_rooms in old.values():
+                for room_id in region_rooms.keys():
+                    self.rooms.pop(room_id, None)
+
+        regions = {}
+
+        for entry in entries:
+            regions.setdefault(entry.region_id, {})[entry.room.room_id] = entry
+            self.rooms[entry.room.room_id] = key
+
+        self.keys[key] = regions
+
+    def add(self, key, entry):
+        regions = self.keys.get(key)
+
+        # nobody searches this key, no reason to track it
+        if regions is None:
+            return
+
+        regions.setdefault(entry.region_id, {})[entry.room.room_id] = entry
+        self.rooms[entry.room.room_id] = key
+
+    def get(self, room_id):
+        key = self.rooms.get(str(room_id))
+
+        if key is None:
+            return None
+
+        for region_rooms in self.keys.get(key, {}).values():
+            entry = region_rooms.get(str(room_id))
+            if entry:
+                return entry
+
+        return None
+
+    def remove(self, room_id):
+        room_id = str(room_id)
+        key = self.rooms.pop(room_id, None)
+
+        if key is None:
+            return
+
+        for region_rooms in self.keys.get(key, {}).values():
+            region_rooms.pop(room_id, None)
+
+    def remove_host(self, host_id, except_rooms=None):
+        host_id = str(host_id)
+        keep = set(map(str, except_rooms)) if except_rooms else set()
+
+        for regions in self.keys.values():
+            for region_rooms in regions.values():
+                for room_id, entry in list(region_rooms.items()):
+                    if entry.room.host_id == host_id and room_id not in keep:
+                        del region_rooms[room_id]
+                        self.rooms.pop(room_id, None)
+
+    def update_players(self, room_id, amount):
+        entry = self.get(room_id)
+
+        if entry:
+            entry.room.players = max(entry.room.players + amount, 0)
+
+    def update_settings(self, room_id, settings):
+        entry = self.get(room_id)
+
+        if entry:
+            entry.room.room_settings = settings
+
+    def candidates(self, key, room_filter, slots=1, regions_order=None, region_id=None, limit=8):
+        """
+        Returns up to `limit` rooms matching the filter, ordered the same way RoomQuery does:
+            by the order of the regions, then by room id
+        """
+        regions = self.keys.get(key)
+        result = []
+
+        if not regions:
+            return result
+
+        if region_id is not None:
+            order = [str(region_id)]
+        elif regions_order:
+            order = [str(r) for r in regions_order]
+            # much like FIELD() does, the regions not in the list go first
+            order = [r for r in regions.keys() if r not in order] + order
+        else:
+            order = sorted(regions.keys(), key=int)
+
+        for region in order:
+            region_rooms = regions.get(region)
+
+            if not region_rooms:
+                continue
+
+            for room_id in sorted(region_rooms.keys(), key=int):
+                entry = region_rooms[room_id]
+
+                if not entry.host_active:
+                    continue
+
+                if entry.free_slots() < slots:
+                    continue
+
+                if not room_filter.match(entry.room.room_settings):
+                    continue
+
+                result.append(entry)
+
+                if len(result) >= limit:
+                    return result
+
+        return result
@@ -13,10 +13,11 @@ from anthill.common import Enum, Flags
 
 from pika.exceptions import ChannelClosed
 
-from .gameserver import GameServerNotFound, GameVersionNotFound
-from .deploy import NoCurrentDeployment
+from .gameserver import GameServerNotFound
+from .deploy import NoCurrentDeployment, DeploymentDeliveryError
 from .host import HostNotFound
 from .room import RoomError, RoomNotFound
+from .ban import BanError
 
 import ujson
 import logging
@@ -241,54 +242,58 @@ class PartySession(object):
             raise PartyError(429, "Too many requests")
 
         try:
-            host = await self.parties.hosts.get_best_host(self.party.region_id)
-        except HostNotFound:
-            raise PartyError(503, "Not enough hosts")
-
-        try:
-            gs = await self.parties.gameservers.get_game_server(
-                self.gamespace_id, self.party.game_name, self.party.game_server_id)
+            gs, server_settings = await self.parties.gameservers.resolve_game_server(
+                self.gamespace_id, self.party.game_name, self.party.game_version,
+                game_server_id=self.party.game_server_id)
         except GameServerNotFound:
             raise PartyError(404, "No such gameserver")
 
+        if server_settings is None:
+            raise PartyError(500, "No default version configuration")
+
         try:
-            server_settings = await self.parties.gameservers.get_version_game_server(
-                self.gamespace_id, self.party.game_name, self.party.game_version, gs.game_server_id)
-        except GameVersionNotFound:
-            logging.info("Applied default config for version '{0}'".format(self.party.game_version))
-            server_settings = gs.server_settings
+            delivered = await self.parties.deployments.get_delivered_hosts(self.gamespace_id, deployment_id)
+        except DeploymentDeliveryError as e:
+            raise PartyError(500, e.message)
 
-            if server_settings is None:
-                raise PartyError(500, "No default version configuration")
+        try:
+            host = await self.parties.hosts.get_best_host(self.party.region_id, gs.game_settings, delivered)
+        except HostNotFound:
+            raise PartyError(503, "Not enough hosts")
 
-        create_members = [
-            (AccessToken(member.token), {
-                "party_id": str(party.id),
-                "party_profile": member.profile,
-                "party_role": member.role
-            })
-            for member in members
-        ]
+        try:
+            create_members = [
+                (AccessToken(member.token), {
+                    "party_id": str(party.id),
+                    "party_profile": member.profile,
+                    "party_role": member.role
+                })
+                for member in members
+            ]
 
-        records, self.room_id = await self.parties.rooms.create_and_join_room_multi(
-            self.gamespace_id, self.party.game_name, self.party.game_version,
-            gs, room_settings, create_members, host, deployment_id, trigger_remove=False)
+            records, self.room_id = await self.parties.rooms.create_and_join_room_multi(
+                self.gamespace_id, self.party.game_name, self.party.game_version,
+                gs, room_settings, create_members, host, deployment_id, trigger_remove=False)
 
-        logging.info("Created a room: '{0}'".format(self.room_id))
+            logging.info("Created a room: '{0}'".format(self.room_id))
 
-        party_members = {
-            member.account: {
-                "profile": member.profile,
-                "role": member.role
+            party_members = {
+                member.account: {
+                    "profile": member.profile,
+                    "role": member.role
+                }
+                for member in members
             }
-            for member in members
-        }
 
-        other_settings = {
-            "party_id": str(party.id),
-            "party_settings": ujson.dumps(party.settings),
-            "party_members": ujson.dumps(party_members)
-        }
+            other_settings = {
+                "party_id": str(party.id),
+                "party_settings": ujson.dumps(party.settings),
+                "party_members": ujson.dumps(party_members)
+            }
+        except Exception:
+            # the server is not going to be spawned, so the spawn accounted on the host is over
+            self.parties.hosts.spawn_finished(host.host_id, False)
+            raise
 
         try:
             result = await self.parties.rooms.spawn_server(
@@ -470,6 +475,32 @@ class PartySession(object):
 
         await self.__start_game__(message_payload)
 
+    async def __filter_banned__(self, members):
+        """
+        :returns the members that are not banned, or raises PartyError if the one who starts the game is banned
+        """
+
+        try:
+            account_bans, _ = await self.parties.bans.resolve_bans(
+                self.gamespace_id, [member.account for member in members], [])
+        except BanError as e:
+            raise PartyError(500, e.message)
+
+        if not account_bans:
+            return members
+
+        if int(self.account_id) in account_bans:
+            raise PartyError(403, "You are banned")
+
+        for account, ban in account_bans.items():
+            logging.info("Banned account tried to start a party game: @{0} ban {1}".format(account, ban.ban_id))
+
+        return [
+            member
+            for member in members
+            if int(member.account) not in account_bans
+        ]
+
     @validate(message_payload="json_dict")
     async def __start_game__(self, message_payload, check_permissions=True):
 
@@ -515,6 +546,8 @@ class PartySession(object):
                 parties = self.parties
 
                 try:
+                    members = await self.__filter_banned__(members)
+
                     if party.room_filters is None:
                         logging.info("Party spawning new server: {0}".format(party.id))
                         await self.__spawn_server__(members, party)
@@ -845,13 +878,14 @@ class PartyModel(Model):
     PARTY_PERMISSION_START = 500
     PARTY_PERMISSION_CLOSE = 1000
 
-    def __init__(self, db, gameservers, deployments, ratelimit, hosts, rooms):
+    def __init__(self, db, gameservers, deployments, ratelimit, hosts, rooms, bans):
         self.db = db
         self.gameservers = gameservers
         self.deployments = deployments
         self.ratelimit = ratelimit
         self.hosts = hosts
         self.rooms = rooms
+        self.bans = bans
         self.internal = Internal()
 
         party_broker = options.party_broker
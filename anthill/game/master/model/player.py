@@ -4,12 +4,11 @@ from anthill.common.ratelimit import RateLimitExceeded
 
 from .room import RoomNotFound, RoomError
 from .host import HostNotFound, RegionNotFound
-from .gameserver import GameVersionNotFound
-from .deploy import NoCurrentDeployment
+from .deploy import NoCurrentDeployment, DeploymentDeliveryError
+from .ban import BanError
 
 import logging
 import uuid
-from geoip import geolite2
 
 
 class PlayerBanned(Exception):
@@ -28,6 +27,7 @@ class Player(object):
                  account_id, access_token, player_info, ip):
         self.app = app
         self.hosts = app.hosts
+        self.geo = app.geo
         self.rooms = app.rooms
         self.gameservers = app.gameservers
         self.bans = app.bans
@@ -52,20 +52,13 @@ class Player(object):
         self.access_token = access_token
 
     async def init(self):
-        self.gs = await self.gameservers.find_game_server(
-            self.gamespace, self.game_name, self.game_server_name)
+        self.gs, self.server_settings = await self.gameservers.resolve_game_server(
+            self.gamespace, self.game_name, self.game_version, game_server_name=self.game_server_name)
 
         self.game_settings = self.gs.game_settings
 
-        try:
-            self.server_settings = await self.gameservers.get_version_game_server(
-                self.gamespace, self.game_name, self.game_version, self.gs.game_server_id)
-        except GameVersionNotFound as e:
-            logging.info("Applied default config for version '{0}'".format(self.game_version))
-            self.server_settings = self.gs.server_settings
-
-            if self.server_settings is None:
-                raise PlayerError(500, "No default version configuration")
+        if self.server_settings is None:
+            raise PlayerError(500, "No default version configuration")
 
         ban = await self.bans.lookup_ban(self.gamespace, self.account_id, self.ip)
 
@@ -74,29 +67,23 @@ class Player(object):
 
     async def get_closest_region(self):
 
-        location = self.get_location()
+        region = await self.geo.get_closest_region(self.ip)
 
-        if location:
-            p_lat, p_long = location
-            region = await self.hosts.get_closest_region(p_long, p_lat)
-        else:
+        if region is None:
             region = await self.hosts.get_default_region()
 
         return region
 
     def get_location(self):
-        if not self.ip:
-            return None
-
-        geo = geolite2.lookup(self.ip)
+        return self.geo.get_location(self.ip)
 
-        if not geo:
-            return None
-
-        return geo.location
+    async def get_best_host(self, region, deployment_id):
+        try:
+            delivered = await self.app.deployments.get_delivered_hosts(self.gamespace, deployment_id)
+        except DeploymentDeliveryError as e:
+            raise PlayerError(500, e.message)
 
-    async def get_best_host(self, region):
-        host = await self.hosts.get_best_host(region.region_id)
+        host = await self.hosts.get_best_host(region.region_id, self.game_settings, delivered)
         return host
 
     async def create(self, room_settings):
@@ -136,14 +123,19 @@ class Player(object):
                 raise PlayerError(404, "Host not found")
 
             try:
-                host = await self.get_best_host(region)
+                host = await self.get_best_host(region, deployment_id)
             except HostNotFound:
                 raise PlayerError(503, "Not enough hosts")
 
-            self.record_id, key, self.room_id = await self.rooms.create_and_join_room(
-                self.gamespace, self.game_name, self.game_version,
-                self.gs, room_settings, self.account_id, self.access_token, self.player_info,
-                host, deployment_id, False)
+            try:
+                self.record_id, key, self.room_id = await self.rooms.create_and_join_room(
+                    self.gamespace, self.game_name, self.game_version,
+                    self.gs, room_settings, self.account_id, self.access_token, self.player_info,
+                    host, deployment_id, False)
+            except Exception:
+                # the server is not going to be spawned, so the spawn accounted on the host is over
+                self.hosts.spawn_finished(host.host_id, False)
+                raise
 
             logging.info("Created a room: '{0}'".format(self.room_id))
 
@@ -200,20 +192,13 @@ class Player(object):
             except RegionNotFound:
                 raise PlayerError(404, "No such region")
         else:
-            geo = self.get_location()
+            regions = await self.geo.list_closest_regions(self.ip)
             region_lock = None
 
-            if geo:
-                p_lat, p_long = geo
-
+            if regions:
                 if lock_my_region:
-                    try:
-                        region_lock = await self.hosts.get_closest_region(p_long, p_lat)
-                    except RegionNotFound:
-                        pass
-
-                if not region_lock:
-                    regions = await self.hosts.list_closest_regions(p_long, p_lat)
+                    region_lock = regions[0]
+                else:
                     regions_order = [region.region_id for region in regions]
 
         try:
@@ -261,6 +246,7 @@ class PlayersGroup(object):
     def __init__(self, app, gamespace, game_name, game_version, game_server_name, account_records, ip):
         self.app = app
         self.hosts = app.hosts
+        self.geo = app.geo
         self.rooms = app.rooms
         self.gameservers = app.gameservers
         self.bans = app.bans
@@ -317,20 +303,13 @@ class PlayersGroup(object):
         if not self.account_records:
             raise PlayerError(400, "Accounts is empty")
 
-        self.gs = await self.gameservers.find_game_server(
-            self.gamespace, self.game_name, self.game_server_name)
+        self.gs, self.server_settings = await self.gameservers.resolve_game_server(
+            self.gamespace, self.game_name, self.game_version, game_server_name=self.game_server_name)
 
         self.game_settings = self.gs.game_settings
 
-        try:
-            self.server_settings = await self.gameservers.get_version_game_server(
-                self.gamespace, self.game_name, self.game_version, self.gs.game_server_id)
-        except GameVersionNotFound as e:
-            logging.info("Applied default config for version '{0}'".format(self.game_version))
-            self.server_settings = self.gs.server_settings
-
-            if self.server_settings is None:
-                raise PlayerError(500, "No default version configuration")
+        if self.server_settings is None:
+            raise PlayerError(500, "No default version configuration")
 
         _accounts = []
         _ips = []
@@ -347,11 +326,26 @@ class PlayersGroup(object):
         # ips = ["1.2.3.4", "1.2.3.5", "1.2.3.6", ...]
         # self.tokens = [AccessToken(1), AccessToken(2), AccessToken(3), ...]
 
-        banned_accounts = await self.bans.find_bans(self.gamespace, _accounts, _ips)
+        try:
+            account_bans, ip_bans = await self.bans.resolve_bans(self.gamespace, _accounts, _ips)
+        except BanError as e:
+            raise PlayerError(500, e.message)
+
+        # an account is banned either by itself, or by the ip (or the network) it's coming from
+        banned_accounts = {
+            int(account): ban
+            for account, ban in account_bans.items()
+        }
+
+        for account, ip in zip(_accounts, _ips):
+            ban = ip_bans.get(ip)
+            if ban is not None:
+                banned_accounts.setdefault(int(account), ban)
 
         def filter_banned(check):
-            if int(check.account) in banned_accounts:
-                logging.info("Banned account tried to join group: @" + str(check.account))
+            ban = banned_accounts.get(int(check.account))
+            if ban is not None:
+                logging.info("Banned account tried to join group: @{0} ban {1}".format(check.account, ban.ban_id))
                 return False
             return True
 
@@ -363,29 +357,23 @@ class PlayersGroup(object):
 
     async def get_closest_region(self):
 
-        location = self.get_location()
+        region = await self.geo.get_closest_region(self.ip)
 
-        if location:
-            p_lat, p_long = location
-            region = await self.hosts.get_closest_region(p_long, p_lat)
-        else:
+        if region is None:
             region = await self.hosts.get_default_region()
 
         return region
 
     def get_location(self):
-        if not self.ip:
-            return None
+        return self.geo.get_location(self.ip)
 
-        geo = geolite2.lookup(self.ip)
-
-        if not geo:
-            return None
-
-        return geo.location
+    async def get_best_host(self, region, deployment_id):
+        try:
+            delivered = await self.app.deployments.get_delivered_hosts(self.gamespace, deployment_id)
+        except DeploymentDeliveryError as e:
+            raise PlayerError(500, e.message)
 
-    async def get_best_host(self, region):
-        host = await self.hosts.get_best_host(region.region_id)
+        host = await self.hosts.get_best_host(region.region_id, self.game_settings, delivered)
         return host
 
     async def create(self, room_settings):
@@ -423,7 +411,7 @@ class PlayersGroup(object):
             raise PlayerError(404, "Host not found")
 
         try:
-            host = await self.get_best_host(region)
+            host = await self.get_best_host(region, deployment_id)
         except HostNotFound:
             raise PlayerError(503, "Not enough hosts")
 
@@ -434,10 +422,15 @@ class PlayersGroup(object):
             for token in self.tokens
         ]
 
-        records, self.room_id = await self.rooms.create_and_join_room_multi(
-            self.gamespace, self.game_name, self.game_version,
-            self.gs, room_settings, create_members,
-            host, deployment_id, False)
+        try:
+            records, self.room_id = await self.rooms.create_and_join_room_multi(
+                self.gamespace, self.game_name, self.game_version,
+                self.gs, room_settings, create_members,
+                host, deployment_id, False)
+        except Exception:
+            # the server is not going to be spawned, so the spawn accounted on the host is over
+            self.hosts.spawn_finished(host.host_id, False)
+            raise
 
         logging.info("Created a room: '{0}'".format(self.room_id))
 
@@ -492,20 +485,13 @@ class PlayersGroup(object):
 
         regions_order = None
 
-        geo = self.get_location()
+        regions = await self.geo.list_closest_regions(self.ip)
         my_region_only = None
 
-        if geo:
-            p_lat, p_long = geo
-
+        if regions:
             if lock_my_region:
-                try:
-                    my_region_only = await self.hosts.get_closest_region(p_long, p_lat)
-                except RegionNotFound:
-                    pass
-
-            if not my_region_only:
-                regions = await self.hosts.list_closest_regions(p_long, p_lat)
+                my_region_only = regions[0]
+            else:
                 regions_order = [region.region_id for region in regions]
 
         join_members = [
@@ -0,0 +1,154 @@
+
+import ipaddress
+
+
+class PrefixNode(object):
+    __slots__ = ("prefix", "length", "values", "children")
+
+    def __init__(self, prefix, length):
+        self.prefix = prefix
+        self.length = length
+        self.values = None
+        self.children = [None, None]
+
+
+class PrefixTrie(object):
+    """
+    A compressed binary (Patricia) trie of network prefixes of a fixed width (32 bits for IPv4, 128 for IPv6).
+
+    Nodes only exist where the prefixes branch or end, so a lookup takes as many steps as there are distinct
+        prefixes on the way to the address, not as many as there are bits in it.
+    Several values may be stored under the same prefix.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.root = PrefixNode(0, 0)
+
+    def __mask__(self, key, length):
+        if length == 0:
+            return 0
+        return key & (((1 << length) - 1) << (self.width - length))
+
+    def __bit__(self, key, position):
+        return (key >> (self.width - position - 1)) & 1
+
+    def __common__(self, a, b, limit):
+        diff = a ^ b
+        common = self.width - diff.bit_length() if diff else self.width
+        return min(common, limit)
+
+    def insert(self, key, length, value_id, value):
+        key = self.__mask__(key, length)
+        node = self.root
+
+        while True:
+            if node.length == length:
+                if node.values is None:
+                    node.values = {}
+                node.values[value_id] = value
+                return
+
+            bit = self.__bit__(key, node.length)
+            child = node.children[bit]
+
+            if child is None:
+                leaf = PrefixNode(key, length)
+                leaf.values = {value_id: value}
+                node.children[bit] = leaf
+                return
+
+            common = self.__common__(child.prefix, key, min(child.length, length))
+
+            if common == child.length:
+                node = child
+                continue
+
+            # the new prefix diverges from the child somewhere in the middle, so a node is put in between
+            split = PrefixNode(self.__mask__(key, common), common)
+            split.children[self.__bit__(child.prefix, common)] = child
+            node.children[bit] = split
+
+            if common == length:
+                split.values = {value_id: value}
+            else:
+                leaf = PrefixNode(key, length)
+                leaf.values = {value_id: value}
+                split.children[self.__bit__(key, common)] = leaf
+
+            return
+
+    def remove(self, key, length, value_id):
+        key = self.__mask__(key, length)
+        node = self.root
+
+        while node is not None:
+            if node.length == length:
+                if node.prefix == key and node.values:
+                    node.values.pop(value_id, None)
+                return
+
+            if node.length > length or self.__mask__(key, node.length) != node.prefix:
+                return
+
+            node = node.children[self.__bit__(key, node.length)]
+
+    def match(self, key):
+        """
+        :returns a list of the values of every prefix the key belongs to, the longest prefix first
+        """
+        result = []
+        node = self.root
+
+        while node is not None:
+            if self.__mask__(key, node.length) != node.prefix:
+                break
+
+            if node.values:
+                result.append(node.values)
+
+            if node.length == self.width:
+                break
+
+            node = node.children[self.__bit__(key, node.length)]
+
+        result.reverse()
+        return [value for values in result for value in values.values()]
+
+
+class NetworkTrie(object):
+    """
+    A pair of PrefixTrie for IPv4 and IPv6 networks, in terms of addresses in their text form
+    """
+
+    def __init__(self):
+        self.tries = {
+            4: PrefixTrie(32),
+            6: PrefixTrie(128)
+        }
+
+    @staticmethod
+    def parse(network):
+        """
+        :returns an ipaddress network object
+        :raises ValueError if the network is malformed
+        """
+        return ipaddress.ip_network(network, strict=False)
+
+    def insert(self, network, value_id, value):
+        network = NetworkTrie.parse(network)
+        self.tries[network.version].insert(
+            int(network.network_address), network.prefixlen, value_id, value)
+
+    def remove(self, network, value_id):
+        network = NetworkTrie.parse(network)
+        self.tries[network.version].remove(
+            int(network.network_address), network.prefixlen, value_id)
+
+    def match(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return []
+
+        return self.tries[address.version].match(int(address))
@@ -1,16 +1,20 @@
-from tornado.gen import sleep
 from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.concurrent import Future
 
 from anthill.common.model import Model
 from anthill.common.internal import Internal, InternalError
 from anthill.common.discover import DiscoveryError
 from anthill.common.validate import validate
 from anthill.common.jsonrpc import JsonRPCTimeout, JsonRPCError, JSONRPC_TIMEOUT
+from anthill.common.options import options
 from anthill.common import random_string, database, discover
 
 from .gameserver import GameServerAdapter
-from .host import RegionAdapter, HostAdapter, HostNotFound
+from .host import RegionAdapter, HostAdapter, HostNotFound, HostOvercommitted
+from .index import RoomIndex, RoomFilter, IndexedRoom, FilterUnsupported
+from .timer import TimerWheel
 
+import copy
 import ujson
 import logging
 import platform
@@ -58,6 +62,7 @@ class RoomAdapter(object):
     def __init__(self, data):
         self.room_id = str(data.get("room_id"))
         self.host_id = str(data.get("host_id"))
+        self.region_id = str(data.get("region_id"))
         self.room_settings = data.get("settings", {})
         self.players = data.get("players", 0)
         self.location = data.get("location", {})
@@ -176,7 +181,8 @@ class RoomQuery(object):
             """)
 
         for condition, values in self.other_conditions:
-            conditions.append(condition)
+            # an "in" condition is a bunch of ORs
+            conditions.append("(" + condition + ")")
             data.extend(values)
 
         return conditions, data
@@ -264,8 +270,49 @@ class RoomQuery(object):
             return list(items)
 
 
+class JoinBatch(object):
+    """
+    Join requests with the same search parameters, collected during the coalescing window
+    """
+
+    def __init__(self, gamespace, game_name, game_version, game_server_id, filters, conditions,
+                 regions_order=None, region_id=None):
+        self.gamespace = gamespace
+        self.game_name = game_name
+        self.game_version = game_version
+        self.game_server_id = game_server_id
+        self.filters = filters
+        self.conditions = conditions
+        self.regions_order = regions_order
+        self.region_id = region_id
+
+        # a list of pairs ((account_id, access_token, info), future)
+        self.requests = []
+
+    @staticmethod
+    def key(gamespace, game_name, game_version, game_server_id, filters, regions_order=None, region_id=None):
+        return (str(gamespace), game_name, game_version, str(game_server_id),
+                ujson.dumps(filters, sort_keys=True), tuple(regions_order or ()), region_id)
+
+
 class RoomsModel(Model):
     AUTO_REMOVE_TIME = 60
+    JOIN_CANDIDATES = 8
+    # 60 seconds for spawn plus 10 for extra
+    SPAWN_TIME = 70
+
+    # the reservation expiry wheel moves once per second
+    EXPIRY_TICK = 1
+    # every that many ticks the expired reservations are swept anyway, to take care of the reservations
+    #   made by other instances, or before a restart
+    EXPIRY_SWEEP_TICKS = 15
+    # maximum amount of reservations removed with a single statement
+    EXPIRY_BATCH = 1000
+
+    # a name of the lock that makes sure only one node reconciles the player counters at a time
+    RECONCILE_LOCK = "anthill_game_master_reconcile_players"
+    # amount of rooms checked with a single query while reconciling the player counters
+    RECONCILE_BATCH = 1000
 
     @staticmethod
     def __generate_key__(gamespace_id, account_id):
@@ -280,14 +327,91 @@ class RoomsModel(Model):
             """, amount, gamespace_id, room_id
         )
 
+    async def __dec_players_num__(self, gamespace_id, room_id, db, amount=1):
+        await db.execute(
+            """
+            UPDATE `rooms`
+            SET `players`=IF(`players` > %s, `players` - %s, 0)
+            WHERE `gamespace_id`=%s AND `room_id`=%s;
+            """, amount, amount, gamespace_id, room_id
+        )
+
+    async def __dec_rooms_players_num__(self, amounts, db):
+        """
+        Decrements the player counters of several rooms with a single statement
+        :param amounts: a dict of room_id -> amount of players to subtract
+        """
+
+        if not amounts:
+            return
+
+        scheme = []
+        data = []
+
+        for room_id, amount in amounts.items():
+            scheme.append("SELECT %s AS `room_id`, %s AS `amount`")
+            data.extend([room_id, amount])
+
+        await db.execute(
+            """
+            UPDATE `rooms` r
+            JOIN ({0}) d ON r.`room_id` = d.`room_id`
+            SET r.`players`=IF(r.`players` > d.`amount`, r.`players` - d.`amount`, 0);
+            """.format(" UNION ALL ".join(scheme)), *data
+        )
+
     def get_setup_db(self):
         return self.db
 
     def get_setup_tables(self):
         return ["rooms", "players"]
 
-    def get_setup_triggers(self):
-        return ["player_removal"]
+    async def __migrate_players_table__(self):
+        """
+        Adds the `reserved_at` column to the `players` table created by previous versions
+        """
+        try:
+            column = await self.db.get(
+                """
+                SELECT COUNT(*) AS `count`
+                FROM `information_schema`.`COLUMNS`
+                WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`='players' AND `COLUMN_NAME`='reserved_at';
+                """)
+
+            if column["count"]:
+                return
+
+            logging.info("Adding `reserved_at` column to the `players` table")
+
+            await self.db.execute(
+                """
+                ALTER TABLE `players`
+                ADD COLUMN `reserved_at` datetime DEFAULT NULL,
+                ADD KEY `reserved_at` (`state`, `reserved_at`);
+                """)
+
+            # the reservations made before would never expire otherwise, give them the time a new room has
+            await self.db.execute(
+                """
+                UPDATE `players`
+                SET `reserved_at`=DATE_ADD(NOW(), INTERVAL %s SECOND)
+                WHERE `state`='RESERVED' AND `reserved_at` IS NULL;
+                """, RoomsModel.SPAWN_TIME)
+        except database.DatabaseError as e:
+            logging.error("Failed to migrate the players table: " + e.args[1])
+
+    async def __drop_legacy_triggers__(self):
+        """
+        Player counters used to be recalculated by the `player_removal` trigger on every deleted player,
+            now they are maintained explicitly, so the trigger should not be there
+        """
+        try:
+            await self.db.execute(
+                """
+                DROP TRIGGER IF EXISTS `player_removal`;
+                """)
+        except database.DatabaseError as e:
+            logging.error("Failed to drop the player_removal trigger: " + e.args[1])
 
     def __init__(self, app, db, hosts):
         self.db = db
@@ -303,6 +427,76 @@ class RoomsModel(Model):
 
         self.rpc = app.rpc.acquire_rpc("game_master")
 
+        self.join_batches = {}
+        self.players_num_drift = {}
+
+        self.expiry_wheel = TimerWheel(tick=RoomsModel.EXPIRY_TICK)
+        self.expiry_ticks = 0
+        self.expiry_callback = PeriodicCallback(self.__expiry_tick__, RoomsModel.EXPIRY_TICK * 1000)
+
+        if options.rooms_reconcile_period:
+            self.reconcile_callback = PeriodicCallback(
+                self.__reconcile_players_num__, options.rooms_reconcile_period * 1000)
+        else:
+            self.reconcile_callback = None
+
+        if options.rooms_index_refresh:
+            self.index = RoomIndex()
+            self.index_refresh_callback = PeriodicCallback(
+                self.__refresh_index__, options.rooms_index_refresh * 1000)
+        else:
+            self.index = None
+            self.index_refresh_callback = None
+
+    async def __load_index_key__(self, key):
+        gamespace, game_name, game_version, game_server_id = key
+
+        try:
+            rooms = await self.db.query(
+                """
+                SELECT `rooms`.*, `hosts`.`host_state`
+                FROM `rooms`, `hosts`
+                WHERE `rooms`.`gamespace_id`=%s AND `rooms`.`game_name`=%s AND `rooms`.`game_version`=%s
+                    AND `rooms`.`game_server_id`=%s AND `hosts`.`host_id`=`rooms`.`host_id`;
+                """, gamespace, game_name, game_version, game_server_id
+            )
+        except database.DatabaseError as e:
+            raise RoomError("Failed to load rooms index: " + e.args[1])
+
+        self.index.reset(key, [
+            IndexedRoom(RoomAdapter(room), room["region_id"], room["host_state"] in ["ACTIVE", "OVERLOAD"])
+            for room in rooms
+        ])
+
+    async def __refresh_index__(self):
+        for key in self.index.active_keys():
+            try:
+                await self.__load_index_key__(key)
+            except RoomError:
+                logging.exception("Failed to refresh rooms index")
+
+    def __index_room__(self, gamespace, game_name, game_version, game_server_id, room_id, host,
+                       players, max_players, room_settings, deployment_id):
+
+        if self.index is None:
+            return
+
+        room = RoomAdapter({
+            "room_id": room_id,
+            "host_id": host.host_id,
+            "region_id": host.region,
+            "settings": room_settings,
+            "players": players,
+            "game_name": game_name,
+            "game_version": game_version,
+            "max_players": max_players,
+            "deployment_id": deployment_id
+        })
+
+        self.index.add(
+            RoomIndex.key(gamespace, game_name, game_version, game_server_id),
+            IndexedRoom(room, host.region))
+
     async def __update_monitoring_status__(self):
         players_count = await self.get_players_count()
         players_count_per_host = await self.list_players_count_per_host()
@@ -326,15 +520,189 @@ class RoomsModel(Model):
 
     async def started(self, application):
         await super(RoomsModel, self).started(application)
+        await self.__drop_legacy_triggers__()
+        await self.__migrate_players_table__()
+
+        # whatever has expired while we were down
+        await self.__expire_reservations__()
+        self.expiry_callback.start()
         if self.monitoring_report_callback:
             self.monitoring_report_callback.start()
             await self.__update_monitoring_status__()
+        if self.index_refresh_callback:
+            self.index_refresh_callback.start()
+        if self.reconcile_callback:
+            self.reconcile_callback.start()
 
     async def stopped(self):
         if self.monitoring_report_callback:
             self.monitoring_report_callback.stop()
+        if self.index_refresh_callback:
+            self.index_refresh_callback.stop()
+        if self.reconcile_callback:
+            self.reconcile_callback.stop()
+        self.expiry_callback.stop()
         await super(RoomsModel, self).stopped()
 
+    async def __reconcile_players_num__(self):
+        """
+        Fixes the rooms which player counter has drifted away from the actual amount of player records.
+            A counter is allowed to be off for a moment (slots are claimed before the records are inserted),
+            so only the rooms that were found off by the same amount on the previous run are fixed, by that amount.
+
+        Every node runs it, but only the one that holds the lock does the job, and the rooms are checked in
+            batches by room_id so neither the query nor the join it does is unbounded.
+        """
+
+        try:
+            async with self.db.acquire() as db:
+                locked = await db.get(
+                    """
+                    SELECT GET_LOCK(%s, 0) AS `locked`;
+                    """, RoomsModel.RECONCILE_LOCK)
+
+                if not locked or not locked["locked"]:
+                    # some other node is on it, so the drift seen here before is of no use anymore
+                    self.players_num_drift = {}
+                    return
+
+                try:
+                    drift = await self.__players_num_drift__(db)
+                finally:
+                    await db.get(
+                        """
+                        SELECT RELEASE_LOCK(%s) AS `released`;
+                        """, RoomsModel.RECONCILE_LOCK)
+        except database.DatabaseError as e:
+            logging.error("Failed to reconcile player counters: " + e.args[1])
+            return
+
+        previous = self.players_num_drift
+        self.players_num_drift = drift
+
+        for room_id, off in drift.items():
+            if previous.get(room_id) != off:
+                continue
+
+            try:
+                fixed = await self.db.execute(
+                    """
+                    UPDATE `rooms`
+                    SET `players`=`players`-%s
+                    WHERE `room_id`=%s AND `players`>=%s;
+                    """, off, room_id, off)
+            except database.DatabaseError as e:
+                logging.error("Failed to reconcile player counter: " + e.args[1])
+                continue
+
+            if fixed:
+                logging.warning("Fixed player counter of room {0} by {1}".format(room_id, -off))
+
+                if self.index is not None:
+                    self.index.update_players(room_id, -off)
+
+    async def __players_num_drift__(self, db):
+        """
+        :returns room_id -> how many players the counter of the room is off by, for every room that is off
+        """
+
+        drift = {}
+        last_room_id = 0
+
+        while True:
+            rooms = await db.query(
+                """
+                SELECT r.`room_id`, CAST(r.`players` AS SIGNED) - COUNT(p.`record_id`) AS `drift`
+                FROM (
+                    SELECT `room_id`, `players`
+                    FROM `rooms`
+                    WHERE `room_id` > %s
+                    ORDER BY `room_id`
+                    LIMIT %s
+                ) r
+                LEFT JOIN `players` p ON p.`room_id` = r.`room_id`
+                GROUP BY r.`room_id`, r.`players`
+                ORDER BY r.`room_id`;
+                """, last_room_id, RoomsModel.RECONCILE_BATCH)
+
+            for room in rooms:
+                if room["drift"]:
+                    drift[room["room_id"]] = int(room["drift"])
+
+            if len(rooms) < RoomsModel.RECONCILE_BATCH:
+                return drift
+
+            last_room_id = rooms[-1]["room_id"]
+
+    async def __delete_room_players__(self, gamespace, room_id, condition, *args):
+        """
+        Deletes the player records of a single room, and decrements its counter within the same transaction
+        :returns amount of records deleted
+        """
+
+        async with self.db.acquire(auto_commit=False) as db:
+            try:
+                deleted = await db.execute(
+                    """
+                    DELETE FROM `players`
+                    WHERE `gamespace_id`=%s AND `room_id`=%s AND {0};
+                    """.format(condition), gamespace, room_id, *args
+                )
+
+                if deleted:
+                    await self.__dec_players_num__(gamespace, room_id, db, deleted)
+            finally:
+                await db.commit()
+
+        if deleted and self.index is not None:
+            self.index.update_players(room_id, -deleted)
+
+        return deleted
+
+    async def __delete_players__(self, condition, *args):
+        """
+        Deletes the player records across any rooms, and decrements the counters grouped by room
+            with a single statement
+        :returns amount of records deleted
+        """
+
+        async with self.db.acquire(auto_commit=False) as db:
+            try:
+                records = await db.query(
+                    """
+                    SELECT `record_id`, `room_id`
+                    FROM `players`
+                    WHERE {0}
+                    FOR UPDATE;
+                    """.format(condition), *args
+                )
+
+                if not records:
+                    return 0
+
+                amounts = {}
+
+                for record in records:
+                    room_id = record["room_id"]
+                    amounts[room_id] = amounts.get(room_id, 0) + 1
+
+                await db.execute(
+                    """
+                    DELETE FROM `players`
+                    WHERE `record_id` IN %s;
+                    """, [record["record_id"] for record in records]
+                )
+
+                await self.__dec_rooms_players_num__(amounts, db)
+            finally:
+                await db.commit()
+
+        if self.index is not None:
+            for room_id, amount in amounts.items():
+                self.index.update_players(room_id, -amount)
+
+        return len(records)
+
     async def get_players_count(self):
         try:
             count = await self.db.get(
@@ -424,61 +792,404 @@ class RoomsModel(Model):
 
     async def __insert_player__(self, gamespace, account_id, room_id, host_id,
                                 key, access_token, info, db, trigger_remove=True):
+        """
+        Inserts a player record
+        :param trigger_remove: if True, the reservation starts to expire right away, otherwise the expiry starts
+                               once trigger_remove_temp_reservation is called for it, or the room has had
+                               SPAWN_TIME to spawn, whatever comes first
+        """
+
         record_id = await db.insert(
             """
             INSERT INTO `players`
-            (`gamespace_id`, `account_id`, `room_id`, `host_id`, `key`, `access_token`, `info`)
-            VALUES (%s, %s, %s, %s, %s, %s, %s);
-            """, gamespace, account_id, room_id, host_id, key, access_token, ujson.dumps(info)
+            (`gamespace_id`, `account_id`, `room_id`, `host_id`, `key`, `access_token`, `info`, `reserved_at`)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, {0});
+            """.format(RoomsModel.__reserved_at__(trigger_remove)),
+            gamespace, account_id, room_id, host_id, key, access_token, ujson.dumps(info)
         )
 
-        if trigger_remove:
-            self.trigger_remove_temp_reservation(record_id)
+        self.__schedule_reservation_expiry__(1, trigger_remove)
 
         return record_id
 
-    def trigger_remove_temp_reservation_multi(self, gamespace, room_id, accounts):
-        IOLoop.current().spawn_callback(self.__remove_temp_reservation_multi__, gamespace, room_id, accounts)
+    async def __insert_players__(self, gamespace, room_id, host_id, members, db, trigger_remove=True):
+        """
+        Inserts a bulk of player records with a single statement
+        :param members: a list of triples (account_id, access_token, info)
+        :param trigger_remove: same as for __insert_player__
+        :returns a list of pairs (record_id, key), in the same order as members
+        """
 
-    def trigger_remove_temp_reservation(self, record):
-        IOLoop.current().spawn_callback(self.__remove_temp_reservation__, record)
+        data = []
+        scheme = []
+        keys = []
 
-    async def __update_players_num__(self, room_id, db):
-        await db.execute(
+        reserved_at = RoomsModel.__reserved_at__(trigger_remove)
+
+        for account_id, access_token, info in members:
+            key = RoomsModel.__generate_key__(gamespace, account_id)
+            keys.append(key)
+            data.extend([gamespace, account_id, room_id, host_id, key, access_token, ujson.dumps(info)])
+            scheme.append('(%s, %s, %s, %s, %s, %s, %s, ' + reserved_at + ')')
+
+        first_record_id = await db.insert(
             """
-            UPDATE `rooms` r
-            SET `players`=(SELECT COUNT(*) FROM `players` p WHERE p.room_id = r.room_id)
-            WHERE `room_id`=%s
-            """, room_id
+            INSERT INTO `players`
+            (`gamespace_id`, `account_id`, `room_id`, `host_id`, `key`, `access_token`, `info`, `reserved_at`)
+            VALUES {0};
+            """.format(",".join(scheme)), *data
         )
 
-    async def __remove_temp_reservation__(self, record_id):
+        self.__schedule_reservation_expiry__(len(members), trigger_remove)
+
+        return list(zip(range(first_record_id, first_record_id + len(members)), keys))
+
+    async def __claim_slots__(self, gamespace, room_id, amount, conditions, db, host_active=True):
         """
-        Called asynchronously when user joined the room
-        Waits a while, and then leaves the room, if the join reservation
-            was not approved by game-controller.
+        Claims player slots in the room with a single conditional write, without locking anything beforehand.
+            The room filters (and the host state, if the search required it) are checked once again,
+            so a stale candidate just fails to claim.
+        :param host_active: whether the host of the room should be ACTIVE or OVERLOAD, the same as the
+            RoomQuery.host_active of the search the room was found with
+        :returns True if the slots were claimed
         """
 
-        # wait a while
-        await sleep(RoomsModel.AUTO_REMOVE_TIME)
+        query_conditions = [
+            "`room_id`=%s",
+            "`gamespace_id`=%s",
+            "`players` + %s <= `max_players`"
+        ]
+
+        if host_active:
+            query_conditions.append(
+                """
+                (
+                    SELECT `hosts`.`host_state`
+                    FROM `hosts`
+                    WHERE `hosts`.`host_id` = `rooms`.`host_id`
+                ) IN ('ACTIVE', 'OVERLOAD')
+                """)
+
+        data = [room_id, gamespace, amount]
+
+        for condition, values in conditions:
+            # an "in" condition is a bunch of ORs
+            query_conditions.append("(" + condition + ")")
+            data.extend(values)
 
-        result = await self.leave_room_reservation(record_id)
+        result = await db.execute(
+            """
+            UPDATE `rooms`
+            SET `players`=`players` + %s
+            WHERE {0};
+            """.format(" AND ".join(query_conditions)), amount, *data
+        )
 
-        if result:
-            logging.warning("Removed player reservation: {0}".format(
-                record_id
-            ))
+        return bool(result)
 
-    async def __remove_temp_reservation_multi__(self, gamespace, room_id, accounts):
+    async def __join_indexed__(self, gamespace, game_name, game_version, game_server_id,
+                               members, filters, conditions, regions_order=None, region_id=None):
         """
-        Called asynchronously when users joined the room
-        Waits a while, and then leaves the room, if the join reservation
-            was not approved by game-controller.
+        Looks up the in-memory index for a room, and claims the slots in it
+        :param members: a list of triples (account_id, access_token, info)
+        :returns a pair of room and records (see __insert_players__), or None if the index has nothing to offer,
+                 so the caller should fall back to the database search
         """
 
-        # wait a while
-        await sleep(RoomsModel.AUTO_REMOVE_TIME)
-        await self.leave_room_reservation_multi(gamespace, room_id, accounts)
+        try:
+            room_filter = RoomFilter(filters)
+        except FilterUnsupported:
+            return None
+
+        key = RoomIndex.key(gamespace, game_name, game_version, game_server_id)
+        self.index.touch(key)
+
+        if not self.index.has(key):
+            await self.__load_index_key__(key)
+
+        candidates = self.index.candidates(
+            key, room_filter, slots=len(members), regions_order=regions_order, region_id=region_id,
+            limit=RoomsModel.JOIN_CANDIDATES)
+
+        if not candidates:
+            return None
+
+        return await self.__claim_and_join__(gamespace, [entry.room for entry in candidates], members, conditions)
+
+    async def __claim_and_join__(self, gamespace, rooms, members, conditions, host_active=True):
+        """
+        Tries to claim the slots in the candidate rooms one by one, and joins the members into the first
+            room that succeeds. Each claim is a single auto-committed statement, so no lock is held in between.
+        :param rooms: a list of candidate rooms (RoomAdapter), best first
+        :param members: a list of triples (account_id, access_token, info)
+        :param host_active: see __claim_slots__
+        :returns a pair of room and records (see __insert_players__), or None if every candidate failed
+        """
+
+        amount = len(members)
+
+        try:
+            async with self.db.acquire() as db:
+                for room in rooms:
+                    claimed = await self.__claim_slots__(
+                        gamespace, room.room_id, amount, conditions, db, host_active=host_active)
+
+                    if not claimed:
+                        if self.index is not None:
+                            # the index has been wrong about this one, it will be back on next refresh if still alive
+                            self.index.remove(room.room_id)
+                        continue
+
+                    if self.index is not None:
+                        self.index.update_players(room.room_id, amount)
+
+                    try:
+                        records = await self.__insert_players__(gamespace, room.room_id, room.host_id, members, db)
+                    except database.DatabaseError:
+                        # give the slots back
+                        await self.__dec_players_num__(gamespace, room.room_id, db, amount)
+
+                        if self.index is not None:
+                            self.index.update_players(room.room_id, -amount)
+                        raise
+
+                    return (room, records)
+        except database.DatabaseError as e:
+            raise RoomError("Failed to join a room: " + e.args[1])
+
+        return None
+
+    async def __join_coalesced__(self, gamespace, game_name, game_version, game_server_id,
+                                 account_id, access_token, player_info, filters, conditions,
+                                 regions_order=None, region_id=None):
+        """
+        Puts the join request into a batch of compatible requests, that is processed once the coalescing
+            window is over, with a single search and a single insert per room.
+        :returns a tuple (record_id, key, room), or None if the batch had no room for this request,
+                 so the caller should proceed on its own
+        """
+
+        batch_key = JoinBatch.key(
+            gamespace, game_name, game_version, game_server_id, filters, regions_order, region_id)
+
+        batch = self.join_batches.get(batch_key)
+
+        if batch is None:
+            batch = JoinBatch(
+                gamespace, game_name, game_version, game_server_id, filters, conditions,
+                regions_order, region_id)
+
+            self.join_batches[batch_key] = batch
+
+            IOLoop.current().call_later(
+                options.rooms_join_coalesce / 1000.0, self.__flush_join_batch__, batch_key)
+
+        future = Future()
+        batch.requests.append(((account_id, access_token, player_info), future))
+
+        return await future
+
+    def __flush_join_batch__(self, batch_key):
+        batch = self.join_batches.pop(batch_key, None)
+
+        if batch:
+            IOLoop.current().spawn_callback(self.__process_join_batch__, batch)
+
+    async def __join_batch_candidates__(self, batch):
+        if self.index is not None:
+            try:
+                room_filter = RoomFilter(batch.filters)
+            except FilterUnsupported:
+                pass
+            else:
+                key = RoomIndex.key(batch.gamespace, batch.game_name, batch.game_version, batch.game_server_id)
+                self.index.touch(key)
+
+                if not self.index.has(key):
+                    await self.__load_index_key__(key)
+
+                candidates = self.index.candidates(
+                    key, room_filter, regions_order=batch.regions_order, region_id=batch.region_id,
+                    limit=RoomsModel.JOIN_CANDIDATES)
+
+                return [entry.room for entry in candidates]
+
+        query = RoomQuery(batch.gamespace, batch.game_name, batch.game_version, batch.game_server_id)
+
+        query.add_conditions(batch.conditions)
+        query.regions_order = batch.regions_order
+        query.show_full = False
+        query.host_active = True
+        query.limit = RoomsModel.JOIN_CANDIDATES
+
+        if batch.region_id:
+            query.region_id = batch.region_id
+
+        try:
+            return await query.query(self.db, one=False)
+        except database.DatabaseError as e:
+            raise RoomError("Failed to join a room: " + e.args[1])
+
+    async def __process_join_batch__(self, batch):
+        pending = batch.requests
+        gamespace = batch.gamespace
+
+        try:
+            rooms = await self.__join_batch_candidates__(batch)
+
+            async with self.db.acquire() as db:
+                for room in rooms:
+                    if not pending:
+                        break
+
+                    free = room.max_players - room.players
+
+                    if free <= 0:
+                        continue
+
+                    chunk = pending[:free]
+                    amount = len(chunk)
+
+                    claimed = await self.__claim_slots__(gamespace, room.room_id, amount, batch.conditions, db)
+
+                    if not claimed:
+                        if self.index is not None:
+                            self.index.remove(room.room_id)
+                        continue
+
+                    if self.index is not None:
+                        self.index.update_players(room.room_id, amount)
+
+                    try:
+                        records = await self.__insert_players__(
+                            gamespace, room.room_id, room.host_id, [member for member, future in chunk], db)
+                    except database.DatabaseError:
+                        await self.__dec_players_num__(gamespace, room.room_id, db, amount)
+
+                        if self.index is not None:
+                            self.index.update_players(room.room_id, -amount)
+                        raise
+
+                    pending = pending[amount:]
+
+                    for (record_id, key), (member, future) in zip(records, chunk):
+                        future.set_result((record_id, key, room))
+
+        except (RoomError, database.DatabaseError):
+            logging.exception("Failed to process a join batch")
+        finally:
+            # whoever is left would join on its own
+            for member, future in pending:
+                if not future.done():
+                    future.set_result(None)
+
+    async def __join_optimistic__(self, gamespace, query, members, conditions):
+        """
+        Runs the room search without locking anything, and then claims the slots in the first matching room
+        :returns a pair of room and records (see __insert_players__)
+        """
+
+        query.limit = RoomsModel.JOIN_CANDIDATES
+
+        try:
+            rooms = await query.query(self.db, one=False)
+        except database.DatabaseError as e:
+            raise RoomError("Failed to join a room: " + e.args[1])
+
+        joined = await self.__claim_and_join__(
+            gamespace, rooms, members, conditions, host_active=query.host_active)
+
+        if joined is None:
+            raise RoomNotFound()
+
+        return joined
+
+    def trigger_remove_temp_reservation_multi(self, gamespace, room_id, accounts):
+        IOLoop.current().spawn_callback(self.__start_reservation_expiry_multi__, gamespace, room_id, accounts)
+
+    def trigger_remove_temp_reservation(self, record):
+        IOLoop.current().spawn_callback(self.__start_reservation_expiry__, record)
+
+    @staticmethod
+    def __reserved_at__(trigger_remove):
+        """
+        :returns an SQL expression for the `reserved_at` of a new reservation: the ones that do not start to expire
+                 right away are given SPAWN_TIME on top, so they do expire if nothing ever starts their expiry
+        """
+        if trigger_remove:
+            return "NOW()"
+
+        return "DATE_ADD(NOW(), INTERVAL {0} SECOND)".format(RoomsModel.SPAWN_TIME)
+
+    def __schedule_reservation_expiry__(self, amount, trigger_remove=True):
+        # the wheel only knows when something is due, the reservations themselves are in the database
+        delay = RoomsModel.AUTO_REMOVE_TIME if trigger_remove else RoomsModel.SPAWN_TIME + RoomsModel.AUTO_REMOVE_TIME
+        self.expiry_wheel.add(delay, amount)
+
+    async def __start_reservation_expiry__(self, record_id):
+        """
+        Starts the expiry of a reservation inserted with trigger_remove=False, sooner than its spawn deadline
+        """
+
+        try:
+            started = await self.db.execute(
+                """
+                UPDATE `players`
+                SET `reserved_at`=NOW()
+                WHERE `record_id`=%s AND `state`='RESERVED';
+                """, record_id)
+        except database.DatabaseError as e:
+            logging.error("Failed to start reservation expiry: " + e.args[1])
+        else:
+            if started:
+                self.__schedule_reservation_expiry__(started)
+
+    async def __start_reservation_expiry_multi__(self, gamespace, room_id, accounts):
+        try:
+            started = await self.db.execute(
+                """
+                UPDATE `players`
+                SET `reserved_at`=NOW()
+                WHERE `gamespace_id`=%s AND `account_id` IN %s AND `room_id`=%s AND `state`='RESERVED';
+                """, gamespace, accounts, room_id)
+        except database.DatabaseError as e:
+            logging.error("Failed to start reservation expiry: " + e.args[1])
+        else:
+            if started:
+                self.__schedule_reservation_expiry__(started)
+
+    async def __expiry_tick__(self):
+        due = self.expiry_wheel.advance()
+        self.expiry_ticks += 1
+
+        if due or self.expiry_ticks >= RoomsModel.EXPIRY_SWEEP_TICKS:
+            self.expiry_ticks = 0
+            await self.__expire_reservations__()
+
+    async def __expire_reservations__(self):
+        """
+        Removes the reservations that were not approved by game-controller in time, in batches.
+            The deadline is stored along with the reservation, so it does not matter which instance
+            (if any) is still around to remember about it.
+        """
+
+        while True:
+            try:
+                removed = await self.__delete_players__(
+                    """
+                    `state`='RESERVED' AND `reserved_at` < DATE_SUB(NOW(), INTERVAL %s SECOND)
+                    LIMIT %s
+                    """, RoomsModel.AUTO_REMOVE_TIME, RoomsModel.EXPIRY_BATCH)
+            except database.DatabaseError as e:
+                # several instances may sweep at the same time, whatever is left would be removed on next tick
+                logging.warning("Failed to remove expired reservations: " + e.args[1])
+                return
+
+            if removed:
+                logging.warning("Removed {0} expired player reservation(s)".format(removed))
+
+            if removed < RoomsModel.EXPIRY_BATCH:
+                return
 
     async def approve_join(self, gamespace, room_id, key):
 
@@ -521,13 +1232,7 @@ class RoomsModel(Model):
 
     async def approve_leave(self, gamespace, room_id, key):
         try:
-            async with self.db.acquire() as db:
-                await db.execute(
-                    """
-                    DELETE FROM `players`
-                    WHERE `gamespace_id`=%s AND `key`=%s AND `room_id`=%s;
-                    """, gamespace, key, room_id
-                )
+            await self.__delete_room_players__(gamespace, room_id, "`key`=%s", key)
         except database.DatabaseError as e:
             # well, a dead lock is possible here, so ignore it as it happens
             pass
@@ -575,6 +1280,10 @@ class RoomsModel(Model):
         except database.DatabaseError as e:
             raise RoomError("Failed to create a room: " + e.args[1])
         else:
+            self.__index_room__(
+                gamespace, game_name, game_version, gs.game_server_id, room_id, host,
+                1, max_players, room_settings, deployment_id)
+
             return (record_id, key, room_id)
 
     async def create_room(self, gamespace, game_name, game_version, gs, room_settings, host, deployment_id,
@@ -596,6 +1305,10 @@ class RoomsModel(Model):
         except database.DatabaseError as e:
             raise RoomError("Failed to create a room: " + e.args[1])
         else:
+            self.__index_room__(
+                gamespace, game_name, game_version, gs.game_server_id, room_id, host,
+                0, max_players, room_settings, deployment_id)
+
             return room_id
 
     async def create_and_join_room_multi(
@@ -617,38 +1330,24 @@ class RoomsModel(Model):
                     "{}", ujson.dumps(room_settings), host.host_id, host.region, deployment_id
                 )
 
-                data = []
-                scheme = []
-                keys = {}
-
-                for token, info in members:
-                    key = RoomsModel.__generate_key__(gamespace, token.account)
-                    keys[token.account] = key
-                    data.extend([gamespace, token.account, room_id, host.host_id, key, token.key, ujson.dumps(info)])
-                    scheme.append('(%s, %s, %s, %s, %s, %s, %s)')
-
-                query_string = """
-                    INSERT INTO `players`
-                    (`gamespace_id`, `account_id`, `room_id`, `host_id`, `key`, `access_token`, `info`)
-                    VALUES {0};
-                    """.format(",".join(scheme))
-
-                first_record_id = await db.insert(query_string, *data)
+                records = await self.__insert_players__(
+                    gamespace, room_id, host.host_id,
+                    [(token.account, token.key, info) for token, info in members], db, trigger_remove)
 
                 await db.commit()
 
                 result = {
-                    token.account: (record_id, keys[token.account])
-                    for record_id, (token, info) in enumerate(members, first_record_id)
+                    token.account: record
+                    for record, (token, info) in zip(records, members)
                 }
 
-                if trigger_remove:
-                    accounts = [token.account for token, info in members]
-                    self.trigger_remove_temp_reservation_multi(gamespace, room_id, accounts)
-
         except database.DatabaseError as e:
             raise RoomError("Failed to create a room: " + e.args[1])
         else:
+            self.__index_room__(
+                gamespace, game_name, game_version, gs.game_server_id, room_id, host,
+                len(members), max_players, room_settings, deployment_id)
+
             return (result, room_id)
 
     async def find_and_join_room_multi(
@@ -675,6 +1374,44 @@ class RoomsModel(Model):
         except database.ConditionError as e:
             raise RoomError(str(e))
 
+        if self.index is not None:
+            indexed = await self.__join_indexed__(
+                gamespace, game_name, game_version, game_server_id,
+                [(token.account, token.key, info) for token, info in members],
+                filters, conditions, regions_order=regions_order, region_id=region)
+
+            if indexed:
+                room, records = indexed
+
+                result = {
+                    token.account: record
+                    for record, (token, info) in zip(records, members)
+                }
+
+                return (result, room)
+
+        if options.rooms_join_mode == "optimistic":
+            query = RoomQuery(gamespace, game_name, game_version, game_server_id)
+
+            query.add_conditions(conditions)
+            query.regions_order = regions_order
+            query.free_slots = len(members)
+            query.show_full = False
+            query.host_active = True
+
+            if region:
+                query.region_id = region
+
+            room, records = await self.__join_optimistic__(
+                gamespace, query, [(token.account, token.key, info) for token, info in members], conditions)
+
+            result = {
+                token.account: record
+                for record, (token, info) in zip(records, members)
+            }
+
+            return (result, room)
+
         try:
             async with self.db.acquire(auto_commit=False) as db:
 
@@ -732,6 +1469,42 @@ class RoomsModel(Model):
         except database.ConditionError as e:
             raise RoomError(str(e))
 
+        if options.rooms_join_coalesce:
+            joined = await self.__join_coalesced__(
+                gamespace, game_name, game_version, game_server_id,
+                account_id, access_token, player_info, settings, conditions,
+                regions_order=regions_order, region_id=region.region_id if region else None)
+
+            if joined:
+                return joined
+
+        if self.index is not None:
+            indexed = await self.__join_indexed__(
+                gamespace, game_name, game_version, game_server_id,
+                [(account_id, access_token, player_info)],
+                settings, conditions, regions_order=regions_order,
+                region_id=region.region_id if region else None)
+
+            if indexed:
+                room, [(record_id, key)] = indexed
+                return (record_id, key, room)
+
+        if options.rooms_join_mode == "optimistic":
+            query = RoomQuery(gamespace, game_name, game_version, game_server_id)
+
+            query.add_conditions(conditions)
+            query.regions_order = regions_order
+            query.show_full = False
+            query.host_active = True
+
+            if region:
+                query.region_id = region.region_id
+
+            room, [(record_id, key)] = await self.__join_optimistic__(
+                gamespace, query, [(account_id, access_token, player_info)], conditions)
+
+            return (record_id, key, room)
+
         try:
             async with self.db.acquire(auto_commit=False) as db:
 
@@ -776,6 +1549,17 @@ class RoomsModel(Model):
         :returns a pair of record_id, a key (an unique string to find the record by) for the player and room info
         """
 
+        if options.rooms_join_mode == "optimistic":
+            query = RoomQuery(gamespace, game_name)
+
+            query.room_id = room_id
+            query.show_full = False
+
+            room, [(record_id, key)] = await self.__join_optimistic__(
+                gamespace, query, [(account_id, access_token, player_info)], [])
+
+            return (record_id, key, room)
+
         try:
             async with self.db.acquire(auto_commit=False) as db:
 
@@ -843,6 +1627,9 @@ class RoomsModel(Model):
         except database.DatabaseError as e:
             raise RoomError("Failed to update a room: " + e.args[1])
 
+        if self.index is not None:
+            self.index.update_settings(room_id, room_settings)
+
     async def update_rooms_state(self, host_id, state, rooms=None, exclusive=False):
 
         if rooms and not isinstance(rooms, list):
@@ -903,8 +1690,12 @@ class RoomsModel(Model):
         This method takes the game settings generated by schema in GAME_SETTINGS_SCHEME, and prepares it for usage by
             controller game sever instance. For example, it authenticates if username/password is provided and then
             replaces the whole section with generated token to hide passwords themselves
+
+        The settings passed are shared (see GameServersCache) and are left intact, the prepared ones are a copy
+        :returns the prepared settings
         """
 
+        settings = copy.deepcopy(settings)
         token = settings.get("token", {})
 
         if token:
@@ -945,11 +1736,13 @@ class RoomsModel(Model):
             else:
                 settings["discover"] = services
 
+        return settings
+
     async def instantiate(self, gamespace, game_id, game_version, game_server_name,
                           deployment_id, room_id, host, game_settings, server_settings,
                           room_settings, other_settings=None):
 
-        await self.prepare(gamespace, game_settings)
+        game_settings = await self.prepare(gamespace, game_settings)
 
         settings = {
             "game": game_settings,
@@ -961,10 +1754,9 @@ class RoomsModel(Model):
             settings["other"] = other_settings
 
         try:
-            # 60 seconds for spawn plus 10 for extra
             result = await self.rpc.send_mq_request(
                 "game_host_{0}".format(host.host_id),
-                "spawn", 70, game_name=game_id, game_version=game_version,
+                "spawn", RoomsModel.SPAWN_TIME, game_name=game_id, game_version=game_version,
                 game_server_name=game_server_name,
                 room_id=room_id, deployment=deployment_id, settings=settings)
         except JsonRPCTimeout as e:
@@ -994,35 +1786,15 @@ class RoomsModel(Model):
             await self.__inc_players_num__(gamespace, room_id, db, len(members))
             await db.commit()
 
-            data = []
-            scheme = []
-            keys = {}
-
-            for token, info in members:
-                key = RoomsModel.__generate_key__(gamespace, token.account)
-                keys[token.account] = key
-                data.extend([gamespace, token.account, room_id, host_id, key, token.key, ujson.dumps(info)])
-                scheme.append('(%s, %s, %s, %s, %s, %s, %s)')
-
-            first_record_id = await db.insert(
-                """
-                INSERT INTO `players`
-                (`gamespace_id`, `account_id`, `room_id`, `host_id`, `key`, `access_token`, `info`)
-                VALUES {0};
-                """.format(",".join(scheme)), *data
-            )
+            records = await self.__insert_players__(
+                gamespace, room_id, host_id, [(token.account, token.key, info) for token, info in members], db)
             await db.commit()
 
             result = {
-                token.account: (record_id, keys[token.account])
-                for record_id, (token, info) in enumerate(members, first_record_id)
+                token.account: record
+                for record, (token, info) in zip(records, members)
             }
 
-            accounts = [token.account for token, info in members]
-            self.trigger_remove_temp_reservation_multi(gamespace, room_id, accounts)
-
-            await db.commit()
-
         except database.DatabaseError as e:
             raise RoomError("Failed to join a room: " + e.args[1])
 
@@ -1061,14 +1833,7 @@ class RoomsModel(Model):
 
     async def leave_room(self, gamespace, room_id, account_id, remove_room=False):
         try:
-            async with self.db.acquire() as db:
-                await db.execute(
-                    """
-                    DELETE FROM `players`
-                    WHERE `gamespace_id`=%s AND `account_id`=%s AND `room_id`=%s
-                    LIMIT 1;
-                    """, gamespace, account_id, room_id
-                )
+            await self.__delete_room_players__(gamespace, room_id, "`account_id`=%s LIMIT 1", account_id)
         except database.DatabaseError as e:
             raise RoomError("Failed to leave a room: " + e.args[1])
         finally:
@@ -1077,13 +1842,7 @@ class RoomsModel(Model):
 
     async def leave_room_multi(self, gamespace, room_id, accounts, remove_room=False):
         try:
-            async with self.db.acquire() as db:
-                await db.execute(
-                    """
-                    DELETE FROM `players`
-                    WHERE `gamespace_id`=%s AND `account_id` IN %s AND `room_id`=%s;
-                    """, gamespace, accounts, room_id
-                )
+            await self.__delete_room_players__(gamespace, room_id, "`account_id` IN %s", accounts)
         except database.DatabaseError as e:
             raise RoomError("Failed to leave a room: " + e.args[1])
         finally:
@@ -1091,30 +1850,19 @@ class RoomsModel(Model):
                 await self.remove_room(gamespace, room_id)
 
     async def leave_room_reservation(self, record_id):
-        async with self.db.acquire() as db:
-            try:
-                result = await db.execute(
-                    """
-                    DELETE FROM `players`
-                    WHERE `record_id`=%s AND `state`='RESERVED'
-                    LIMIT 1;
-                    """, record_id)
-            except database.DatabaseError as e:
-                return False
-            else:
-                return result
+        try:
+            result = await self.__delete_players__("`record_id`=%s AND `state`='RESERVED'", record_id)
+        except database.DatabaseError as e:
+            return False
+        else:
+            return result
 
     async def leave_room_reservation_multi(self, gamespace, room_id, accounts):
         try:
-            async with self.db.acquire() as db:
-                result = await db.execute(
-                    """
-                    DELETE FROM `players`
-                    WHERE `gamespace_id`=%s AND `account_id` IN %s AND `room_id`=%s AND `state`='RESERVED';
-                    """, gamespace, accounts, room_id
-                )
+            result = await self.__delete_room_players__(
+                gamespace, room_id, "`account_id` IN %s AND `state`='RESERVED'", accounts)
 
-                return result
+            return result
         except database.DatabaseError as e:
             # well, a dead lock is possible here, so ignore it as it happens
             pass
@@ -1192,6 +1940,7 @@ class RoomsModel(Model):
     async def remove_host_rooms(self, host_id, except_rooms=None):
         try:
             # cleanup empty room
+            # the player records removed belong to the removed rooms only, so no counters to maintain here
 
             async with self.db.acquire() as db:
                 if except_rooms:
@@ -1223,6 +1972,38 @@ class RoomsModel(Model):
         except database.DatabaseError as e:
             raise RoomError("Failed to remove rooms: " + e.args[1])
 
+        if self.index is not None:
+            self.index.remove_host(host_id, except_rooms)
+
+    async def remove_rooms(self, host_id, rooms):
+        """
+        Removes the listed rooms of the host along with their players
+        """
+
+        if not rooms:
+            return
+
+        try:
+            async with self.db.acquire() as db:
+                await db.execute(
+                    """
+                    DELETE FROM `rooms`
+                    WHERE `host_id`=%s AND `room_id` IN %s;
+                    """, host_id, rooms
+                )
+                await db.execute(
+                    """
+                    DELETE FROM `players`
+                    WHERE `host_id`=%s AND `room_id` IN %s;
+                    """, host_id, rooms
+                )
+        except database.DatabaseError as e:
+            raise RoomError("Failed to remove rooms: " + e.args[1])
+
+        if self.index is not None:
+            for room_id in rooms:
+                self.index.remove(room_id)
+
     async def remove_room(self, gamespace, room_id):
         try:
             # cleanup empty room
@@ -1243,13 +2024,28 @@ class RoomsModel(Model):
         except database.DatabaseError as e:
             raise RoomError("Failed to leave a room: " + e.args[1])
 
+        if self.index is not None:
+            self.index.remove(room_id)
+
     async def spawn_server(self, gamespace, game_id, game_version, game_server_name, deployment_id,
                            room_id, host, game_settings, server_settings, room_settings, other_settings=None):
 
-        result = await self.instantiate(
-            gamespace, game_id, game_version, game_server_name,
-            deployment_id, room_id, host,
-            game_settings, server_settings, room_settings, other_settings)
+        try:
+            self.hosts.check_capacity(host)
+        except HostOvercommitted:
+            self.hosts.spawn_finished(host.host_id, False)
+            raise RoomError("Host {0} is out of capacity".format(host.host_id))
+
+        spawned = False
+
+        try:
+            result = await self.instantiate(
+                gamespace, game_id, game_version, game_server_name,
+                deployment_id, room_id, host,
+                game_settings, server_settings, room_settings, other_settings)
+            spawned = True
+        finally:
+            self.hosts.spawn_finished(host.host_id, spawned)
 
         if "location" not in result:
             raise RoomError("No location in result.")
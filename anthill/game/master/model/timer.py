@@ -0,0 +1,52 @@
+
+import math
+
+
+class TimerWheel(object):
+    """
+    A hashed timer wheel: a ring of `slots` buckets, each one covering `tick` seconds.
+    Adding a timer and advancing the wheel are O(1) regardless of how many timers are pending, and the timers
+        themselves are plain list entries instead of sleeping coroutines.
+
+    The wheel does not track time on its own, the owner is expected to call `advance` once every `tick` seconds
+        (e.g. with a PeriodicCallback).
+    """
+
+    def __init__(self, tick=1.0, slots=128):
+        self.tick = tick
+        self.buckets = [[] for _ in range(0, slots)]
+        self.position = 0
+        self.pending = 0
+
+    def add(self, delay, item):
+        ticks = max(int(math.ceil(delay / self.tick)), 1)
+        slots = len(self.buckets)
+
+        # amount of full turns the timer has to wait before it fires
+        rounds = (ticks - 1) // slots
+
+        self.buckets[(self.position + ticks) % slots].append([rounds, item])
+        self.pending += 1
+
+    def advance(self):
+        """
+        Moves the wheel one tick forward
+        :returns a list of items that are due
+        """
+
+        self.position = (self.position + 1) % len(self.buckets)
+
+        due = []
+        waiting = []
+
+        for timer in self.buckets[self.position]:
+            if timer[0] <= 0:
+                due.append(timer[1])
+            else:
+                timer[0] -= 1
+                waiting.append(timer)
+
+        self.buckets[self.position] = waiting
+        self.pending -= len(due)
+
+        return due
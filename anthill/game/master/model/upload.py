@@ -0,0 +1,531 @@
+
+from tornado.concurrent import run_on_executor
+from tornado.ioloop import IOLoop
+from tornado.locks import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from anthill.common import database
+from anthill.common.model import Model
+from anthill.common.options import options
+from anthill.common.validate import validate
+
+from .deploy import DeploymentAdapter, DeploymentError, DeploymentNotFound
+from .ziptest import ZipStreamTest
+
+import hashlib
+import logging
+import os
+
+
+class UploadError(Exception):
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return str(self.code) + ": " + self.message
+
+
+class UploadNotFound(Exception):
+    pass
+
+
+class UploadAdapter(object):
+    def __init__(self, data):
+        self.deployment_id = str(data.get("deployment_id"))
+        self.size = int(data.get("upload_size"))
+        self.part_size = int(data.get("upload_part_size"))
+        # whether some request is completing the upload at the moment
+        self.completing = bool(data.get("completing", False))
+
+    @property
+    def parts(self):
+        return max((self.size + self.part_size - 1) // self.part_size, 1)
+
+    def part_range(self, part_number):
+        start = part_number * self.part_size
+        return start, min(start + self.part_size, self.size)
+
+    def dump(self, received=None):
+        result = {
+            "deployment_id": self.deployment_id,
+            "size": self.size,
+            "part_size": self.part_size,
+            "parts": self.parts,
+            "completing": self.completing
+        }
+
+        if received is not None:
+            result["received"] = sorted(received)
+
+        return result
+
+
+class UploadCheck(object):
+    """
+    The sha256 and the zip test of an upload, run over the file in order as soon as the parts in front are there,
+        so by the time the last part arrives there is (almost) nothing left to check
+    """
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.zip_test = ZipStreamTest()
+        # how much of the file has been checked
+        self.position = 0
+        # a set of the parts known to be written
+        self.received = set()
+        self.lock = Lock()
+
+
+class UploadPart(object):
+    """
+    A part of the deployment file that is being written as the request body arrives,
+        see DeploymentUploadsModel.start_part
+    """
+
+    def __init__(self, upload, part_number, fd):
+        self.upload = upload
+        self.part_number = part_number
+        self.start, self.end = upload.part_range(part_number)
+        self.fd = fd
+        # where the next write goes, everything in front of it is written already
+        self.offset = self.start
+        self.sha256 = hashlib.sha256()
+        # what has been received, but not written yet
+        self.pending = bytearray()
+
+    @property
+    def received(self):
+        return self.offset + len(self.pending) - self.start
+
+
+class DeploymentUploadsModel(Model):
+    """
+    Uploads a deployment file in parts, so a large file can be uploaded with several connections at the same time,
+        and a broken upload can be resumed by sending only the parts that are missing.
+
+    The file is allocated in full once the upload starts, and each part is written right into its place. The parts
+        received are recorded in the database, so any instance can tell what's missing, as long as they all share
+        the deployments_location. Once every part is there, the upload is completed: the sha256 of the file is
+        checked against the one the client has been uploading, and the file against being a valid zip, and the
+        deployment becomes "uploaded", just like the one uploaded from the admin.
+    """
+
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    MIN_PART_SIZE = 1048576
+    MAX_PART_SIZE = 67108864
+
+    CHECK_CHUNK = 1048576
+    # the part being received is written down by that much, so no more than that is kept in memory
+    WRITE_CHUNK = 1048576
+
+    # an upload that is being completed for that long is considered abandoned, and can be completed again
+    COMPLETE_TIMEOUT = 600
+
+    def __init__(self, db, deployments):
+        self.db = db
+        self.deployments = deployments
+        # deployment_id -> UploadCheck of the uploads in progress on this instance
+        self.checks = {}
+
+    def get_setup_db(self):
+        return self.db
+
+    def get_setup_tables(self):
+        return ["deployment_uploads", "deployment_upload_parts"]
+
+    @run_on_executor
+    def __allocate__(self, filename, size):
+        directory = os.path.dirname(filename)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        with open(filename, "wb") as f:
+            f.truncate(size)
+
+    @validate(gamespace_id="int", game_name="str", game_version="str", size="int", part_size="int")
+    async def new_upload(self, gamespace_id, game_name, game_version, size, part_size=0):
+        """
+        Creates a new deployment to be uploaded in parts
+        :param size: the size of the deployment file
+        :param part_size: the size of each part but the last one, deployments_upload_part_size if 0
+        :returns an UploadAdapter
+        """
+
+        if size <= 0:
+            raise UploadError(400, "Bad size")
+
+        part_size = part_size or options.deployments_upload_part_size
+
+        if not DeploymentUploadsModel.MIN_PART_SIZE <= part_size <= DeploymentUploadsModel.MAX_PART_SIZE:
+            raise UploadError(400, "Part size should be between {0} and {1}".format(
+                DeploymentUploadsModel.MIN_PART_SIZE, DeploymentUploadsModel.MAX_PART_SIZE))
+
+        deployments = self.deployments
+
+        try:
+            deployment_id = await deployments.new_deployment(gamespace_id, game_name, game_version, "")
+            deployment = await deployments.get_deployment(gamespace_id, deployment_id)
+        except (DeploymentError, DeploymentNotFound) as e:
+            raise UploadError(500, "Failed to create a deployment: " + str(e))
+
+        try:
+            await self.__allocate__(deployments.get_deployment_path(deployment), size)
+        except OSError as e:
+            await deployments.update_deployment_status(gamespace_id, deployment_id, DeploymentAdapter.STATUS_ERROR)
+            raise UploadError(500, "Failed to allocate the deployment file: " + str(e))
+
+        try:
+            await self.db.insert(
+                """
+                INSERT INTO `deployment_uploads`
+                (`deployment_id`, `gamespace_id`, `upload_size`, `upload_part_size`)
+                VALUES (%s, %s, %s, %s);
+                """, deployment_id, gamespace_id, size, part_size)
+        except database.DatabaseError as e:
+            raise UploadError(500, "Failed to create an upload: " + e.args[1])
+
+        return UploadAdapter({
+            "deployment_id": deployment_id,
+            "upload_size": size,
+            "upload_part_size": part_size
+        })
+
+    @validate(gamespace_id="int", deployment_id="int")
+    async def get_upload(self, gamespace_id, deployment_id):
+        try:
+            upload = await self.db.get(
+                """
+                SELECT *, `upload_completing` > DATE_SUB(NOW(), INTERVAL %s SECOND) AS `completing`
+                FROM `deployment_uploads`
+                WHERE `gamespace_id`=%s AND `deployment_id`=%s
+                LIMIT 1;
+                """, DeploymentUploadsModel.COMPLETE_TIMEOUT, gamespace_id, deployment_id
+            )
+        except database.DatabaseError as e:
+            raise UploadError(500, "Failed to get upload: " + e.args[1])
+
+        if upload is None:
+            raise UploadNotFound()
+
+        return UploadAdapter(upload)
+
+    @validate(gamespace_id="int", deployment_id="int")
+    async def list_received_parts(self, gamespace_id, deployment_id):
+        """
+        :returns a dict of part_number -> sha256 of the parts received so far
+        """
+
+        try:
+            parts = await self.db.query(
+                """
+                SELECT `part_number`, `part_hash`
+                FROM `deployment_upload_parts`
+                WHERE `gamespace_id`=%s AND `deployment_id`=%s;
+                """, gamespace_id, deployment_id
+            )
+        except database.DatabaseError as e:
+            raise UploadError(500, "Failed to list received parts: " + e.args[1])
+
+        return {
+            part["part_number"]: part["part_hash"]
+            for part in parts
+        }
+
+    @run_on_executor
+    def __open_part__(self, filename):
+        return os.open(filename, os.O_WRONLY)
+
+    @run_on_executor
+    def __write_part__(self, fd, offset, data, sha256):
+        sha256.update(data)
+
+        view = memoryview(data)
+
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    async def __flush_part__(self, part):
+        if not part.pending:
+            return
+
+        data = bytes(part.pending)
+        part.pending.clear()
+
+        try:
+            await self.__write_part__(part.fd, part.offset, data, part.sha256)
+        except OSError as e:
+            raise UploadError(500, "Failed to write the part: " + str(e))
+
+        part.offset += len(data)
+
+    async def start_part(self, gamespace_id, deployment, upload, part_number):
+        """
+        Starts writing a part of the deployment file into its place. A part may be uploaded again,
+            if it has been broken. The contents are then passed with write_part as they arrive, and the part
+            is completed with finish_part (or given up with close_part).
+        :param deployment: a DeploymentAdapter of the deployment being uploaded
+        :param upload: an UploadAdapter of it
+        :returns an UploadPart
+        """
+
+        if deployment.status != DeploymentAdapter.STATUS_UPLOADING:
+            raise UploadError(409, "The deployment is not being uploaded")
+
+        if upload.completing:
+            raise UploadError(409, "The upload is being completed")
+
+        if not 0 <= part_number < upload.parts:
+            raise UploadError(400, "No such part")
+
+        check = self.checks.get(upload.deployment_id)
+        start, end = upload.part_range(part_number)
+
+        if check is not None and part_number in check.received and start < check.position:
+            # a part that has been checked already is overwritten, so the check starts over upon completion
+            self.checks.pop(upload.deployment_id, None)
+
+        try:
+            fd = await self.__open_part__(self.deployments.get_deployment_path(deployment))
+        except OSError as e:
+            raise UploadError(500, "Failed to write the part: " + str(e))
+
+        return UploadPart(upload, part_number, fd)
+
+    async def write_part(self, part, data):
+        size = part.end - part.start
+
+        if part.received + len(data) > size:
+            raise UploadError(400, "Part {0} should be {1} bytes long".format(part.part_number, size))
+
+        part.pending.extend(data)
+
+        if len(part.pending) >= DeploymentUploadsModel.WRITE_CHUNK:
+            await self.__flush_part__(part)
+
+    def close_part(self, part):
+        if part.fd is not None:
+            os.close(part.fd)
+            part.fd = None
+
+    async def finish_part(self, gamespace_id, deployment, part, part_hash=None):
+        """
+        Writes down the rest of the part, and records it as received
+        :param part_hash: the sha256 of the part the client has, to check it has arrived as it is
+        :returns the sha256 of the part
+        """
+
+        upload = part.upload
+        size = part.end - part.start
+
+        try:
+            await self.__flush_part__(part)
+        finally:
+            self.close_part(part)
+
+        if part.received != size:
+            raise UploadError(400, "Part {0} should be {1} bytes long".format(part.part_number, size))
+
+        part_number = part.part_number
+        received_hash = part.sha256.hexdigest()
+
+        if part_hash and part_hash.lower() != received_hash:
+            # the part is written anyway, but not recorded, so it is still missing
+            raise UploadError(400, "Part {0} has been corrupted on the way".format(part_number))
+
+        try:
+            await self.db.execute(
+                """
+                INSERT INTO `deployment_upload_parts`
+                (`deployment_id`, `gamespace_id`, `part_number`, `part_hash`)
+                VALUES (%s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE `part_hash`=%s;
+                """, upload.deployment_id, gamespace_id, part_number, received_hash, received_hash)
+        except database.DatabaseError as e:
+            raise UploadError(500, "Failed to record the part: " + e.args[1])
+
+        check = self.checks.get(upload.deployment_id)
+
+        if check is None:
+            check = self.checks[upload.deployment_id] = UploadCheck()
+
+        check.received.add(part_number)
+        # not waited for, so the part is confirmed as soon as it's written
+        IOLoop.current().spawn_callback(self.__advance_check_safe__, deployment, upload, check)
+
+        return received_hash
+
+    @run_on_executor
+    def __run_check__(self, check, filename, end):
+        fd = os.open(filename, os.O_RDONLY)
+
+        try:
+            while check.position < end:
+                data = os.pread(fd, min(DeploymentUploadsModel.CHECK_CHUNK, end - check.position), check.position)
+
+                if not data:
+                    raise OSError("Unexpected end of file")
+
+                check.sha256.update(data)
+                check.zip_test.feed(data)
+                check.position += len(data)
+        finally:
+            os.close(fd)
+
+    async def __advance_check__(self, deployment, upload, check):
+        """
+        Checks the file up to the first part that is not there yet
+        """
+
+        async with check.lock:
+            part_number = check.position // upload.part_size
+
+            while part_number in check.received:
+                part_number += 1
+
+            end = min(part_number * upload.part_size, upload.size)
+
+            if end > check.position:
+                await self.__run_check__(check, self.deployments.get_deployment_path(deployment), end)
+
+    async def __advance_check_safe__(self, deployment, upload, check):
+        try:
+            await self.__advance_check__(deployment, upload, check)
+        except OSError:
+            logging.exception("Failed to check upload of deployment {0}".format(upload.deployment_id))
+            # checked from scratch upon completion
+            if self.checks.get(upload.deployment_id) is check:
+                self.checks.pop(upload.deployment_id, None)
+
+    @run_on_executor
+    def __test_zip__(self, check, filename):
+        return check.zip_test.test(filename)
+
+    async def __claim_completion__(self, gamespace_id, deployment_id):
+        """
+        Marks the upload as being completed, unless some other request is on it already
+        :returns True if the upload has been claimed
+        """
+
+        try:
+            claimed = await self.db.execute(
+                """
+                UPDATE `deployment_uploads`
+                SET `upload_completing`=NOW()
+                WHERE `gamespace_id`=%s AND `deployment_id`=%s AND (`upload_completing` IS NULL OR
+                    `upload_completing` < DATE_SUB(NOW(), INTERVAL %s SECOND));
+                """, gamespace_id, deployment_id, DeploymentUploadsModel.COMPLETE_TIMEOUT
+            )
+        except database.DatabaseError as e:
+            raise UploadError(500, "Failed to complete the upload: " + e.args[1])
+
+        return bool(claimed)
+
+    async def __release_completion__(self, gamespace_id, deployment_id):
+        try:
+            await self.db.execute(
+                """
+                UPDATE `deployment_uploads`
+                SET `upload_completing`=NULL
+                WHERE `gamespace_id`=%s AND `deployment_id`=%s;
+                """, gamespace_id, deployment_id
+            )
+        except database.DatabaseError:
+            # it will be released by the timeout then
+            logging.exception("Failed to release upload of deployment {0}".format(deployment_id))
+
+    async def complete_upload(self, gamespace_id, deployment, upload, deployment_hash):
+        """
+        Completes the upload once all of the parts are there. Only one request can complete an upload at a time,
+            the others fail with 409, and no more parts are accepted meanwhile.
+
+        Only the upload itself is completed: the deployment becomes "uploaded", and it is up to the caller
+            to deliver it (see distribution.Delivery), just like the admin does with the deployment uploaded there.
+        :param deployment_hash: the sha256 of the whole file the client has
+        :returns the sha256 of the file
+        """
+
+        if deployment.status != DeploymentAdapter.STATUS_UPLOADING:
+            raise UploadError(409, "The deployment is not being uploaded")
+
+        if not await self.__claim_completion__(gamespace_id, upload.deployment_id):
+            raise UploadError(409, "The upload is being completed already")
+
+        try:
+            received_hash = await self.__complete__(gamespace_id, deployment, upload, deployment_hash)
+        except BaseException:
+            # so the client can fix whatever is wrong and try again
+            await self.__release_completion__(gamespace_id, upload.deployment_id)
+            raise
+
+        try:
+            await self.db.execute(
+                """
+                DELETE FROM `deployment_uploads`
+                WHERE `gamespace_id`=%s AND `deployment_id`=%s;
+                """, gamespace_id, upload.deployment_id
+            )
+        except database.DatabaseError:
+            logging.exception("Failed to delete upload of deployment {0}".format(upload.deployment_id))
+
+        return received_hash
+
+    async def __complete__(self, gamespace_id, deployment, upload, deployment_hash):
+        deployments = self.deployments
+
+        received = await self.list_received_parts(gamespace_id, upload.deployment_id)
+        missing = upload.parts - len(received)
+
+        if missing:
+            raise UploadError(409, "{0} part(s) are missing".format(missing))
+
+        check = self.checks.get(upload.deployment_id)
+
+        if check is None:
+            # the parts have been uploaded to another instance (or before a restart), checked from scratch then
+            check = self.checks[upload.deployment_id] = UploadCheck()
+
+        check.received.update(received.keys())
+
+        try:
+            await self.__advance_check__(deployment, upload, check)
+        except OSError as e:
+            raise UploadError(500, "Failed to check the deployment file: " + str(e))
+
+        received_hash = check.sha256.hexdigest()
+
+        if received_hash != deployment_hash.lower():
+            self.checks.pop(upload.deployment_id, None)
+            raise UploadError(409, "The deployment hash does not match: {0}".format(received_hash))
+
+        try:
+            bad_file = await self.__test_zip__(check, deployments.get_deployment_path(deployment))
+        except Exception as e:
+            bad_file = str(e) or "?"
+
+        self.checks.pop(upload.deployment_id, None)
+
+        if bad_file:
+            await deployments.update_deployment_status(
+                gamespace_id, upload.deployment_id, DeploymentAdapter.STATUS_ERROR)
+            raise UploadError(400, "Corrupted deployment file: " + str(bad_file))
+
+        if deployments.chunks is not None:
+            try:
+                await deployments.store_deployment_chunks(deployment)
+            except DeploymentError:
+                # the hosts will download the whole file then
+                logging.exception("Failed to store chunks of deployment {0}".format(upload.deployment_id))
+
+        try:
+            await deployments.update_deployment_hash(gamespace_id, upload.deployment_id, received_hash)
+            await deployments.update_deployment_status(
+                gamespace_id, upload.deployment_id, DeploymentAdapter.STATUS_UPLOADED)
+        except DeploymentError as e:
+            raise UploadError(500, "Failed to complete the upload: " + str(e))
+
+        return received_hash
@@ -0,0 +1,325 @@
+
+import logging
+import struct
+import zipfile
+import zlib
+
+
+class ZipStreamTest(object):
+    """
+    Tests a zip file for corruption while it's being written, chunk by chunk, so there is no need to read (and
+        decompress) it once again with ZipFile.testzip once it's there.
+
+    The local file entries are parsed as the data comes, the data of each one is decompressed and checked against
+        the CRC-32 (and the size) from its header, or from the data descriptor after it. Once the file is complete,
+        its central directory (the only part a ZipFile reads upon opening) is checked to point at the very entries
+        that have been tested (see verify).
+
+    Only the archives made of stored or deflated entries are tested that way, and the ones that have anything else
+        (other compression methods, encryption, data in front of the first entry) are left for testzip,
+        see `complete`.
+    """
+
+    LOCAL_HEADER = b"PK\x03\x04"
+    LOCAL_HEADER_FORMAT = "<4sHHHHHIIIHH"
+    LOCAL_HEADER_SIZE = 30
+    DATA_DESCRIPTOR = b"PK\x07\x08"
+    CENTRAL_DIRECTORY = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06")
+
+    STORED = 0
+    DEFLATED = 8
+
+    FLAG_ENCRYPTED = 0x01
+    FLAG_DATA_DESCRIPTOR = 0x08
+    FLAG_UTF8 = 0x800
+
+    ZIP64_EXTRA = 0x0001
+    ZIP64_LIMIT = 0xFFFFFFFF
+
+    # how much a piece of the compressed data is inflated into at once, so a small piece of a highly compressed
+    #   file does not take a lot of memory
+    INFLATE_CHUNK = 1048576
+
+    STATE_HEADER = 0
+    STATE_NAME = 1
+    STATE_DATA = 2
+    STATE_DESCRIPTOR = 3
+    STATE_DONE = 4
+
+    def __init__(self):
+        self.state = ZipStreamTest.STATE_HEADER
+        self.buffer = bytearray()
+        # the signature is checked first, as the end of the central directory is smaller than a local header
+        self.need = 4
+        # how many bytes have been consumed so far
+        self.position = 0
+
+        # False if the archive has something that cannot be tested that way
+        self.supported = True
+        # a name of the first file that has turned out to be corrupted
+        self.bad_file = None
+        # offset of the local header -> (crc, size) of every file tested
+        self.entries = {}
+
+        self.entry_offset = 0
+        self.entry_name = None
+        self.entry_flags = 0
+        self.entry_method = ZipStreamTest.STORED
+        self.entry_crc = 0
+        self.entry_size = None
+        self.entry_zip64 = False
+        # how many bytes of compressed data are left, None if unknown (there is a data descriptor after it)
+        self.remaining = None
+        self.inflater = None
+        self.crc = 0
+        self.size = 0
+
+    @property
+    def complete(self):
+        """
+        Whether the archive has been tested as a whole, and verify can be used instead of testzip
+        """
+        return self.supported and self.bad_file is None and self.state == ZipStreamTest.STATE_DONE
+
+    def __unsupported__(self, reason):
+        logging.info("Cannot test the zip file while it's being written ({0}), leaving it for later".format(reason))
+        self.supported = False
+
+    def __corrupted__(self):
+        self.bad_file = self.entry_name
+        self.state = ZipStreamTest.STATE_DONE
+
+    def feed(self, data):
+        """
+        Tests the next chunk of the file
+        """
+
+        if self.state == ZipStreamTest.STATE_DONE or not self.supported:
+            return
+
+        data = memoryview(data)
+        position = 0
+
+        while position < len(data) and self.supported and self.state != ZipStreamTest.STATE_DONE:
+            if self.state == ZipStreamTest.STATE_DATA:
+                position = self.__data__(data, position)
+                continue
+
+            take = min(self.need - len(self.buffer), len(data) - position)
+            self.buffer += data[position:position + take]
+            position += take
+            self.position += take
+
+            if len(self.buffer) < self.need:
+                continue
+
+            if self.state == ZipStreamTest.STATE_HEADER:
+                self.__header__()
+            elif self.state == ZipStreamTest.STATE_NAME:
+                self.__entry_header__()
+            else:
+                self.__descriptor__()
+
+    def __header__(self):
+        if self.need == 4:
+            signature = bytes(self.buffer)
+
+            if signature in ZipStreamTest.CENTRAL_DIRECTORY:
+                # no more files, and the central directory is checked by verify
+                self.state = ZipStreamTest.STATE_DONE
+            elif signature != ZipStreamTest.LOCAL_HEADER:
+                self.__unsupported__("unexpected data at offset {0}".format(self.position - len(self.buffer)))
+            else:
+                self.need = ZipStreamTest.LOCAL_HEADER_SIZE
+
+            return
+
+        (signature, version, self.entry_flags, self.entry_method, mod_time, mod_date,
+         self.entry_crc, compressed_size, self.entry_size,
+         name_length, extra_length) = struct.unpack(ZipStreamTest.LOCAL_HEADER_FORMAT, self.buffer)
+
+        self.entry_offset = self.position - len(self.buffer)
+        self.remaining = compressed_size
+        self.need = ZipStreamTest.LOCAL_HEADER_SIZE + name_length + extra_length
+        self.state = ZipStreamTest.STATE_NAME
+
+        if len(self.buffer) == self.need:
+            self.__entry_header__()
+
+    def __entry_header__(self):
+        name_length, extra_length = struct.unpack("<HH", self.buffer[26:ZipStreamTest.LOCAL_HEADER_SIZE])
+        name = bytes(self.buffer[ZipStreamTest.LOCAL_HEADER_SIZE:ZipStreamTest.LOCAL_HEADER_SIZE + name_length])
+        extra = bytes(self.buffer[ZipStreamTest.LOCAL_HEADER_SIZE + name_length:])
+
+        self.buffer = bytearray()
+        self.entry_name = name.decode("utf-8" if self.entry_flags & ZipStreamTest.FLAG_UTF8 else "cp437")
+
+        if self.entry_flags & ZipStreamTest.FLAG_ENCRYPTED:
+            self.__unsupported__("{0} is encrypted".format(self.entry_name))
+            return
+
+        if self.entry_method not in (ZipStreamTest.STORED, ZipStreamTest.DEFLATED):
+            self.__unsupported__("{0} is compressed with method {1}".format(self.entry_name, self.entry_method))
+            return
+
+        self.entry_zip64 = self.__zip64__(extra)
+
+        if self.entry_flags & ZipStreamTest.FLAG_DATA_DESCRIPTOR:
+            if self.entry_method == ZipStreamTest.STORED:
+                # the end of it cannot be known until the central directory
+                self.__unsupported__("{0} is stored with a data descriptor".format(self.entry_name))
+                return
+
+            self.remaining = None
+            self.entry_size = None
+
+        self.inflater = zlib.decompressobj(-15) if self.entry_method == ZipStreamTest.DEFLATED else None
+        self.crc = 0
+        self.size = 0
+        self.state = ZipStreamTest.STATE_DATA
+
+        if self.remaining == 0:
+            self.__entry_done__(self.entry_crc, self.entry_size)
+
+    def __zip64__(self, extra):
+        """
+        Replaces the sizes from the header with the ones from the zip64 extra field, if there is one
+        :returns whether there is one
+        """
+
+        offset = 0
+
+        while offset + 4 <= len(extra):
+            field_id, field_size = struct.unpack("<HH", extra[offset:offset + 4])
+            field = extra[offset + 4:offset + 4 + field_size]
+            offset += 4 + field_size
+
+            if field_id != ZipStreamTest.ZIP64_EXTRA:
+                continue
+
+            # the fields are only there for the sizes that did not fit into the header, in that order
+            values = list(struct.unpack("<{0}Q".format(len(field) // 8), field[:len(field) // 8 * 8]))
+
+            if self.entry_size == ZipStreamTest.ZIP64_LIMIT and values:
+                self.entry_size = values.pop(0)
+
+            if self.remaining == ZipStreamTest.ZIP64_LIMIT and values:
+                self.remaining = values.pop(0)
+
+            return True
+
+        return False
+
+    def __data__(self, data, position):
+        if self.remaining is None:
+            end = len(data)
+        else:
+            end = min(len(data), position + self.remaining)
+
+        piece = data[position:end]
+
+        if self.inflater is None:
+            self.crc = zlib.crc32(piece, self.crc)
+            self.size += len(piece)
+            consumed = len(piece)
+        elif self.inflater.eof:
+            # whatever is left after the end of the deflate stream, ignored as testzip does
+            consumed = len(piece)
+        else:
+            try:
+                self.__inflated__(self.inflater.decompress(piece, ZipStreamTest.INFLATE_CHUNK))
+
+                while self.inflater.unconsumed_tail and not self.inflater.eof:
+                    self.__inflated__(self.inflater.decompress(
+                        self.inflater.unconsumed_tail, ZipStreamTest.INFLATE_CHUNK))
+            except zlib.error:
+                self.__corrupted__()
+                return end
+
+            consumed = len(piece) - len(self.inflater.unused_data)
+
+        position += consumed
+        self.position += consumed
+
+        if self.remaining is None:
+            if self.inflater.eof:
+                self.buffer = bytearray()
+                self.need = 4
+                self.state = ZipStreamTest.STATE_DESCRIPTOR
+        else:
+            self.remaining -= consumed
+
+            if self.remaining == 0:
+                if self.inflater is not None and not self.inflater.eof:
+                    self.__corrupted__()
+                else:
+                    self.__entry_done__(self.entry_crc, self.entry_size)
+
+        return position
+
+    def __inflated__(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+
+    def __descriptor__(self):
+        sizes = 16 if self.entry_zip64 else 8
+
+        if self.need == 4:
+            # the signature of a data descriptor is optional
+            if bytes(self.buffer) == ZipStreamTest.DATA_DESCRIPTOR:
+                self.need = 8 + sizes
+            else:
+                self.need = 4 + sizes
+
+            return
+
+        descriptor = self.buffer[self.need - 4 - sizes:]
+        crc = struct.unpack("<I", descriptor[:4])[0]
+
+        if self.entry_zip64:
+            size = struct.unpack("<Q", descriptor[12:20])[0]
+        else:
+            size = struct.unpack("<I", descriptor[8:12])[0]
+
+        self.__entry_done__(crc, size)
+
+    def __entry_done__(self, crc, size):
+        if self.crc != crc or (size is not None and self.size != size):
+            self.__corrupted__()
+            return
+
+        self.entries[self.entry_offset] = (self.crc, self.size)
+
+        self.inflater = None
+        self.buffer = bytearray()
+        self.need = 4
+        self.state = ZipStreamTest.STATE_HEADER
+
+    def verify(self, zip_file):
+        """
+        Checks the central directory of a complete archive against the files tested
+        :param zip_file: a ZipFile of the archive
+        :returns a name of the first bad file, or None, like ZipFile.testzip does
+        """
+
+        for info in zip_file.infolist():
+            if self.entries.get(info.header_offset) != (info.CRC, info.file_size):
+                return info.filename
+
+        return None
+
+    def test(self, filename):
+        """
+        Tests the archive once it's complete: only its central directory if the files have been tested already,
+            or the whole of it with ZipFile.testzip otherwise
+        :returns a name of the first bad file, or None, like ZipFile.testzip does
+        """
+
+        if self.bad_file is not None:
+            return self.bad_file
+
+        with zipfile.ZipFile(filename) as zip_file:
+            if self.complete:
+                return self.verify(zip_file)
+
+            return zip_file.testzip()
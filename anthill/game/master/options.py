@@ -117,6 +117,64 @@ else:
                 "make sure this location is accessible from all instances (e.g. on a nfs).",
            type=str)
 
+define("deployments_download_chunk",
+       default=1048576,
+       help="A size (in bytes) of the slices the deployment files are sent to the hosts with. Larger slices cost "
+            "less CPU per byte, but take more memory per download in progress.",
+       type=int)
+
+define("deployments_delta_delivery",
+       default=False,
+       help="Split the deployment files into a content-addressed chunk store (next to deployments_location), so "
+            "the hosts could download only the chunks they don't have. Requires the host controllers to support "
+            "'deploy_delivery_chunks', the ones that don't get the whole file.",
+       type=bool)
+
+define("deployments_delivery_fanout",
+       default=0,
+       help="How many hosts of the same region a host that already has a deployment delivers it to, at the same "
+            "time. Requires the host controllers to support 'deploy_delivery_peer'. "
+            "Set 0 to deliver to every host from the master.",
+       type=int)
+
+define("deployments_delivery_seeds",
+       default=4,
+       help="How many hosts of a region download a deployment from the master at the same time, if "
+            "deployments_delivery_fanout is set.",
+       type=int)
+
+define("deployments_delivery_concurrency",
+       default=64,
+       help="How many hosts a deployment is delivered to at the same time overall. Set 0 for no limit.",
+       type=int)
+
+define("deployments_delivery_region_concurrency",
+       default=0,
+       help="How many hosts of a region a deployment is delivered to at the same time. Set 0 for no limit.",
+       type=int)
+
+define("deployments_delivery_retries",
+       default=3,
+       help="How many times a failed delivery of a deployment to a host is retried.",
+       type=int)
+
+define("deployments_delivery_backoff",
+       default=5.0,
+       help="How long (in seconds) to wait before retrying a failed delivery, doubled with each next retry.",
+       type=float)
+
+define("deployments_upload_part_size",
+       default=8388608,
+       help="A size (in bytes) of the parts a deployment file is uploaded in, if the client has not asked for "
+            "the other one.",
+       type=int)
+
+define("deployments_catch_up_concurrency",
+       default=4,
+       help="How many deployments are delivered at the same time to the hosts that have just connected and "
+            "miss some of the current deployments.",
+       type=int)
+
 # Rabbitmq
 
 define("party_broker",
@@ -124,3 +182,106 @@ define("party_broker",
        help="RabbitMQ broker location for party messaging (amqp).",
        group="message",
        type=str)
+
+# Rooms
+
+define("rooms_index_refresh",
+       default=5,
+       help="How often (in seconds) the in-memory room index is refreshed from the database. "
+            "Every instance keeps its own index, and the slot claim is always checked by the database, "
+            "so the index stays coherent across several instances. Set 0 to disable the index.",
+       group="rooms",
+       type=int)
+
+define("rooms_join_mode",
+       default="locking",
+       help="How the room slots are reserved when the room is searched in the database: "
+            "'optimistic' claims the slots with a single conditional update and moves on to the next candidate "
+            "room should it fail, 'locking' locks the room with SELECT ... FOR UPDATE first. "
+            "See tests/bench_join.py to compare both on a particular database.",
+       group="rooms",
+       type=str)
+
+define("rooms_join_coalesce",
+       default=0,
+       help="A window (in milliseconds) during which concurrent join requests with the same search "
+            "parameters are collected and joined in one go (one search, one insert per room). "
+            "Something like 20-50 is reasonable during high load. Set 0 to disable.",
+       group="rooms",
+       type=int)
+
+define("rooms_reconcile_period",
+       default=60,
+       help="How often (in seconds) the room player counters are checked against the actual player records, "
+            "and fixed if drifted away. Set 0 to disable.",
+       group="rooms",
+       type=int)
+
+# Hosts
+
+define("hosts_registry_refresh",
+       default=10,
+       help="How often (in seconds) the in-memory hosts registry is refreshed from the database. "
+            "Set 0 to disable the registry and pick hosts with the database instead.",
+       group="hosts",
+       type=int)
+
+define("hosts_spawn_cost",
+       default=2,
+       help="An estimated load (in percents) a freshly spawned game server adds to a host, used until "
+            "the actual cost of a room on that host is observed from its heartbeats.",
+       group="hosts",
+       type=int)
+
+define("hosts_placement",
+       default="p2c",
+       help="How a host for a new room is picked: "
+            "'p2c' (the less loaded of two random hosts) or 'best_fit' (pack rooms onto the most loaded host "
+            "that still fits).",
+       group="hosts",
+       type=str)
+
+define("hosts_memory_limit",
+       default=90,
+       help="Memory usage (in percents) a host is not expected to go above when a new room is placed onto it.",
+       group="hosts",
+       type=int)
+
+define("hosts_cpu_limit",
+       default=95,
+       help="CPU usage (in percents) a host is not expected to go above when a new room is placed onto it.",
+       group="hosts",
+       type=int)
+
+# GeoIP
+
+define("geoip_database",
+       default="",
+       help="A path to a GeoIP database (mmdb) to use instead of the bundled one. "
+            "The file is checked for changes every minute and reloaded, so it can be updated in place.",
+       group="geoip",
+       type=str)
+
+define("geoip_cache_size",
+       default=65536,
+       help="How many networks (/24 for IPv4, /48 for IPv6) to keep resolved locations and regions for.",
+       group="geoip",
+       type=int)
+
+# Game servers
+
+define("gameservers_cache_refresh",
+       default=30,
+       help="How often (in seconds) the in-memory game servers configuration is reloaded from the database, "
+            "to pick up the changes made on other nodes. Set 0 to disable the cache.",
+       group="gameservers",
+       type=int)
+
+# Bans
+
+define("bans_index_refresh",
+       default=10,
+       help="How often (in seconds) the in-memory index of active bans picks up the new bans from the database. "
+            "Set 0 to disable the index and check the bans with the database instead.",
+       group="bans",
+       type=int)
@@ -9,10 +9,14 @@ from .model.gameserver import GameServersModel
 from .model.room import RoomsModel
 from .model.controller import ControllersClientModel
 from .model.host import HostsModel
+from .model.geo import GeoModel
 from .model.deploy import DeploymentModel
 from .model.ban import BansModel
 from .model.party import PartyModel
+from .model.catchup import DeliveryCatchUpModel
+from .model.upload import DeploymentUploadsModel
 from .model.rpc import GameControllerRPC
+from .model.bus import CacheBus
 
 
 class GameMasterServer(server.Server):
@@ -37,11 +41,15 @@ class GameMasterServer(server.Server):
             options.internal_max_connections,
             options.internal_channel_prefetch_count)
 
-        self.gameservers = GameServersModel(self.db)
-        self.hosts = HostsModel(self.db)
+        self.bus = CacheBus()
+        self.gameservers = GameServersModel(self.db, self.bus)
+        self.hosts = HostsModel(self.db, self.bus)
+        self.geo = GeoModel(self, self.hosts)
         self.rooms = RoomsModel(self, self.db, self.hosts)
-        self.deployments = DeploymentModel(self.db)
-        self.bans = BansModel(self.db)
+        self.deployments = DeploymentModel(self.db, self.bus)
+        self.uploads = DeploymentUploadsModel(self.db, self.deployments)
+        self.bans = BansModel(self.db, self.bus)
+        self.catch_up = DeliveryCatchUpModel(self, self.deployments, self.hosts)
 
         self.ctl_client = ControllersClientModel(self.rooms, self.deployments)
 
@@ -51,10 +59,11 @@ class GameMasterServer(server.Server):
 
         self.parties = PartyModel(
             self.db, self.gameservers, self.deployments,
-            self.ratelimit, self.hosts, self.rooms)
+            self.ratelimit, self.hosts, self.rooms, self.bans)
 
     def get_models(self):
-        return [self.rpc, self.hosts, self.rooms, self.gameservers, self.deployments, self.bans, self.parties]
+        return [self.rpc, self.bus, self.hosts, self.geo, self.rooms, self.gameservers, self.deployments, self.bans,
+                self.parties, self.catch_up, self.uploads]
 
     def get_admin(self):
         return {
@@ -80,13 +89,16 @@ class GameMasterServer(server.Server):
 
             "new_ban": admin.IssueBanController,
             "mass_ban": admin.IssueMultipleBansController,
+            "range_bans": admin.RangeBansController,
             "find_active_ban": admin.FindBanController,
             "ban": admin.BanController
         }
 
     def get_admin_stream(self):
         return {
-            "debug_controller": admin.DebugControllerAction
+            "debug_controller": admin.DebugControllerAction,
+            "mass_ban": admin.MassBanAction,
+            "delivery_progress": admin.DeliveryProgressAction
         }
 
     def get_internal_handler(self):
@@ -108,7 +120,13 @@ class GameMasterServer(server.Server):
             (r"/create/multi/(.*)/(.*)/(.*)", h.CreateMultiHandler),
             (r"/create/(.*)/(.*)/(.*)", h.CreateHandler),
             (r"/host", h.HostHandler),
+            (r"/deployment/(.*)/(.*)/(.*)/manifest", h.HostDeploymentManifestHandler),
             (r"/deployment/(.*)/(.*)/(.*)", h.HostDeploymentHandler),
+            (r"/chunk/([0-9a-f]{64})", h.HostDeploymentChunkHandler),
+            (r"/upload/(.*)/(.*)/([0-9]+)/part/([0-9]+)", h.DeploymentUploadPartHandler),
+            (r"/upload/(.*)/(.*)/([0-9]+)/complete", h.DeploymentUploadCompleteHandler),
+            (r"/upload/(.*)/(.*)/([0-9]+)", h.DeploymentUploadStatusHandler),
+            (r"/upload/(.*)/(.*)", h.DeploymentUploadHandler),
             (r"/status", h.StatusHandler),
             (r"/players", h.MultiplePlayersRecordsHandler),
             (r"/player/(.*)", h.PlayerRecordsHandler),
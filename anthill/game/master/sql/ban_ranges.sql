@@ -0,0 +1,11 @@
+CREATE TABLE `ban_ranges` (
+  `range_id` int(11) NOT NULL AUTO_INCREMENT,
+  `range_gamespace` int(11) NOT NULL,
+  `range_network` varchar(64) NOT NULL,
+  `range_start` varbinary(16) NOT NULL,
+  `range_end` varbinary(16) NOT NULL,
+  `range_reason` varchar(255) NOT NULL,
+  `range_expires` datetime NOT NULL,
+  PRIMARY KEY (`range_id`),
+  KEY `range_start` (`range_gamespace`,`range_start`,`range_end`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,8 @@
+CREATE TABLE `deployment_upload_parts` (
+  `deployment_id` int(11) NOT NULL,
+  `gamespace_id` int(11) NOT NULL,
+  `part_number` int(11) NOT NULL,
+  `part_hash` varchar(64) NOT NULL DEFAULT '',
+  PRIMARY KEY (`deployment_id`,`part_number`),
+  CONSTRAINT `deployment_upload_parts_ibfk_1` FOREIGN KEY (`deployment_id`) REFERENCES `deployment_uploads` (`deployment_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
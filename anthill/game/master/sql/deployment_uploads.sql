@@ -0,0 +1,9 @@
+CREATE TABLE `deployment_uploads` (
+  `deployment_id` int(11) NOT NULL,
+  `gamespace_id` int(11) NOT NULL,
+  `upload_size` bigint(20) NOT NULL,
+  `upload_part_size` int(11) NOT NULL,
+  `upload_completing` datetime DEFAULT NULL,
+  PRIMARY KEY (`deployment_id`),
+  CONSTRAINT `deployment_uploads_ibfk_1` FOREIGN KEY (`deployment_id`) REFERENCES `deployments` (`deployment_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
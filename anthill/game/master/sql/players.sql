@@ -8,8 +8,10 @@ CREATE TABLE `players` (
   `key` varchar(64) NOT NULL DEFAULT '',
   `access_token` mediumtext NOT NULL,
   `info` json DEFAULT NULL,
+  `reserved_at` datetime DEFAULT NULL,
   PRIMARY KEY (`record_id`),
   KEY `room_id` (`room_id`),
   KEY `key` (`key`),
-  KEY `gamespace_id` (`gamespace_id`,`account_id`)
+  KEY `gamespace_id` (`gamespace_id`,`account_id`),
+  KEY `reserved_at` (`state`,`reserved_at`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -0,0 +1,65 @@
+(function(div, context)
+{
+    var controller = {
+        ws: new ServiceJsonRPC(SERVICE, "delivery_progress", context),
+        format_bytes: function(value)
+        {
+            var units = ["B", "KB", "MB", "GB", "TB"];
+            var unit = 0;
+
+            while (value >= 1024 && unit < units.length - 1)
+            {
+                value /= 1024;
+                unit++;
+            }
+
+            return value.toFixed(unit ? 1 : 0) + " " + units[unit];
+        },
+        update: function(progress)
+        {
+            var hosts = progress.hosts || 1;
+            var delivered = Math.round(progress.delivered * 100 / hosts);
+            var failed = Math.round(progress.failed * 100 / hosts);
+
+            this.delivered_bar.css("width", delivered + "%");
+            this.failed_bar.css("width", failed + "%");
+
+            var text = progress.delivered + " of " + progress.hosts + " hosts, " +
+                this.format_bytes(progress.bytes) + " of " + this.format_bytes(progress.total_bytes) +
+                " in " + Math.round(progress.time) + "s";
+
+            if (progress.failed)
+            {
+                text += ", " + progress.failed + " failed";
+            }
+
+            if (progress.finished)
+            {
+                text += " (finished, refresh for the host statuses)";
+            }
+
+            this.status.text(text);
+            this.panel.show();
+        },
+        init: function(div, context)
+        {
+            var zis = this;
+
+            this.panel = $('<div class="panel panel-default"></div>').appendTo(div).hide();
+            $('<div class="panel-heading">Delivery progress</div>').appendTo(this.panel);
+            var body = $('<div class="panel-body"></div>').appendTo(this.panel);
+
+            var bar = $('<div class="progress"></div>').appendTo(body);
+            this.delivered_bar = $('<div class="progress-bar progress-bar-success"></div>').appendTo(bar);
+            this.failed_bar = $('<div class="progress-bar progress-bar-danger"></div>').appendTo(bar);
+            this.status = $('<div></div>').appendTo(body);
+
+            this.ws.handle("progress", function(payload)
+            {
+                zis.update(payload);
+            });
+        }
+    };
+
+    controller.init(div, context);
+});
@@ -0,0 +1,119 @@
+(function(div, context)
+{
+    var controller = {
+        ws: new ServiceJsonRPC(SERVICE, "mass_ban", context),
+        busy: false,
+        parse_accounts: function(text)
+        {
+            var accounts = text.match(/\d+/g);
+            return accounts === null ? [] : accounts;
+        },
+        set_progress: function(done, total)
+        {
+            var percent = total ? Math.round(done * 100 / total) : 100;
+
+            this.progress_bar.css("width", percent + "%").text(done + " / " + total);
+        },
+        issue: function()
+        {
+            if (this.busy)
+                return;
+
+            var accounts = this.parse_accounts(this.accounts.val());
+
+            if (accounts.length === 0)
+            {
+                notify_error("No accounts to ban");
+                return;
+            }
+
+            var zis = this;
+
+            this.busy = true;
+            this.button.addClass("disabled");
+            this.results.html('');
+            this.progress.show();
+            this.set_progress(0, accounts.length);
+
+            this.ws.request("issue", {
+                "accounts": accounts,
+                "reason": this.reason.val(),
+                "expires": this.expires.val()
+            }).done(function(summary)
+            {
+                zis.render_summary(summary);
+                notify_success("Bans have been issued");
+            }).fail(function(code, message, data)
+            {
+                notify_error("Error " + code + ": " + message);
+            }).always(function()
+            {
+                zis.busy = false;
+                zis.button.removeClass("disabled");
+            });
+        },
+        render_summary: function(summary)
+        {
+            var table = $('<table class="table"></table>').appendTo(this.results);
+
+            var titles = {
+                "banned": "Banned",
+                "updated": "Expired ban renewed",
+                "already_banned": "Already banned",
+                "failed": "Failed"
+            };
+
+            for (var status in titles)
+            {
+                var accounts = summary[status] || [];
+
+                if (accounts.length === 0)
+                    continue;
+
+                var tr = $('<tr></tr>').appendTo(table);
+                $('<th></th>').text(titles[status] + " (" + accounts.length + ")").appendTo(tr);
+                $('<td></td>').text(accounts.join(", ")).appendTo(tr);
+            }
+        },
+        init: function(div, context)
+        {
+            var zis = this;
+
+            var panel = $('<div class="panel panel-primary"></div>').appendTo(div);
+            $('<div class="panel-heading">New bans</div>').appendTo(panel);
+            var body = $('<div class="panel-body"></div>').appendTo(panel);
+
+            $('<label>Account IDs (sepatated with spaces, commas, or with newlines)</label>').appendTo(body);
+            this.accounts = $('<textarea class="form-control" rows="10"></textarea>').appendTo(body);
+
+            $('<label>Reason</label>').appendTo(body);
+            this.reason = $('<input type="text" class="form-control">').appendTo(body);
+
+            $('<label>Expires</label>').appendTo(body);
+            this.expires = $('<input type="text" class="form-control">').val(context["expires"]).appendTo(body);
+
+            this.button = $('<a href="#" class="btn btn-primary" style="margin-top: 10px;">Create</a>').
+                appendTo(body).click(function()
+            {
+                zis.issue();
+                return false;
+            });
+
+            this.progress = $('<div class="progress" style="margin-top: 10px;"></div>').appendTo(body).hide();
+            this.progress_bar = $('<div class="progress-bar" role="progressbar"></div>').appendTo(this.progress);
+            this.results = $('<div></div>').appendTo(body);
+
+            this.ws.handle("progress", function(payload)
+            {
+                zis.set_progress(payload.done, payload.total);
+            });
+
+            this.ws.onclose = function (code, reaspon)
+            {
+                notify_error('Error ' + code + ": " + reaspon);
+            };
+        }
+    };
+
+    controller.init(div, context);
+});
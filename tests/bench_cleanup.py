@@ -0,0 +1,149 @@
+"""
+Removes every player of a host, spread across its rooms, against an actual MySQL: once the way it used to be done,
+    with the player_removal trigger recounting the room for every deleted row, and once the way it's done now,
+    with __delete_players__ decrementing the counters grouped by room.
+
+    TEST_MYSQL_HOST=localhost python -m tests.bench_cleanup [players] [rooms]
+
+The counters are expected to be correct after either of them.
+"""
+
+from tornado.ioloop import IOLoop
+
+from anthill.game.master.model.room import RoomsModel
+
+from .mysql import ScratchDatabase, configured
+
+import time
+import sys
+
+
+HOST_ID = 1
+# another host, which rooms are expected to be left alone
+OTHER_HOST_ID = 2
+
+PLAYER_REMOVAL_TRIGGER = """
+CREATE TRIGGER `player_removal`
+AFTER DELETE ON `players`
+FOR EACH ROW
+  UPDATE `rooms` r
+  SET `players`=(
+    SELECT COUNT(*)
+    FROM `players` p
+    WHERE p.room_id = r.room_id
+  )
+  WHERE `room_id`=OLD.`room_id`;
+"""
+
+
+def seed(scratch, players, rooms):
+    connection = scratch.connect()
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TRIGGER IF EXISTS `player_removal`;")
+            cursor.execute("TRUNCATE TABLE `players`;")
+            cursor.execute("DELETE FROM `rooms`;")
+
+            cursor.executemany(
+                """
+                INSERT INTO `rooms`
+                (`room_id`, `gamespace_id`, `game_name`, `game_version`, `game_server_id`, `max_players`,
+                 `settings`, `location`, `state`, `host_id`, `region_id`, `deployment_id`)
+                VALUES (%s, 1, 'bench', '1.0', 1, %s, '{}', '{}', 'SPAWNED', %s, 1, 1);
+                """, [
+                    (room_id, players, HOST_ID if room_id <= rooms else OTHER_HOST_ID)
+                    for room_id in range(1, rooms * 2 + 1)
+                ])
+
+            # the same amount of players on the other host
+            records = []
+
+            for account_id in range(1, players * 2 + 1):
+                room_id = account_id % (rooms * 2) + 1
+                records.append((account_id, room_id, HOST_ID if room_id <= rooms else OTHER_HOST_ID))
+
+            cursor.executemany(
+                """
+                INSERT INTO `players`
+                (`gamespace_id`, `account_id`, `room_id`, `host_id`, `state`, `key`, `access_token`)
+                VALUES (1, %s, %s, %s, 'JOINED', '', '');
+                """, records)
+
+            cursor.execute(
+                """
+                UPDATE `rooms` r
+                SET r.`players`=(SELECT COUNT(*) FROM `players` p WHERE p.`room_id` = r.`room_id`);
+                """)
+    finally:
+        connection.close()
+
+
+def check(scratch):
+    connection = scratch.connect()
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT COUNT(*) FROM `rooms` r
+                WHERE r.`players` != (SELECT COUNT(*) FROM `players` p WHERE p.`room_id` = r.`room_id`);
+                """)
+            drifted, = cursor.fetchone()
+
+            cursor.execute("SELECT COUNT(*) FROM `players` WHERE `host_id`=%s;", (OTHER_HOST_ID,))
+            left, = cursor.fetchone()
+    finally:
+        connection.close()
+
+    return drifted, left
+
+
+def cleanup_trigger(scratch):
+    connection = scratch.connect()
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(PLAYER_REMOVAL_TRIGGER)
+
+            started = time.time()
+            cursor.execute("DELETE FROM `players` WHERE `host_id`=%s;", (HOST_ID,))
+            return cursor.rowcount, time.time() - started
+    finally:
+        connection.close()
+
+
+def cleanup_grouped(scratch):
+    rooms = RoomsModel.__new__(RoomsModel)
+
+    rooms.db = scratch.database()
+    rooms.index = None
+
+    started = time.time()
+    removed = IOLoop.current().run_sync(lambda: rooms.__delete_players__("`host_id`=%s", HOST_ID))
+    return removed, time.time() - started
+
+
+def main():
+    if not configured():
+        print("TEST_MYSQL_HOST is not set, nothing to benchmark against")
+        return
+
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rooms = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    with ScratchDatabase("bench_cleanup", ["rooms", "players"]) as scratch:
+        print("{0} players over {1} rooms of a host".format(players, rooms))
+
+        for name, cleanup in [("trigger", cleanup_trigger), ("grouped", cleanup_grouped)]:
+            seed(scratch, players, rooms)
+
+            removed, elapsed = cleanup(scratch)
+            drifted, left = check(scratch)
+
+            print("{0:>8}: {1:.3f}s, removed {2}, left on the other host {3}, drifted counters {4}".format(
+                name, elapsed, removed, left, drifted))
+
+
+if __name__ == "__main__":
+    main()
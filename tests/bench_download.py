@@ -0,0 +1,149 @@
+"""
+Sends a deployment file out the way the hosts download it: once the way it used to be done, reading it 16 KB at a
+    time on a thread and handing every chunk over to the IOLoop, and once with download_deployment_file taking
+    slices of a memory mapping, with a small and with the default slice size.
+
+    python -m tests.bench_download [size in MB] [concurrent downloads]
+
+Every download is expected to receive the whole file.
+"""
+
+from tornado.ioloop import IOLoop
+from tornado.gen import multi
+
+from anthill.game.master.model.deploy import DeploymentModel
+
+from concurrent.futures import ThreadPoolExecutor
+
+import threading
+import tempfile
+import hashlib
+import time
+import sys
+import os
+
+
+OLD_CHUNK = 16384
+WRITE_CHUNK = 1048576
+
+
+class Sink(object):
+    """
+    Stands for the response: takes the chunks in, and, if asked to, hashes them to make sure nothing's lost or
+        reordered (which takes a lot more than sending them out, so it's not done on the timed runs)
+    """
+
+    def __init__(self, check=False):
+        self.sha256 = hashlib.sha256() if check else None
+        self.received = 0
+
+    def write(self, data):
+        if self.sha256 is not None:
+            self.sha256.update(data)
+        self.received += len(data)
+
+
+def old_download(executor, filename, sink):
+    """
+    The way download_deployment_file used to be: a 16 KB read on the thread, a callback on the IOLoop to write
+        it out, and a lock to wait for that
+    """
+
+    ioloop = IOLoop.current()
+    lock = threading.Lock()
+
+    def write_chunk(chunk):
+        sink.write(chunk)
+        lock.release()
+
+    def download():
+        with open(filename, 'rb') as f:
+            while 1:
+                data = f.read(OLD_CHUNK)
+                if data:
+                    lock.acquire()
+                    ioloop.add_callback(write_chunk, data)
+                else:
+                    return
+
+    return ioloop.run_in_executor(executor, download)
+
+
+async def new_download(deployments, deployment_file, sink):
+    async def write_callback(data):
+        sink.write(data)
+
+    await deployments.download_deployment_file(deployment_file, write_callback)
+
+
+def deployments_model(download_chunk):
+    deployments = DeploymentModel.__new__(DeploymentModel)
+    deployments.download_chunk = download_chunk
+    return deployments
+
+
+async def run(filename, size, concurrent, expected):
+    results = []
+
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    async def old(check):
+        sinks = [Sink(check) for i in range(0, concurrent)]
+        await multi([old_download(executor, filename, sink) for sink in sinks])
+        return sinks
+
+    async def new(download_chunk, check):
+        deployments = deployments_model(download_chunk)
+        deployment_file = await deployments.__open_deployment_file__(filename)
+
+        try:
+            sinks = [Sink(check) for i in range(0, concurrent)]
+            await multi([new_download(deployments, deployment_file, sink) for sink in sinks])
+            return sinks
+        finally:
+            deployment_file.close()
+
+    for name, download in [
+            ("16 KB reads", old),
+            ("16 KB slices", lambda check: new(16384, check)),
+            ("1 MB slices", lambda check: new(1048576, check))]:
+
+        started = time.time()
+        await download(False)
+        elapsed = time.time() - started
+
+        sinks = await download(True)
+        broken = len([sink for sink in sinks if sink.received != size or sink.sha256.hexdigest() != expected])
+        results.append((name, elapsed, size * concurrent / elapsed / (1 << 30), broken))
+
+    executor.shutdown()
+    return results
+
+
+def main():
+    size = (int(sys.argv[1]) if len(sys.argv) > 1 else 256) * 1048576
+    concurrent = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    fd, filename = tempfile.mkstemp(suffix=".zip")
+
+    try:
+        sha256 = hashlib.sha256()
+
+        with os.fdopen(fd, "wb") as f:
+            for offset in range(0, size, WRITE_CHUNK):
+                data = os.urandom(min(WRITE_CHUNK, size - offset))
+                sha256.update(data)
+                f.write(data)
+
+        print("{0} MB file, {1} concurrent downloads".format(size // 1048576, concurrent))
+
+        results = IOLoop.current().run_sync(lambda: run(filename, size, concurrent, sha256.hexdigest()))
+
+        for name, elapsed, throughput, broken in results:
+            print("{0:>14}: {1:.2f}s, {2:.1f} GB/s, broken downloads {3}".format(name, elapsed, throughput, broken))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Compares the 'locking' and the 'optimistic' rooms_join_mode under contention: a lot of concurrent
+    find_and_join_room calls over a few rooms, against an actual MySQL.
+
+    TEST_MYSQL_HOST=localhost python -m tests.bench_join [joins] [concurrency] [rooms]
+
+Each mode is expected to fill every room exactly up to max_players, and never more than that.
+"""
+
+from tornado.ioloop import IOLoop
+from tornado.gen import multi
+from tornado.locks import Semaphore
+
+from anthill.game.master.model.room import RoomsModel, RoomNotFound, RoomError
+from anthill.game.master.model.timer import TimerWheel
+from anthill.common.options import options
+
+from anthill.game.master import options as _opts
+
+from .mysql import ScratchDatabase, configured
+
+import ujson
+import time
+import sys
+
+
+MAX_PLAYERS = 16
+HOSTS = 4
+
+
+def seed(scratch, rooms):
+    connection = scratch.connect()
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("TRUNCATE TABLE `players`;")
+            cursor.execute("DELETE FROM `rooms`;")
+            cursor.execute("DELETE FROM `hosts`;")
+
+            cursor.executemany(
+                """
+                INSERT INTO `hosts` (`host_id`, `host_address`, `host_region`, `host_enabled`, `host_state`)
+                VALUES (%s, 'localhost', 1, 1, 'ACTIVE');
+                """, [(host_id,) for host_id in range(1, HOSTS + 1)])
+
+            cursor.executemany(
+                """
+                INSERT INTO `rooms`
+                (`room_id`, `gamespace_id`, `game_name`, `game_version`, `game_server_id`, `max_players`,
+                 `settings`, `location`, `state`, `host_id`, `region_id`, `deployment_id`)
+                VALUES (%s, 1, 'bench', '1.0', 1, %s, %s, '{}', 'SPAWNED', %s, 1, 1);
+                """, [
+                    (room_id, MAX_PLAYERS, ujson.dumps({"mode": "ffa" if room_id % 2 else "ctf"}),
+                     room_id % HOSTS + 1)
+                    for room_id in range(1, rooms + 1)
+                ])
+    finally:
+        connection.close()
+
+
+def check(scratch):
+    connection = scratch.connect()
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM `rooms` WHERE `players` > `max_players`;")
+            overfilled, = cursor.fetchone()
+
+            cursor.execute(
+                """
+                SELECT COUNT(*) FROM `rooms` r
+                WHERE r.`players` != (SELECT COUNT(*) FROM `players` p WHERE p.`room_id` = r.`room_id`);
+                """)
+            drifted, = cursor.fetchone()
+
+            cursor.execute("SELECT COUNT(*) FROM `players`;")
+            players, = cursor.fetchone()
+    finally:
+        connection.close()
+
+    return overfilled, drifted, players
+
+
+async def run(rooms, joins, concurrency):
+    semaphore = Semaphore(concurrency)
+    result = {"joined": 0, "not_found": 0, "failed": 0}
+
+    async def join(account_id):
+        async with semaphore:
+            try:
+                await rooms.find_and_join_room(
+                    1, "bench", "1.0", 1, account_id, "token", {}, {"mode": ["ffa", "ctf"]})
+            except RoomNotFound:
+                result["not_found"] += 1
+            except RoomError:
+                result["failed"] += 1
+            else:
+                result["joined"] += 1
+
+    started = time.time()
+    await multi([join(account_id) for account_id in range(1, joins + 1)])
+
+    return result, time.time() - started
+
+
+def main():
+    if not configured():
+        print("TEST_MYSQL_HOST is not set, nothing to benchmark against")
+        return
+
+    joins = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rooms_count = int(sys.argv[3]) if len(sys.argv) > 3 else joins // MAX_PLAYERS
+
+    options.rooms_join_coalesce = 0
+
+    with ScratchDatabase("bench_join", ["hosts", "rooms", "players"]) as scratch:
+        rooms = RoomsModel.__new__(RoomsModel)
+
+        rooms.db = scratch.database()
+        rooms.index = None
+        rooms.join_batches = {}
+        rooms.expiry_wheel = TimerWheel(tick=RoomsModel.EXPIRY_TICK)
+
+        print("{0} joins, {1} at a time, over {2} rooms of {3} players".format(
+            joins, concurrency, rooms_count, MAX_PLAYERS))
+
+        for mode in ["locking", "optimistic"]:
+            seed(scratch, rooms_count)
+            options.rooms_join_mode = mode
+
+            result, elapsed = IOLoop.current().run_sync(lambda: run(rooms, joins, concurrency))
+            overfilled, drifted, players = check(scratch)
+
+            print("{0:>10}: {1:.2f}s, {2:.0f} joins/s, joined {3}, not found {4}, failed {5}; "
+                  "players {6}, overfilled rooms {7}, drifted counters {8}".format(
+                      mode, elapsed, joins / elapsed, result["joined"], result["not_found"], result["failed"],
+                      players, overfilled, drifted))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Looks the addresses up among a lot of network bans: with the NetworkTrie the ban index keeps, and, for a few of
+    them, with a linear scan over every network, the way it would have to be done without one.
+
+    python -m tests.bench_prefix [prefixes] [lookups]
+
+Both are expected to find the same networks, the longest prefix first.
+"""
+
+from anthill.game.master.model.prefix import NetworkTrie
+
+import ipaddress
+import random
+import time
+import sys
+
+
+# the linear scan is too slow to go through all of the lookups
+LINEAR_LOOKUPS = 100
+
+
+def generate(generator, count):
+    networks = []
+
+    for value in range(0, count):
+        if generator.random() < 0.7:
+            network = ipaddress.ip_network((generator.getrandbits(32), generator.randint(8, 32)), strict=False)
+        else:
+            network = ipaddress.ip_network(
+                ((0x2001 << 112) | (generator.getrandbits(48) << 64), generator.randint(24, 64)), strict=False)
+
+        networks.append((network, value))
+
+    return networks
+
+
+def addresses(generator, networks, count):
+    result = []
+
+    for i in range(0, count):
+        network, value = generator.choice(networks)
+        # half of them within a banned network, the other half most likely not
+        if generator.random() < 0.5:
+            address = int(network.network_address) + generator.randint(0, network.num_addresses - 1)
+        else:
+            address = generator.getrandbits(network.max_prefixlen)
+
+        result.append(str(ipaddress.ip_address(address)))
+
+    return result
+
+
+def linear_match(networks, ip):
+    address = ipaddress.ip_address(ip)
+
+    found = [
+        (network, value)
+        for network, value in networks
+        if network.version == address.version and address in network
+    ]
+
+    found.sort(key=lambda item: item[0].prefixlen, reverse=True)
+    return [value for network, value in found]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    generator = random.Random(1)
+    networks = generate(generator, count)
+    ips = addresses(generator, networks, lookups)
+
+    print("{0} prefixes, {1} lookups".format(count, lookups))
+
+    trie = NetworkTrie()
+
+    started = time.time()
+    for network, value in networks:
+        trie.insert(str(network), value, value)
+    elapsed = time.time() - started
+
+    print("  insert: {0:.2f}s, {1:.1f}us per prefix".format(elapsed, elapsed * 1000000 / count))
+
+    started = time.time()
+    matched = 0
+    for ip in ips:
+        if trie.match(ip):
+            matched += 1
+    elapsed = time.time() - started
+
+    print("    trie: {0:.2f}s, {1:.1f}us per lookup, {2} matched".format(
+        elapsed, elapsed * 1000000 / lookups, matched))
+
+    sample = ips[:LINEAR_LOOKUPS]
+
+    started = time.time()
+    expected = [linear_match(networks, ip) for ip in sample]
+    elapsed = time.time() - started
+
+    mismatched = len([ip for ip, values in zip(sample, expected) if trie.match(ip) != values])
+
+    print("  linear: {0:.2f}s over {1} lookups, {2:.1f}us per lookup, {3} mismatched".format(
+        elapsed, len(sample), elapsed * 1000000 / len(sample), mismatched))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+
+import re
+
+
+class RecordingDB(object):
+    """
+    Stands for a database (and a connection acquired from it) in the model tests: records the statements instead
+        of running them, and answers each one with `respond(query, args)`, 1 by default
+    """
+
+    def __init__(self, respond=None):
+        self.executed = []
+        self.respond = respond or (lambda query, args: 1)
+
+    def acquire(self, auto_commit=True):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    async def __run__(self, query, *args):
+        self.executed.append((query, args))
+        return self.respond(query, args)
+
+    async def execute(self, query, *args):
+        return await self.__run__(query, *args)
+
+    async def insert(self, query, *args):
+        return await self.__run__(query, *args)
+
+    async def get(self, query, *args):
+        return await self.__run__(query, *args)
+
+    async def query(self, query, *args):
+        return await self.__run__(query, *args)
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+    def statements(self, prefix):
+        """
+        :returns the (query, args) recorded, which query starts with the prefix, like "UPDATE `rooms`"
+        """
+        return [
+            (query, args)
+            for query, args in self.executed
+            if " ".join(query.split()).startswith(prefix)
+        ]
+
+
+def top_level(sql):
+    """
+    :returns the SQL with every quoted string and everything in parentheses cut out, so whatever is left
+        is what the operators at the top level apply to
+    """
+    sql = re.sub(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", "''", sql)
+
+    result = []
+    depth = 0
+
+    for c in sql:
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif depth == 0:
+            result.append(c)
+
+    return " ".join("".join(result).split())
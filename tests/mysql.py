@@ -0,0 +1,68 @@
+
+import os
+
+
+SQL_DIR = os.path.join(os.path.dirname(__file__), "..", "anthill", "game", "master", "sql")
+
+
+def configured():
+    return bool(os.environ.get("TEST_MYSQL_HOST"))
+
+
+class ScratchDatabase(object):
+    """
+    A database the benchmarks run against, created with the tables of the service next to the TEST_MYSQL_DB
+        one, and dropped as a whole once done. The foreign keys are created, but not checked while seeding.
+
+    with ScratchDatabase("join", ["hosts", "rooms", "players"]) as scratch:
+        with scratch.connect() as connection:
+            ...
+    """
+
+    def __init__(self, suffix, tables):
+        self.host = os.environ["TEST_MYSQL_HOST"]
+        self.user = os.environ.get("TEST_MYSQL_USER", "root")
+        self.password = os.environ.get("TEST_MYSQL_PASSWORD", "")
+        self.name = os.environ.get("TEST_MYSQL_DB", "test") + "_" + suffix
+        self.tables = tables
+
+    def connect(self, database=True):
+        import pymysql
+
+        return pymysql.connect(
+            host=self.host, user=self.user, password=self.password,
+            database=self.name if database else None,
+            charset="utf8", autocommit=True, init_command="SET FOREIGN_KEY_CHECKS=0;")
+
+    def database(self):
+        from anthill.common.database import Database
+
+        return Database(host=self.host, database=self.name, user=self.user, password=self.password)
+
+    def __enter__(self):
+        connection = self.connect(database=False)
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("DROP DATABASE IF EXISTS `{0}`;".format(self.name))
+                cursor.execute("CREATE DATABASE `{0}` CHARACTER SET utf8;".format(self.name))
+                cursor.execute("USE `{0}`;".format(self.name))
+
+                for table in self.tables:
+                    with open(os.path.join(SQL_DIR, table + ".sql")) as f:
+                        cursor.execute(f.read())
+        finally:
+            connection.close()
+
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        connection = self.connect(database=False)
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("DROP DATABASE IF EXISTS `{0}`;".format(self.name))
+        finally:
+            connection.close()
+
+        return False
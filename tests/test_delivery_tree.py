@@ -0,0 +1,162 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.game.master.model.distribution import DeliveryTree
+
+import unittest
+import asyncio
+
+
+class Host(object):
+    def __init__(self, host_id, region):
+        self.host_id = host_id
+        self.region = region
+
+
+class Controllers(object):
+    """
+    Stands for the controllers of the hosts: a delivery takes a moment, and fails for the hosts asked to
+    """
+
+    def __init__(self, failing=None):
+        # host_id -> how many times its delivery fails before it succeeds, None for always
+        self.failing = failing or {}
+        self.delivered = set()
+        self.attempts = {}
+
+        # (region, source host_id or None for the master) -> how many it serves at the moment, and at most
+        self.serving = {}
+        self.max_serving = {}
+        self.running = {}
+        self.max_running = {}
+        self.total = 0
+        self.max_total = 0
+
+    def __start__(self, host, source):
+        key = (host.region, None if source is None else source.host_id)
+
+        self.serving[key] = self.serving.get(key, 0) + 1
+        self.max_serving[key] = max(self.max_serving.get(key, 0), self.serving[key])
+        self.running[host.region] = self.running.get(host.region, 0) + 1
+        self.max_running[host.region] = max(self.max_running.get(host.region, 0), self.running[host.region])
+        self.total += 1
+        self.max_total = max(self.max_total, self.total)
+
+    def __finish__(self, host, source):
+        self.serving[(host.region, None if source is None else source.host_id)] -= 1
+        self.running[host.region] -= 1
+        self.total -= 1
+
+    async def deliver(self, host, source):
+        if source is not None:
+            assert source.host_id in self.delivered, "a source has to have the deployment"
+            assert source.region == host.region, "the peers only serve their own region"
+
+        self.attempts[host.host_id] = self.attempts.get(host.host_id, 0) + 1
+        self.__start__(host, source)
+
+        try:
+            await asyncio.sleep(0.001)
+        finally:
+            self.__finish__(host, source)
+
+        failing = self.failing.get(host.host_id, 0)
+
+        if failing is None or self.attempts[host.host_id] <= failing:
+            raise Exception("Host {0} is down".format(host.host_id))
+
+        self.delivered.add(host.host_id)
+        return True
+
+    def max_master(self, region):
+        return self.max_serving.get((region, None), 0)
+
+    def max_peer(self, region):
+        return max([count for (r, source), count in self.max_serving.items() if r == region and source is not None])
+
+
+def fleet(count, regions):
+    return [Host(host_id, "region-{0}".format(host_id % regions)) for host_id in range(1, count + 1)]
+
+
+class DeliveryTreeTestCase(unittest.TestCase):
+    def run_tree(self, tree, controllers):
+        return IOLoop.current().run_sync(lambda: tree.run(controllers.deliver))
+
+    def test_fanout(self):
+        # the same run as the original one: 300 hosts in 2 regions, 4 seeds and a fanout of 4, one failing host
+        hosts = fleet(300, 2)
+        controllers = Controllers(failing={7: None})
+        reported = []
+
+        tree = DeliveryTree(hosts, seeds=4, fanout=4, on_result=lambda *args: reported.append(args))
+        results = self.run_tree(tree, controllers)
+
+        self.assertEqual(len(results), 300)
+        self.assertEqual([host_id for host_id, delivered in results.items() if not delivered], [7])
+        self.assertEqual(len(controllers.delivered), 299)
+
+        [(host, delivered, error)] = [result for result in reported if not result[1]]
+        self.assertEqual(host.host_id, 7)
+        self.assertEqual(error, "Host 7 is down")
+
+        for region in ["region-0", "region-1"]:
+            self.assertLessEqual(controllers.max_master(region), 4)
+            self.assertLessEqual(controllers.max_peer(region), 4)
+
+        # most of the hosts get the deployment from their peers
+        from_master = [host_id for host_id, source in tree.sources.items() if source is None]
+        self.assertLess(len(from_master), 30)
+        self.assertNotIn(7, [source.host_id for source in tree.sources.values() if source is not None])
+
+    def test_no_fanout(self):
+        hosts = fleet(20, 2)
+        controllers = Controllers()
+
+        tree = DeliveryTree(hosts, seeds=1, fanout=0)
+        results = self.run_tree(tree, controllers)
+
+        self.assertTrue(all(results.values()))
+        self.assertEqual(set(tree.sources.values()), {None})
+
+        # every host of a region downloads from the master at once
+        self.assertEqual(controllers.max_master("region-0"), 10)
+
+    def test_concurrency(self):
+        hosts = fleet(60, 3)
+        controllers = Controllers()
+
+        tree = DeliveryTree(hosts, seeds=4, fanout=4, concurrency=5, region_concurrency=3)
+        results = self.run_tree(tree, controllers)
+
+        self.assertTrue(all(results.values()))
+        self.assertLessEqual(controllers.max_total, 5)
+
+        for region, running in controllers.max_running.items():
+            self.assertLessEqual(running, 3)
+
+    def test_retries(self):
+        hosts = fleet(10, 1)
+        controllers = Controllers(failing={1: 2, 2: 3})
+        reported = {}
+
+        def on_result(host, delivered, error):
+            reported[host.host_id] = (delivered, error)
+
+        tree = DeliveryTree(hosts, seeds=2, fanout=2, retries=2, backoff=0.001, on_result=on_result)
+        results = self.run_tree(tree, controllers)
+
+        # failed twice, and delivered on the last retry
+        self.assertTrue(results[1])
+        self.assertEqual(controllers.attempts[1], 3)
+
+        # out of retries
+        self.assertFalse(results[2])
+        self.assertEqual(controllers.attempts[2], 3)
+        self.assertEqual(reported[2], (False, "Host 2 is down"))
+
+        self.assertEqual(len([delivered for delivered in results.values() if delivered]), 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.game.master.model.gameserver import GameServersModel, GameServersCache
+
+from .db import RecordingDB
+
+import unittest
+
+
+SERVER = {
+    "game_server_id": 1,
+    "gamespace_id": 1,
+    "game_name": "game",
+    "game_server_name": "default",
+    "server_settings": {"map": "default"}
+}
+
+
+class ResolveGameServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.invalidate = None
+        self.db = RecordingDB(self.respond)
+
+        self.gameservers = GameServersModel.__new__(GameServersModel)
+        self.gameservers.db = self.db
+        self.gameservers.cache = GameServersCache()
+        self.gameservers.cache.load([], [])
+
+    def respond(self, query, args):
+        if self.invalidate:
+            # the bus delivers a change while the database is being asked
+            self.invalidate()
+            self.invalidate = None
+
+        return dict(SERVER)
+
+    def resolve(self):
+        return IOLoop.current().run_sync(
+            lambda: self.gameservers.resolve_game_server(1, "game", "1.0", game_server_id=1))
+
+    def test_memoized(self):
+        gs, server_settings = self.resolve()
+
+        self.assertEqual(server_settings, {"map": "default"})
+        self.assertEqual(len(self.gameservers.cache.resolved), 1)
+
+        self.resolve()
+        self.assertEqual(len(self.db.executed), 1)
+
+    def test_invalidated_meanwhile(self):
+        # the game server is changed after it's been read from the database, but before it's resolved
+        self.invalidate = lambda: self.gameservers.__drop_server__(1)
+
+        self.resolve()
+
+        # resolved with whatever there was, but not kept
+        self.assertEqual(self.gameservers.cache.resolved, {})
+        self.assertIsNone(self.gameservers.cache.get_server(1, 1))
+
+        self.resolve()
+
+        self.assertEqual(len(self.db.executed), 2)
+        self.assertEqual(len(self.gameservers.cache.resolved), 1)
+        self.assertIsNotNone(self.gameservers.cache.get_server(1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.game.master.handlers import HostHandler
+
+import unittest
+
+
+class Rooms(object):
+    def __init__(self):
+        self.calls = []
+
+    async def remove_rooms(self, host_id, rooms):
+        self.calls.append(("remove_rooms", sorted(rooms)))
+
+    async def remove_host_rooms(self, host_id, except_rooms=None):
+        self.calls.append(("remove_host_rooms", sorted(except_rooms)))
+
+
+class Application(object):
+    def __init__(self):
+        self.rooms = Rooms()
+
+
+class DeltaController(object):
+    """
+    Reports the rooms delta, unless asked for the full list
+    """
+
+    def __init__(self):
+        self.rooms = {"1", "2"}
+        self.requests = []
+
+    async def heartbeat(self, context, method, timeout=None, full=False):
+        self.requests.append(full)
+
+        if full:
+            return {"load": {}, "rooms": sorted(self.rooms)}
+
+        return {"load": {}, "rooms_delta": {"added": [], "removed": []}}
+
+
+def host_handler(controller):
+    handler = HostHandler.__new__(HostHandler)
+
+    handler.host_id = 1
+    handler.application = Application()
+    handler.known_rooms = None
+    handler.heartbeats_since_full_check = 0
+    handler.reports_delta = False
+    handler.send_request = controller.heartbeat
+
+    return handler
+
+
+class HeartbeatTestCase(unittest.TestCase):
+    def setUp(self):
+        self.controller = DeltaController()
+        self.handler = host_handler(self.controller)
+
+    def heartbeat(self):
+        async def check():
+            report = await self.handler.__heartbeat__()
+            await self.handler.__reconcile_rooms__(report)
+
+        IOLoop.current().run_sync(check)
+
+    def test_full_list_asked_for(self):
+        # the first delta cannot be applied to anything, so the full list is asked for right away
+        self.heartbeat()
+
+        self.assertEqual(self.controller.requests, [False, True])
+        self.assertEqual(self.handler.application.rooms.calls, [("remove_host_rooms", ["1", "2"])])
+        self.assertEqual(self.handler.known_rooms, {"1", "2"})
+
+    def test_full_check_every(self):
+        for i in range(0, HostHandler.FULL_ROOMS_CHECK_EVERY + 1):
+            self.heartbeat()
+
+        full_checks = [call for call in self.handler.application.rooms.calls if call[0] == "remove_host_rooms"]
+        self.assertEqual(len(full_checks), 1)
+
+        # the delta heartbeats count for the full check as well
+        self.heartbeat()
+
+        full_checks = [call for call in self.handler.application.rooms.calls if call[0] == "remove_host_rooms"]
+        self.assertEqual(len(full_checks), 2)
+        self.assertEqual(self.controller.requests[-1], True)
+        self.assertEqual(self.handler.heartbeats_since_full_check, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
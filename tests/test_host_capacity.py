@@ -0,0 +1,242 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.game.master.model.host import HostAdapter, HostCapacity, HostRegistry, HostsModel, RegionAdapter
+from anthill.game.master.model.room import RoomError
+from anthill.game.master.model.player import Player
+from anthill.common.options import options
+
+# defines the hosts_* options the registry relies on
+from anthill.game.master import options as _opts
+
+import unittest
+
+
+def host(host_id=1, memory=0, cpu=0):
+    return HostAdapter({
+        "host_id": host_id,
+        "host_region": 1,
+        "host_address": "localhost",
+        "host_enabled": 1,
+        "host_memory": memory,
+        "host_cpu": cpu,
+        "host_storage": 0,
+        "host_state": "ACTIVE"
+    })
+
+
+class HostCapacityTestCase(unittest.TestCase):
+    def test_unknown(self):
+        capacity = HostCapacity()
+        capacity.observe(46, 46, None, 100)
+
+        self.assertEqual(capacity.ports, 100)
+        self.assertIsNone(capacity.room_memory)
+        self.assertIsNone(capacity.room_cpu)
+
+    def test_single_observation(self):
+        # the idle load of a host is not a cost of its only room
+        capacity = HostCapacity()
+        capacity.observe(46, 46, 1, None)
+
+        self.assertIsNone(capacity.room_memory)
+        self.assertIsNone(capacity.room_cpu)
+
+    def test_baseline(self):
+        capacity = HostCapacity()
+        capacity.observe(40, 10, 0, None)
+        capacity.observe(46, 14, 2, None)
+
+        self.assertAlmostEqual(capacity.room_memory, 3)
+        self.assertAlmostEqual(capacity.room_cpu, 2)
+
+    def test_delta(self):
+        capacity = HostCapacity()
+        capacity.observe(40, 10, 4, None)
+        capacity.observe(48, 16, 6, None)
+
+        self.assertAlmostEqual(capacity.room_memory, 4)
+        self.assertAlmostEqual(capacity.room_cpu, 3)
+
+    def test_delta_rooms_gone(self):
+        capacity = HostCapacity()
+        capacity.observe(48, 16, 6, None)
+        capacity.observe(40, 10, 4, None)
+
+        self.assertAlmostEqual(capacity.room_memory, 4)
+        self.assertAlmostEqual(capacity.room_cpu, 3)
+
+    def test_same_rooms(self):
+        capacity = HostCapacity()
+        capacity.observe(40, 10, 4, None)
+        capacity.observe(60, 30, 4, None)
+
+        self.assertIsNone(capacity.room_memory)
+        self.assertIsNone(capacity.room_cpu)
+
+    def test_clamp(self):
+        capacity = HostCapacity()
+        capacity.observe(10, 50, 0, None)
+        capacity.observe(90, 20, 1, None)
+
+        self.assertEqual(capacity.room_memory, HostCapacity.MAX_ROOM_COST)
+        self.assertEqual(capacity.room_cpu, HostCapacity.MIN_ROOM_COST)
+
+    def test_average(self):
+        capacity = HostCapacity()
+        capacity.observe(40, 40, 0, None)
+        capacity.observe(42, 42, 1, None)
+        capacity.observe(52, 52, 2, None)
+
+        # 2 observed first, then 6, weighted by COST_WEIGHT
+        expected = 2 + (6 - 2) * HostCapacity.COST_WEIGHT
+        self.assertAlmostEqual(capacity.room_memory, expected)
+        self.assertAlmostEqual(capacity.room_cpu, expected)
+
+
+class HostRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = HostRegistry()
+
+    def add(self, **kwargs):
+        h = host(**kwargs)
+        self.registry.add(h)
+        return h
+
+    def test_idle_host_with_a_room_fits(self):
+        h = self.add(memory=46, cpu=46)
+        self.registry.heartbeat(h.host_id, 40, 40, 0, "ACTIVE", rooms=0)
+        self.registry.heartbeat(h.host_id, 46, 46, 0, "ACTIVE", rooms=1)
+
+        self.assertTrue(self.registry.fits(h))
+        self.assertAlmostEqual(self.registry.projected(h, 1)[0], 52)
+
+    def test_default_cost(self):
+        h = self.add(memory=50, cpu=50)
+        memory, cpu, ports = self.registry.projected(h, 3)
+
+        self.assertEqual(memory, 50 + 3 * options.hosts_spawn_cost)
+        self.assertEqual(cpu, 50 + 3 * options.hosts_spawn_cost)
+        self.assertIsNone(ports)
+
+    def test_limits(self):
+        h = self.add(memory=50, cpu=10)
+        self.registry.heartbeat(h.host_id, 50, 10, 0, "ACTIVE", rooms=0)
+        self.registry.heartbeat(h.host_id, 70, 10, 0, "ACTIVE", rooms=1)
+
+        # each room takes 20% of memory: 70 + 20 is right at the limit
+        self.assertTrue(self.registry.fits(h))
+        self.assertFalse(self.registry.fits(h, extra=2))
+
+    def test_pending_ledger(self):
+        h = self.add(memory=80, cpu=10)
+
+        self.assertTrue(self.registry.fits(h))
+
+        for i in range(5):
+            self.registry.spawn_started(h.host_id)
+
+        self.assertEqual(self.registry.pending(h.host_id), 5)
+        self.assertFalse(self.registry.fits(h))
+
+        # a spawn that failed is no longer accounted for
+        self.registry.spawn_finished(h.host_id, success=False)
+        self.assertEqual(self.registry.pending(h.host_id), 4)
+
+        # a spawn that succeeded is, until the next heartbeat
+        self.registry.spawn_finished(h.host_id)
+        self.assertEqual(self.registry.pending(h.host_id), 4)
+
+        self.registry.heartbeat(h.host_id, 82, 10, 0, "ACTIVE", rooms=1)
+        self.assertEqual(self.registry.pending(h.host_id), 3)
+        self.assertEqual(h.memory, 82)
+
+    def test_lost_spawns(self):
+        h = self.add(memory=88, cpu=10)
+        self.registry.spawn_started(h.host_id)
+        self.assertFalse(self.registry.fits(h))
+
+        for spawn in self.registry.spawning[h.host_id]:
+            spawn[0] = 0
+
+        self.assertEqual(self.registry.pending(h.host_id), 0)
+        self.assertTrue(self.registry.fits(h))
+
+    def test_ports(self):
+        h = self.add(memory=10, cpu=10)
+        self.registry.heartbeat(h.host_id, 10, 10, 0, "ACTIVE", rooms=0, ports=4)
+
+        self.assertTrue(self.registry.fits(h, ports=2, extra=2))
+        self.registry.spawn_started(h.host_id, ports=2)
+
+        self.assertEqual(self.registry.projected(h)[2], 2)
+        self.assertTrue(self.registry.fits(h, ports=2))
+        self.assertFalse(self.registry.fits(h, ports=3))
+
+    def test_remove(self):
+        h = self.add(memory=10, cpu=10)
+        self.registry.spawn_started(h.host_id)
+        self.registry.remove(h.host_id)
+
+        self.assertIsNone(self.registry.get(h.host_id))
+        self.assertEqual(self.registry.pending(h.host_id), 0)
+
+
+class Deployment(object):
+    deployment_id = "1"
+    enabled = True
+
+
+class Limit(object):
+    async def rollback(self):
+        pass
+
+
+class App(object):
+    """
+    Just enough of the application for Player.create, with a room insert that fails
+    """
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.geo = self
+        self.rooms = self
+        self.gameservers = None
+        self.bans = None
+        self.deployments = self
+        self.ratelimit = self
+
+    async def get_current_deployment(self, gamespace, game_name, game_version):
+        return Deployment()
+
+    async def get_delivered_hosts(self, gamespace, deployment_id):
+        return None
+
+    async def limit(self, action, account_id):
+        return Limit()
+
+    async def get_closest_region(self, ip):
+        return RegionAdapter({"region_id": 1})
+
+    async def create_and_join_room(self, *args, **kwargs):
+        raise RoomError("Failed to create a room: Deadlock found")
+
+
+class SpawnReservationTestCase(unittest.TestCase):
+    def test_create_room_failed(self):
+        hosts = HostsModel.__new__(HostsModel)
+        hosts.registry = HostRegistry()
+        hosts.registry.load([host(memory=10, cpu=10)])
+
+        player = Player(App(hosts), 1, "game", "1.0", "default", 1, "token", {}, "127.0.0.1")
+        player.game_settings = {}
+
+        with self.assertRaises(RoomError):
+            IOLoop.current().run_sync(lambda: player.create({}))
+
+        # the room has never made it to the host, so neither has the spawn
+        self.assertEqual(hosts.registry.pending("1"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+
+from anthill.game.master.model.prefix import NetworkTrie, PrefixTrie
+
+import ipaddress
+import unittest
+import random
+
+
+def linear_match(networks, ip):
+    """
+    What the trie is expected to answer, found the slow way: every network the address belongs to,
+        the longest prefix first
+    """
+    address = ipaddress.ip_address(ip)
+
+    found = [
+        (network, value)
+        for network, value in networks
+        if network.version == address.version and address in network
+    ]
+
+    found.sort(key=lambda item: item[0].prefixlen, reverse=True)
+    return [value for network, value in found]
+
+
+class NetworkTrieTestCase(unittest.TestCase):
+    def setUp(self):
+        self.trie = NetworkTrie()
+
+    def test_longest_prefix_first(self):
+        self.trie.insert("10.0.0.0/8", 1, "a")
+        self.trie.insert("10.1.0.0/16", 2, "b")
+        self.trie.insert("10.1.2.0/24", 3, "c")
+        self.trie.insert("10.1.2.3/32", 4, "d")
+
+        self.assertEqual(self.trie.match("10.1.2.3"), ["d", "c", "b", "a"])
+        self.assertEqual(self.trie.match("10.1.2.4"), ["c", "b", "a"])
+        self.assertEqual(self.trie.match("10.1.3.1"), ["b", "a"])
+        self.assertEqual(self.trie.match("10.2.0.1"), ["a"])
+        self.assertEqual(self.trie.match("11.0.0.1"), [])
+
+    def test_ipv4(self):
+        self.trie.insert("192.168.0.0/24", 1, "lan")
+
+        self.assertEqual(self.trie.match("192.168.0.0"), ["lan"])
+        self.assertEqual(self.trie.match("192.168.0.255"), ["lan"])
+        self.assertEqual(self.trie.match("192.168.1.0"), [])
+        self.assertEqual(self.trie.match("192.167.255.255"), [])
+
+    def test_ipv6(self):
+        self.trie.insert("2001:db8::/32", 1, "doc")
+        self.trie.insert("2001:db8:1::/48", 2, "site")
+
+        self.assertEqual(self.trie.match("2001:db8:1::1"), ["site", "doc"])
+        self.assertEqual(self.trie.match("2001:db8:2::1"), ["doc"])
+        self.assertEqual(self.trie.match("2001:db9::1"), [])
+
+    def test_families_apart(self):
+        # ::/0 and 0.0.0.0/0 both cover everything, but only the addresses of their own family
+        self.trie.insert("0.0.0.0/0", 1, "v4")
+        self.trie.insert("::/0", 2, "v6")
+        self.trie.insert("::ffff:10.0.0.0/104", 3, "mapped")
+
+        self.assertEqual(self.trie.match("10.0.0.1"), ["v4"])
+        self.assertEqual(self.trie.match("::1"), ["v6"])
+        self.assertEqual(self.trie.match("::ffff:10.0.0.1"), ["mapped", "v6"])
+
+    def test_overlapping(self):
+        # inserted the shortest prefix last, so the nodes in between have to be split
+        self.trie.insert("172.16.5.0/24", 1, "c")
+        self.trie.insert("172.16.4.0/24", 2, "d")
+        self.trie.insert("172.16.0.0/12", 3, "a")
+        self.trie.insert("172.16.0.0/16", 4, "b")
+
+        self.assertEqual(self.trie.match("172.16.5.1"), ["c", "b", "a"])
+        self.assertEqual(self.trie.match("172.16.4.1"), ["d", "b", "a"])
+        self.assertEqual(self.trie.match("172.16.6.1"), ["b", "a"])
+        self.assertEqual(self.trie.match("172.31.0.1"), ["a"])
+        self.assertEqual(self.trie.match("172.32.0.1"), [])
+
+    def test_same_network(self):
+        # several bans on the same network, written differently
+        self.trie.insert("10.0.0.0/8", 1, "a")
+        self.trie.insert("10.20.30.40/8", 2, "b")
+
+        self.assertEqual(sorted(self.trie.match("10.1.1.1")), ["a", "b"])
+
+        self.trie.remove("10.0.0.0/8", 1)
+        self.assertEqual(self.trie.match("10.1.1.1"), ["b"])
+
+    def test_remove(self):
+        self.trie.insert("10.0.0.0/8", 1, "a")
+        self.trie.insert("10.1.0.0/16", 2, "b")
+
+        self.trie.remove("10.1.0.0/16", 2)
+        self.assertEqual(self.trie.match("10.1.0.1"), ["a"])
+
+        # whatever is not there is ignored
+        self.trie.remove("10.1.0.0/16", 2)
+        self.trie.remove("10.2.0.0/16", 3)
+        self.trie.remove("10.0.0.0/9", 1)
+        self.assertEqual(self.trie.match("10.1.0.1"), ["a"])
+
+        self.trie.remove("10.0.0.0/8", 1)
+        self.assertEqual(self.trie.match("10.1.0.1"), [])
+
+    def test_malformed(self):
+        self.assertEqual(self.trie.match("not an address"), [])
+
+        with self.assertRaises(ValueError):
+            self.trie.insert("10.0.0.0/33", 1, "a")
+
+    def test_against_linear(self):
+        generator = random.Random(1)
+        networks = []
+
+        for value in range(0, 1000):
+            if generator.random() < 0.5:
+                # a narrow address space, so there are plenty of overlaps
+                network = ipaddress.ip_network(
+                    (generator.getrandbits(12) << 20, generator.randint(4, 32)), strict=False)
+            else:
+                network = ipaddress.ip_network(
+                    ((0x2001 << 112) | (generator.getrandbits(16) << 96), generator.randint(16, 128)),
+                    strict=False)
+
+            networks.append((network, value))
+            self.trie.insert(str(network), value, value)
+
+        for i in range(0, 1000):
+            network, value = generator.choice(networks)
+            # an address somewhere within the network, or just past it
+            offset = generator.randint(0, network.num_addresses)
+            ip = str(ipaddress.ip_address(
+                min(int(network.network_address) + offset, (1 << network.max_prefixlen) - 1)))
+
+            self.assertEqual(self.trie.match(ip), linear_match(networks, ip), ip)
+
+
+class PrefixTrieTestCase(unittest.TestCase):
+    def test_full_width(self):
+        trie = PrefixTrie(8)
+
+        trie.insert(0b10101010, 8, 1, "host")
+        trie.insert(0b10100000, 4, 2, "net")
+
+        self.assertEqual(trie.match(0b10101010), ["host", "net"])
+        self.assertEqual(trie.match(0b10101011), ["net"])
+        self.assertEqual(trie.match(0b00101010), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
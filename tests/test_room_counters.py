@@ -0,0 +1,171 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.game.master.model.room import RoomsModel
+
+from .db import RecordingDB
+
+import unittest
+import re
+
+
+# the conditions the tests delete the players with, as the database would evaluate them
+CONDITIONS = {
+    "`host_id`=%s": lambda player, host_id: player["host_id"] == host_id,
+    "`host_id`=%s AND `state`='RESERVED'":
+        lambda player, host_id: player["host_id"] == host_id and player["state"] == "RESERVED",
+    "`account_id` IN %s": lambda player, accounts: player["account_id"] in accounts,
+}
+
+
+class RoomsDB(RecordingDB):
+    """
+    Keeps the `rooms` and the `players` tables in memory, and runs the statements the player removal is made of
+    """
+
+    def __init__(self):
+        super().__init__(self.run)
+
+        # room_id -> {"host_id", "players"}
+        self.rooms = {}
+        # record_id -> {"room_id", "host_id", "account_id", "state"}
+        self.players = {}
+
+    def add_room(self, room_id, host_id, players, reserved=0):
+        self.rooms[room_id] = {"host_id": host_id, "players": players}
+
+        for i in range(0, players):
+            record_id = len(self.players) + 1
+            self.players[record_id] = {
+                "room_id": room_id,
+                "host_id": host_id,
+                "account_id": record_id,
+                "state": "RESERVED" if i < reserved else "JOINED"
+            }
+
+    def count(self, room_id):
+        return len([player for player in self.players.values() if player["room_id"] == room_id])
+
+    @staticmethod
+    def condition(query):
+        return CONDITIONS[re.search(r"WHERE (.*?)\s*(FOR UPDATE)?;", query, re.S).group(1)]
+
+    def run(self, query, args):
+        statement = " ".join(query.split())
+
+        if statement.startswith("SELECT `record_id`, `room_id` FROM `players`"):
+            condition = RoomsDB.condition(statement)
+
+            return [
+                {"record_id": record_id, "room_id": player["room_id"]}
+                for record_id, player in self.players.items()
+                if condition(player, *args)
+            ]
+
+        if statement.startswith("DELETE FROM `players` WHERE `record_id` IN %s"):
+            records, = args
+
+            for record_id in records:
+                del self.players[record_id]
+
+            return len(records)
+
+        if statement.startswith("DELETE FROM `players` WHERE `gamespace_id`=%s AND `room_id`=%s AND "):
+            gamespace, room_id = args[:2]
+            condition = CONDITIONS[statement.split(" AND ", 2)[2].rstrip(";")]
+
+            deleted = [
+                record_id
+                for record_id, player in self.players.items()
+                if player["room_id"] == room_id and condition(player, *args[2:])
+            ]
+
+            for record_id in deleted:
+                del self.players[record_id]
+
+            return len(deleted)
+
+        if statement.startswith("UPDATE `rooms` SET `players`=IF("):
+            amount, amount, gamespace, room_id = args
+            room = self.rooms[room_id]
+            room["players"] = max(room["players"] - amount, 0)
+            return 1
+
+        if statement.startswith("UPDATE `rooms` r JOIN ("):
+            # the UNION ALL of (room_id, amount) pairs
+            for room_id, amount in zip(args[0::2], args[1::2]):
+                room = self.rooms[room_id]
+                room["players"] = max(room["players"] - amount, 0)
+
+            return len(args) // 2
+
+        raise AssertionError("Unexpected statement: " + statement)
+
+
+class PlayersCountersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = RoomsDB()
+
+        self.rooms = RoomsModel.__new__(RoomsModel)
+        self.rooms.db = self.db
+        self.rooms.index = None
+
+        # rooms 1..20 on the host 1 with a few reservations each, 21..25 on the host 2
+        for room_id in range(1, 26):
+            self.db.add_room(room_id, 1 if room_id <= 20 else 2, players=room_id % 7 + 1, reserved=room_id % 3)
+
+    def run_sync(self, func, *args):
+        return IOLoop.current().run_sync(lambda: func(*args))
+
+    def assertCountersCorrect(self):
+        for room_id, room in self.db.rooms.items():
+            self.assertEqual(room["players"], self.db.count(room_id), "room {0}".format(room_id))
+
+    def test_host_cleanup(self):
+        before = len(self.db.players)
+        on_host = len([player for player in self.db.players.values() if player["host_id"] == 1])
+
+        removed = self.run_sync(self.rooms.__delete_players__, "`host_id`=%s", 1)
+
+        self.assertEqual(removed, on_host)
+        self.assertEqual(len(self.db.players), before - on_host)
+        self.assertCountersCorrect()
+
+        for room_id in range(1, 21):
+            self.assertEqual(self.db.rooms[room_id]["players"], 0)
+
+        # all of the rooms are decremented with a single statement
+        self.assertEqual(len(self.db.statements("UPDATE `rooms`")), 1)
+
+    def test_host_reservations_cleanup(self):
+        reserved = len([
+            player for player in self.db.players.values()
+            if player["host_id"] == 1 and player["state"] == "RESERVED"
+        ])
+
+        removed = self.run_sync(self.rooms.__delete_players__, "`host_id`=%s AND `state`='RESERVED'", 1)
+
+        self.assertEqual(removed, reserved)
+        self.assertCountersCorrect()
+
+    def test_room_by_room_cleanup(self):
+        for room_id in range(1, 21):
+            accounts = [
+                player["account_id"] for player in self.db.players.values() if player["room_id"] == room_id
+            ][:2]
+
+            removed = self.run_sync(self.rooms.__delete_room_players__, 1, room_id, "`account_id` IN %s", accounts)
+            self.assertEqual(removed, len(accounts))
+
+        self.assertCountersCorrect()
+
+    def test_nothing_to_cleanup(self):
+        removed = self.run_sync(self.rooms.__delete_players__, "`host_id`=%s", 3)
+
+        self.assertEqual(removed, 0)
+        self.assertEqual(self.db.statements("UPDATE"), [])
+        self.assertCountersCorrect()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.game.master.model.index import RoomFilter, FilterUnsupported
+from anthill.game.master.model.room import RoomsModel
+from anthill.common.database import format_conditions_json, ConditionError
+
+from .db import RecordingDB, top_level
+
+import unittest
+import ujson
+import os
+
+
+SETTINGS = [
+    {"mode": "ffa", "level": 10, "rate": 1.5, "ranked": True, "score": "12abc", "tag": None},
+    {"mode": "FFA", "level": 5, "rate": 1.0, "ranked": False, "score": "abc", "tag": "eu"},
+    {"mode": "ctf", "level": "10", "rate": 2, "ranked": 1, "score": 0},
+    {"mode": "ctf", "level": 0},
+    {}
+]
+
+# filters -> which of SETTINGS do match, the same way MySQL does
+CASES = [
+    ({"mode": "ffa"}, [0, 1]),
+    ({"mode": "ctf"}, [2, 3]),
+    ({"mode": {"@func": "=", "@value": "FfA"}}, [0, 1]),
+    ({"level": 10}, [0, 2]),
+    ({"level": "10"}, [0, 2]),
+    ({"rate": 1}, []),
+    ({"rate": 1.0}, [1]),
+    ({"ranked": True}, [0]),
+    ({"ranked": False}, [1]),
+    ({"ranked": {"@func": "=", "@value": True}}, [0]),
+    ({"tag": "null"}, [0]),
+    ({"level": {"@func": ">", "@value": 5}}, [0, 2]),
+    ({"level": {"@func": ">=", "@value": 5}}, [0, 1, 2]),
+    ({"level": {"@func": "<", "@value": 5}}, [3]),
+    ({"level": {"@func": "<=", "@value": 5}}, [1, 3]),
+    ({"level": {"@func": "!=", "@value": 10}}, [1, 3]),
+    ({"score": {"@func": ">", "@value": 11}}, [0]),
+    ({"score": {"@func": "=", "@value": 0}}, [2]),
+    ({"score": {"@func": "<=", "@value": 0}}, [1, 2]),
+    ({"mode": {"@func": "<", "@value": 1}}, [0, 1, 2, 3]),
+    ({"ranked": {"@func": "<", "@value": 1}}, [0, 1]),
+    ({"tag": {"@func": "<", "@value": 1}}, [0, 1]),
+    ({"level": {"@func": "between", "@a": 1, "@b": 10}}, [0, 1, 2]),
+    ({"rate": {"@func": "between", "@a": 1.2, "@b": 2}}, [0, 2]),
+    ({"level": {"@func": "in", "@values": [5, 10]}}, [0, 1]),
+    ({"level": {"@func": "in", "@values": ["10"]}}, [2]),
+    ({"mode": {"@func": "in", "@values": ["ffa", "ctf"]}}, [0, 2, 3]),
+    ({"rate": [1, 2]}, [1, 2]),
+    ({"ranked": [True]}, [2]),
+    ({"mode": "ctf", "level": [0, 5]}, [3]),
+    ({"mode": ["ffa"], "level": 10}, [0]),
+    ({"missing": {"@func": "<", "@value": 1}}, []),
+    ({}, [0, 1, 2, 3, 4])
+]
+
+# filters the database rejects
+INVALID = [
+    {"mode": {"@value": "ffa"}},
+    {"mode": {"@func": "<>", "@value": 1}},
+    {"mode": {"@func": "like", "@value": "f%"}},
+    {"mode": {"@func": "="}},
+    {"mode": {"@func": "=", "@value": [1]}},
+    {"level": {"@func": ">", "@value": "5"}},
+    {"level": {"@func": "!=", "@value": "5"}},
+    {"level": {"@func": "between", "@a": 1}},
+    {"level": {"@func": "between", "@a": 1, "@b": "5"}},
+    {"level": {"@func": "in", "@values": []}},
+    {"level": {"@func": "in", "@values": 5}},
+    {"level": {"@func": "in", "@values": [{}]}},
+    {"level": None},
+    {"level": {}}
+]
+
+
+def matches(filters):
+    room_filter = RoomFilter(filters)
+    return [index for index, settings in enumerate(SETTINGS) if room_filter.match(settings)]
+
+
+class RoomFilterTestCase(unittest.TestCase):
+    def test_cases(self):
+        for filters, expected in CASES:
+            with self.subTest(filters=filters):
+                self.assertEqual(matches(filters), expected)
+
+    def test_invalid(self):
+        for filters in INVALID:
+            with self.subTest(filters=filters):
+                with self.assertRaises(ConditionError):
+                    format_conditions_json("settings", filters)
+                with self.assertRaises(FilterUnsupported):
+                    RoomFilter(filters)
+
+    def test_dotted_keys(self):
+        # the database looks those up in the nested objects
+        format_conditions_json("settings", {"a.b": 1})
+
+        with self.assertRaises(FilterUnsupported):
+            RoomFilter({"a.b": 1})
+
+    def test_no_filters(self):
+        self.assertTrue(RoomFilter(None).match({"mode": "ffa"}))
+        self.assertFalse(RoomFilter({"mode": "ffa"}).match(None))
+
+
+class ClaimSlotsTestCase(unittest.TestCase):
+    """
+    The slots are claimed with the very conditions the filters are turned into, so a condition that is a chain
+        of ORs must not leak out of the WHERE of the claim
+    """
+
+    def test_list_filter(self):
+        IOLoop.current().run_sync(self.__list_filter__)
+
+    async def __list_filter__(self):
+        rooms = RoomsModel.__new__(RoomsModel)
+        db = RecordingDB()
+
+        conditions = format_conditions_json("settings", {
+            "mode": ["ffa", "ctf"],
+            "level": {"@func": "in", "@values": [1, 2, 3]},
+            "ranked": True
+        })
+
+        claimed = await rooms.__claim_slots__(1, 10, 2, conditions, db)
+        self.assertTrue(claimed)
+
+        [(query, args)] = db.statements("UPDATE `rooms`")
+        where = top_level(query.split("WHERE", 1)[1]).upper().split()
+
+        self.assertNotIn("OR", where)
+        self.assertEqual(where.count("AND"), 3 + len(conditions))
+        self.assertEqual(query.count("%s"), len(args))
+        self.assertEqual(args[:4], (2, 10, 1, 2))
+
+
+@unittest.skipUnless(os.environ.get("TEST_MYSQL_HOST"), "TEST_MYSQL_HOST is not set")
+class RoomFilterMySQLTestCase(unittest.TestCase):
+    """
+    Runs every case through format_conditions_json against an actual MySQL and compares with RoomFilter
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        import pymysql
+
+        cls.connection = pymysql.connect(
+            host=os.environ["TEST_MYSQL_HOST"],
+            user=os.environ.get("TEST_MYSQL_USER", "root"),
+            password=os.environ.get("TEST_MYSQL_PASSWORD", ""),
+            database=os.environ.get("TEST_MYSQL_DB", "test"),
+            charset="utf8mb4")
+
+        with cls.connection.cursor() as cursor:
+            cursor.execute(
+                """
+                CREATE TEMPORARY TABLE `room_filter_test` (
+                  `room_id` int(11) NOT NULL,
+                  `settings` json NOT NULL,
+                  PRIMARY KEY (`room_id`)
+                );
+                """)
+
+            for index, settings in enumerate(SETTINGS):
+                cursor.execute(
+                    """
+                    INSERT INTO `room_filter_test` (`room_id`, `settings`) VALUES (%s, %s);
+                    """, (index, ujson.dumps(settings)))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.connection.close()
+
+    def select(self, filters):
+        conditions = ["TRUE"]
+        data = []
+
+        for condition, values in format_conditions_json("settings", filters):
+            conditions.append("(" + condition + ")")
+            data.extend(values)
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT `room_id` FROM `room_filter_test` WHERE {0} ORDER BY `room_id`;
+                """.format(" AND ".join(conditions)), data)
+
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_cases(self):
+        for filters, expected in CASES:
+            with self.subTest(filters=filters):
+                self.assertEqual(self.select(filters), expected)
+                self.assertEqual(matches(filters), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
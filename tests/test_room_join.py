@@ -0,0 +1,128 @@
+
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+
+from anthill.game.master.model.room import RoomsModel, JoinBatch
+from anthill.game.master.model.timer import TimerWheel
+from anthill.common.options import options
+from anthill.common.database import format_conditions_json
+
+# defines the rooms_* options the model relies on
+from anthill.game.master import options as _opts
+
+from .db import RecordingDB, top_level
+
+import unittest
+
+
+ROOMS = [
+    {"room_id": 10, "host_id": 1, "region_id": 1, "players": 0, "max_players": 4, "settings": {"mode": "ffa"}},
+    {"room_id": 11, "host_id": 1, "region_id": 1, "players": 2, "max_players": 4, "settings": {"mode": "ctf"}}
+]
+
+
+def respond(query, args):
+    statement = " ".join(query.split())
+
+    if statement.startswith("SELECT"):
+        return [dict(room) for room in ROOMS]
+    if statement.startswith("INSERT"):
+        return 100
+
+    return 1
+
+
+def rooms_model(db):
+    rooms = RoomsModel.__new__(RoomsModel)
+
+    rooms.db = db
+    rooms.index = None
+    rooms.join_batches = {}
+    rooms.expiry_wheel = TimerWheel(tick=RoomsModel.EXPIRY_TICK)
+
+    return rooms
+
+
+def checks_host(query):
+    return "`hosts`" in query
+
+
+class OptimisticJoinTestCase(unittest.TestCase):
+    """
+    The slot claim should require exactly what the room search required, the same as the locking join does
+    """
+
+    def setUp(self):
+        self.join_mode = options.rooms_join_mode
+        options.rooms_join_mode = "optimistic"
+
+        self.db = RecordingDB(respond)
+        self.rooms = rooms_model(self.db)
+
+    def tearDown(self):
+        options.rooms_join_mode = self.join_mode
+
+    def run_sync(self, func, *args):
+        return IOLoop.current().run_sync(lambda: func(*args))
+
+    def test_join_room_any_host(self):
+        record_id, key, room = self.run_sync(
+            self.rooms.join_room, 1, "game", 10, 5, "token", {})
+
+        self.assertEqual(record_id, 100)
+        self.assertEqual(room.room_id, "10")
+
+        [(search, args)] = self.db.statements("SELECT")
+        [(claim, args)] = self.db.statements("UPDATE `rooms`")
+
+        self.assertFalse(checks_host(search))
+        self.assertFalse(checks_host(claim))
+
+    def test_find_and_join_room_active_host(self):
+        record_id, key, room = self.run_sync(
+            self.rooms.find_and_join_room, 1, "game", "1.0", 1, 5, "token", {}, {"mode": ["ffa", "ctf"]})
+
+        self.assertEqual(record_id, 100)
+
+        [(search, args)] = self.db.statements("SELECT")
+        [(claim, args)] = self.db.statements("UPDATE `rooms`")
+
+        self.assertTrue(checks_host(search))
+        self.assertTrue(checks_host(claim))
+
+
+class JoinBatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = RecordingDB(respond)
+        self.rooms = rooms_model(self.db)
+
+    def test_list_filter(self):
+        filters = {"mode": ["ffa", "ctf"]}
+
+        batch = JoinBatch(1, "game", "1.0", 1, filters, format_conditions_json("settings", filters))
+        batch.requests = [((account_id, "token", {}), Future()) for account_id in range(0, 7)]
+
+        IOLoop.current().run_sync(lambda: self.rooms.__process_join_batch__(batch))
+
+        claims = self.db.statements("UPDATE `rooms`")
+
+        # 4 free slots in the first room, 2 in the second one
+        self.assertEqual([args[0] for query, args in claims], [4, 2])
+
+        for query, args in claims:
+            where = top_level(query.split("WHERE", 1)[1]).upper().split()
+
+            self.assertNotIn("OR", where)
+            self.assertEqual(query.count("%s"), len(args))
+
+        results = [future.result() for member, future in batch.requests]
+
+        self.assertEqual([room.room_id for record_id, key, room in results[:6]], ["10"] * 4 + ["11"] * 2)
+        self.assertEqual([record_id for record_id, key, room in results[:6]], [100, 101, 102, 103, 100, 101])
+
+        # no room left for the last one, it joins on its own
+        self.assertIsNone(results[6])
+
+
+if __name__ == "__main__":
+    unittest.main()
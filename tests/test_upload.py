@@ -0,0 +1,115 @@
+
+from tornado.ioloop import IOLoop
+
+from anthill.game.master.model.upload import DeploymentUploadsModel, UploadAdapter, UploadError
+from anthill.game.master.model.deploy import DeploymentAdapter
+
+from .db import RecordingDB
+
+import tempfile
+import hashlib
+import unittest
+import shutil
+import os
+
+
+PART_SIZE = DeploymentUploadsModel.MIN_PART_SIZE
+# the body arrives in chunks of that size, the same way tornado passes it to data_received
+BODY_CHUNK = 65536
+
+
+class Deployments(object):
+    def __init__(self, location):
+        self.location = location
+
+    def get_deployment_path(self, deployment):
+        return os.path.join(self.location, deployment.deployment_id + ".zip")
+
+
+class UploadPartTestCase(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.db = RecordingDB()
+        self.uploads = DeploymentUploadsModel(self.db, Deployments(self.location))
+
+        self.deployment = DeploymentAdapter({
+            "deployment_id": 1,
+            "game_name": "game",
+            "game_version": "1.0",
+            "deployment_status": DeploymentAdapter.STATUS_UPLOADING
+        })
+
+        self.upload = UploadAdapter({
+            "deployment_id": 1,
+            "upload_size": PART_SIZE * 3 + 100,
+            "upload_part_size": PART_SIZE
+        })
+
+        self.filename = os.path.join(self.location, "1.zip")
+
+        with open(self.filename, "wb") as f:
+            f.truncate(self.upload.size)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def run_sync(self, func, *args, **kwargs):
+        return IOLoop.current().run_sync(lambda: func(*args, **kwargs))
+
+    def send(self, part_number, data, part_hash=None):
+        part = self.run_sync(self.uploads.start_part, 1, self.deployment, self.upload, part_number)
+
+        try:
+            for offset in range(0, len(data), BODY_CHUNK):
+                self.run_sync(self.uploads.write_part, part, data[offset:offset + BODY_CHUNK])
+
+                # the body is not kept in memory as a whole
+                self.assertLess(len(part.pending), DeploymentUploadsModel.WRITE_CHUNK)
+
+            return self.run_sync(self.uploads.finish_part, 1, self.deployment, part, part_hash=part_hash)
+        finally:
+            self.uploads.close_part(part)
+
+    def test_part(self):
+        data = os.urandom(PART_SIZE)
+        part_hash = self.send(1, data, part_hash=hashlib.sha256(data).hexdigest())
+
+        self.assertEqual(part_hash, hashlib.sha256(data).hexdigest())
+
+        with open(self.filename, "rb") as f:
+            f.seek(PART_SIZE)
+            self.assertEqual(f.read(PART_SIZE), data)
+
+        [(query, args)] = self.db.statements("INSERT INTO `deployment_upload_parts`")
+        self.assertEqual(args[2:4], (1, part_hash))
+
+    def test_last_part(self):
+        data = os.urandom(100)
+        self.send(3, data)
+
+        with open(self.filename, "rb") as f:
+            f.seek(PART_SIZE * 3)
+            self.assertEqual(f.read(), data)
+
+    def test_wrong_size(self):
+        with self.assertRaises(UploadError):
+            self.send(0, os.urandom(PART_SIZE - 1))
+
+        with self.assertRaises(UploadError):
+            self.send(0, os.urandom(PART_SIZE + 1))
+
+        self.assertEqual(self.db.statements("INSERT"), [])
+
+    def test_corrupted(self):
+        with self.assertRaises(UploadError):
+            self.send(0, os.urandom(PART_SIZE), part_hash="00")
+
+        self.assertEqual(self.db.statements("INSERT"), [])
+
+    def test_no_such_part(self):
+        with self.assertRaises(UploadError):
+            self.run_sync(self.uploads.start_part, 1, self.deployment, self.upload, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()